@@ -0,0 +1,356 @@
+"""
+Offline benchmark suite for the analysis pipeline.
+
+Times the analyzers (including the fast name filter), tf_idf, max_row, keyword_search1 and similar_books on a synthetic corpus of several sizes and document lengths, and on the shipped data/ pickles.
+Every case runs in its own spawned process, so that its peak RSS can be measured: peak_rss_mb is the peak of the whole process, case_rss_mb the part added by the case on top of the interpreter and the imported libraries. No network access is needed; the analyzer cases need the spacy model to be installed and are skipped otherwise.
+
+Usage:
+    python benchmark.py --output results.json
+    python benchmark.py --save-baseline benchmark_baseline.json
+    python benchmark.py --baseline benchmark_baseline.json --tolerance 0.2
+"""
+
+import argparse
+import functools
+import json
+import multiprocessing
+import pickle
+import platform
+import queue as queue_module
+import random
+import resource
+import sys
+import time
+import numpy as np
+import pandas as pd
+import scipy
+import sklearn
+import spacy
+import tfidf
+import search_engine
+
+
+DATA_FILES = {
+    "summary": "data/summary_results_1.pkl",
+    "full_text": "data/full_text_results_1.pkl",
+}
+
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ber", "dan", "gel", "hor", "lin", "mar", "pen", "tor"]
+FILLERS = ["the", "and", "of", "to", "in", "was", "with", "his", "her", "that", "on", "for"]
+NAMES = ["Elizabeth", "Darcy", "Heathcliff", "Catherine", "Gulliver", "Ishmael", "Ahab", "Pip", "Jane", "Rochester"]
+
+
+def synthetic_corpus(n_docs, doc_length, vocab_size = 5000, seed = 42):
+    """
+    Generates a reproducible corpus of English-like documents: Zipf-distributed pseudo-words mixed with stop words, numbers and character names, in sentences and paragraphs.
+
+    Parameters
+    ----------
+    n_docs : int
+        Number of documents
+    doc_length : int
+        Number of words per document
+    vocab_size : int
+        Number of distinct pseudo-words
+    seed : int
+        Random seed
+
+    Returns
+    -------
+    corpus : list
+        The documents, in string format
+    """
+
+    rng = random.Random(seed)
+    vocab = []
+    seen = set()
+    while len(vocab) < vocab_size:
+        word = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            vocab.append(word)
+    weights = [1 / (rank + 1) for rank in range(vocab_size)]
+
+    corpus = []
+    for _ in range(n_docs):
+        words = rng.choices(vocab, weights, k=doc_length)
+        parts = []
+        for i, word in enumerate(words):
+            r = rng.random()
+            if r < 0.3:
+                parts.append(rng.choice(FILLERS))
+            elif r < 0.33:
+                parts.append(rng.choice(NAMES))
+            elif r < 0.34:
+                parts.append(str(rng.randint(1, 1000)))
+            parts.append(word)
+            if i % 15 == 14:
+                parts[-1] += "."
+            if i % 150 == 149:
+                parts[-1] += "\n\n"
+        corpus.append(" ".join(parts))
+
+    return corpus
+
+
+def n_words(corpus):
+    """ Number of whitespace separated words in a corpus, the unit of the analyzer throughput """
+    return sum(len(text.split()) for text in corpus)
+
+
+def load_results(name):
+    """ Loads one of the shipped (X, feature_names) pickles, with placeholder titles """
+
+    with open(DATA_FILES[name], "rb") as f:
+        X, feature_names = pickle.load(f)
+    titles = pd.Series([f"book {i}" for i in range(X.shape[0])])
+
+    return X, feature_names, titles
+
+
+def _model_loads():
+    try:
+        tfidf.get_nlp()
+        return True
+    except OSError:
+        return False
+
+
+def model_available():
+    """ Whether the spacy model can be loaded, without network access. Checked in a child process, so the benchmark process itself never holds the model. """
+
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(_model_loads)
+
+
+def synthetic_results(n_docs):
+    """ tf-idf matrix of a synthetic corpus of n_docs documents, with placeholder titles """
+
+    corpus = [text.lower().split() for text in synthetic_corpus(n_docs, 2000)]
+    X, feature_names = tfidf.tf_idf(corpus, 0.8, analyzer=tfidf.pretokenized)
+    return X, feature_names, pd.Series([f"book {i}" for i in range(n_docs)])
+
+
+# Setups of the benchmark cases. Each returns (function to time, number of units, unit name), and is passed to a spawned child process, so it has to be a module level function (bound with functools.partial)
+
+def analyzer_setup(analyzer, n_docs, length):
+    corpus = synthetic_corpus(n_docs, length)
+    return (lambda: [analyzer(text) for text in corpus]), n_words(corpus), "words"
+
+
+def tf_idf_setup(n_docs, length):
+    corpus = synthetic_corpus(n_docs, length)
+    return (lambda: tfidf.tf_idf(corpus, 0.8)), n_words(corpus), "words"
+
+
+def vectorizer_setup(n_docs, length):
+    corpus = [text.lower().split() for text in synthetic_corpus(n_docs, length)]
+    return (lambda: tfidf.tf_idf(corpus, 0.8, analyzer=tfidf.pretokenized)), sum(map(len, corpus)), "words"
+
+
+def max_row_setup(load):
+    X, feature_names, _ = load()
+    df = pd.DataFrame(X.toarray(), columns=feature_names)
+    return (lambda: tfidf.max_row(df, 15, index=True)), X.shape[0], "books"
+
+
+def keyword_setup(load, n_queries):
+    X, feature_names, titles = load()
+    rng = random.Random(0)
+    queries = rng.choices(list(feature_names), k=n_queries)
+    return (lambda: [search_engine.keyword_search1(X, feature_names, q, titles, 10) for q in queries]), n_queries, "queries"
+
+
+def similar_setup(load, n_queries):
+    X, _, titles = load()
+    rng = random.Random(0)
+    collections = [rng.sample(list(titles), 3) for _ in range(n_queries // 10)]
+    return (lambda: [search_engine.similar_books(c, titles, X, 10) for c in collections]), len(collections), "queries"
+
+
+def analysis_cases(sizes, lengths):
+    """
+    Benchmark cases of the spacy analyzers and tf_idf. Every case is (name, setup), where setup() returns (function to time, number of units, unit name).
+    """
+
+    cases = []
+    for n_docs in sizes:
+        for length in lengths:
+            suffix = f"docs={n_docs}/words={length}"
+            cases.append((f"lemmatize/{suffix}", functools.partial(analyzer_setup, tfidf.lemmatize, n_docs, length)))
+            cases.append((f"lemmatize_no_names/{suffix}", functools.partial(analyzer_setup, tfidf.lemmatize_no_names, n_docs, length)))
+            cases.append((f"lemmatize_fast_no_names/{suffix}", functools.partial(analyzer_setup, tfidf.lemmatize_fast_no_names, n_docs, length)))
+            cases.append((f"tf_idf/{suffix}", functools.partial(tf_idf_setup, n_docs, length)))
+            cases.append((f"tf_idf_pretokenized/{suffix}", functools.partial(vectorizer_setup, n_docs, length)))
+
+    return cases
+
+
+def search_cases(sizes, n_queries = 200):
+    """
+    Benchmark cases of max_row, keyword_search1 and similar_books, on the shipped data/ pickles and on synthetic matrices of the given corpus sizes.
+    """
+
+    sources = [(name, functools.partial(load_results, name)) for name in DATA_FILES]
+    sources += [(f"synthetic/docs={n}", functools.partial(synthetic_results, n)) for n in sizes]
+
+    cases = []
+    for source, load in sources:
+        cases.append((f"max_row/{source}", functools.partial(max_row_setup, load)))
+        cases.append((f"keyword_search1/{source}", functools.partial(keyword_setup, load, n_queries)))
+        cases.append((f"similar_books/{source}", functools.partial(similar_setup, load, n_queries)))
+
+    return cases
+
+
+def peak_rss_mb():
+    """
+    Peak RSS of this process in MB. On Linux this is VmHWM of /proc/self/status, which starts over at exec. ru_maxrss is only the fallback: it also counts the memory of the parent that forked this process before exec.
+    """
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(setup, repeat, queue):
+    """ Runs one case in the current (child) process and puts its result on the queue """
+
+    try:
+        # Before the setup, the peak is the footprint of the interpreter and the imported libraries
+        start_rss = peak_rss_mb()
+        func, units, unit = setup()
+        func()  # Warm up, e.g. loading the spacy model
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+
+        best = min(times)
+        peak_rss = peak_rss_mb()
+        queue.put({
+            "seconds": best,
+            "throughput": units / best if best > 0 else float("inf"),
+            "unit": f"{unit}/s",
+            "peak_rss_mb": peak_rss,
+            "case_rss_mb": peak_rss - start_rss,
+        })
+    except Exception as e:
+        queue.put({"error": f"{type(e).__name__}: {e}"})
+
+
+def run_isolated(setup, repeat):
+    """
+    Runs a case in a freshly spawned child process, so every case gets its own peak RSS (see peak_rss_mb()): a forked child would start with the peak RSS of this process.
+    """
+
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_case, args=(setup, repeat, queue))
+    process.start()
+
+    # A child that dies without an answer (e.g. killed for running out of memory) is reported as an error instead of blocking
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except queue_module.Empty:
+            if not process.is_alive():
+                result = {"error": f"The case process exited with code {process.exitcode}"}
+                break
+    process.join()
+
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares results to a baseline. A case regresses if it is more than tolerance (relative) slower.
+
+    Returns
+    -------
+    regressions : list
+        (name, baseline seconds, seconds) of every regressed case
+    """
+
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get("results", {}).get(name)
+        if base is None or "seconds" not in base or "seconds" not in result:
+            continue
+        if result["seconds"] > base["seconds"] * (1 + tolerance):
+            regressions.append((name, base["seconds"], result["seconds"]))
+
+    return regressions
+
+
+def environment():
+    """ Library versions the results were measured with """
+    return {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "sklearn": sklearn.__version__,
+        "spacy": spacy.__version__,
+        "pandas": pd.__version__,
+    }
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the analysis pipeline")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100], help="Synthetic corpus sizes (documents)")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[200, 5000], help="Synthetic document lengths (words)")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per case, the fastest counts")
+    parser.add_argument("--only", default=None, help="Only run cases whose name contains this string")
+    parser.add_argument("--output", default=None, help="Write results to this JSON file")
+    parser.add_argument("--baseline", default=None, help="Compare against this baseline JSON file")
+    parser.add_argument("--save-baseline", default=None, help="Write results as a new baseline JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown before a case counts as a regression")
+    args = parser.parse_args(argv)
+
+    cases = search_cases(args.sizes)
+    if model_available():
+        cases = analysis_cases(args.sizes, args.lengths) + cases
+    else:
+        print(f"spacy model {tfidf.MODEL_NAME} is not installed, skipping the analyzer cases")
+    if args.only:
+        cases = [(name, setup) for name, setup in cases if args.only in name]
+
+    results = {}
+    for name, setup in cases:
+        result = run_isolated(setup, args.repeat)
+        results[name] = result
+        if "error" in result:
+            print(f"{name:55s} ERROR {result['error']}")
+        else:
+            print(f"{name:55s} {result['seconds']:10.4f} s {result['throughput']:14.1f} {result['unit']:10s} {result['peak_rss_mb']:8.1f} MB (+{result['case_rss_mb']:.1f})")
+
+    report = {"environment": environment(), "results": results}
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, before, after in regressions:
+            print(f"REGRESSION {name}: {before:.4f} s -> {after:.4f} s ({after / before - 1:+.0%})")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.baseline}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
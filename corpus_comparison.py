@@ -0,0 +1,202 @@
+"""
+Compares the keywords of the summary model to those of the full text model, for every book present in both, in a handful of vectorized sparse operations instead of a loop over books.
+
+Both models are joined on their titles and mapped onto one shared term index, so a column means the same word in both matrices. Per book, the table holds:
+    cosine          cosine similarity of the two tf-idf rows over the shared terms
+    overlap         number of keywords in both top-n lists
+    jaccard         overlap / size of the union of the two top-n lists
+    spearman        rank correlation of the two tf-idf scores over the union of the top-n keywords (terms missing from a row score 0)
+    n_summary, n_full_text
+                    number of non-zero terms of each row
+
+Usage:
+    python corpus_comparison.py --summary data/summary_results_1.pkl:description --full-text data/full_text_results_1.pkl:full_text --output comparison.csv
+
+A model is a tfidf_store directory or a <pickle>:<books.db column> spec, see tfidf_store.load_model().
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import instrumentation
+import tfidf
+import tfidf_store
+
+
+def align_titles(titles_a, titles_b):
+    """
+    Hash join of two title lists. Duplicate titles use their first row, like tfidf.title_rows().
+
+    Returns
+    -------
+    titles : list
+        The titles present in both, in the order of titles_a
+    rows_a, rows_b : np.ndarray
+        Row of every joined title in each model
+    only_a, only_b : list
+        The titles present in only one of them
+    """
+
+    rows_a, rows_b = tfidf.title_rows(titles_a), tfidf.title_rows(titles_b)
+    titles = [title for title in rows_a if title in rows_b]
+    only_a = [title for title in rows_a if title not in rows_b]
+    only_b = [title for title in rows_b if title not in rows_a]
+
+    return (titles, np.array([rows_a[t] for t in titles], dtype=np.int64), np.array([rows_b[t] for t in titles], dtype=np.int64),
+            only_a, only_b)
+
+
+def shared_vocabulary(feature_names_a, feature_names_b):
+    """
+    The sorted union of two vocabularies, and the column of every feature of each in it.
+
+    Returns
+    -------
+    vocabulary : np.ndarray
+    columns_a, columns_b : np.ndarray
+        columns_a[i] is the shared column of feature_names_a[i]
+    """
+
+    feature_names_a, feature_names_b = np.asarray(feature_names_a, dtype=object), np.asarray(feature_names_b, dtype=object)
+    vocabulary = np.unique(np.concatenate([feature_names_a, feature_names_b]))
+
+    return vocabulary, np.searchsorted(vocabulary, feature_names_a), np.searchsorted(vocabulary, feature_names_b)
+
+
+def remap_columns(X, columns, n_columns):
+    """ X with column j moved to columns[j], in a matrix of n_columns columns """
+
+    X = sparse.csr_matrix(X)
+    remapped = sparse.csr_matrix((X.data, columns[X.indices], X.indptr), shape=(X.shape[0], n_columns))
+    remapped.sort_indices()
+    return remapped
+
+
+def top_n_indicator(X, n):
+    """ Sparse 0/1 matrix of the top-n columns of every row of X, see tfidf.top_n_columns() """
+
+    cols, _ = tfidf.top_n_columns(X, n)
+    rows = np.repeat(np.arange(X.shape[0]), n).reshape(cols.shape)
+    keep = cols >= 0
+
+    return sparse.csr_matrix((np.ones(keep.sum()), (rows[keep], cols[keep])), shape=X.shape)
+
+
+def rowwise_cosine(A, B):
+    """ Cosine similarity of every row of A with the same row of B. Rows without any term get 0. """
+
+    dots = np.asarray(A.multiply(B).sum(axis=1)).ravel()
+    norms = np.sqrt(np.asarray(A.multiply(A).sum(axis=1)).ravel() * np.asarray(B.multiply(B).sum(axis=1)).ravel())
+
+    return np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+
+
+def rowwise_spearman(A, B, union):
+    """
+    Spearman rank correlation of every row of A with the same row of B, over the columns marked in the sparse indicator matrix union. NaN where a row has fewer than two such columns or constant scores.
+    """
+
+    union = union.tocoo()
+    # Indexing with empty row and column arrays gives a (1, 0) matrix, so there is nothing to rank
+    if union.nnz == 0:
+        return np.full(A.shape[0], np.nan)
+    A, B = sparse.csr_matrix(A), sparse.csr_matrix(B)
+    pairs = pd.DataFrame({
+        "row": union.row,
+        "a": np.asarray(A[union.row, union.col]).ravel(),
+        "b": np.asarray(B[union.row, union.col]).ravel(),
+    })
+
+    # Pearson correlation of the ranks, computed with grouped sums instead of one corrcoef per book
+    grouped = pairs.groupby("row")
+    ra = grouped["a"].rank()
+    rb = grouped["b"].rank()
+    pairs["da"] = ra - ra.groupby(pairs["row"]).transform("mean")
+    pairs["db"] = rb - rb.groupby(pairs["row"]).transform("mean")
+    pairs["dab"] = pairs["da"] * pairs["db"]
+    pairs["daa"] = pairs["da"] ** 2
+    pairs["dbb"] = pairs["db"] ** 2
+    sums = pairs.groupby("row")[["dab", "daa", "dbb"]].sum()
+
+    denominator = np.sqrt(sums["daa"] * sums["dbb"])
+    rho = (sums["dab"] / denominator.where(denominator > 0)).reindex(range(A.shape[0]))
+
+    return rho.to_numpy(dtype=float)
+
+
+@instrumentation.instrumented("corpus_comparison.compare_models", units="titles_a")
+def compare_models(X_a, feature_names_a, titles_a, X_b, feature_names_b, titles_b, n = 15):
+    """
+    Per book comparison of two tf-idf models of the same books, e.g. summaries (a) and full texts (b).
+
+    Parameters
+    ----------
+    X_a, X_b : scipy.sparse matrix
+        TF-IDF matrices, one row per book
+    feature_names_a, feature_names_b : iterable
+        Vocabularies of the matrices
+    titles_a, titles_b : iterable
+        Title of every row of the matrices
+    n : int
+        Number of keywords per book compared in the top-n metrics
+
+    Returns
+    -------
+    table : pd.DataFrame
+        One row per title present in both models, with the columns described in the module docstring
+    only_a, only_b : list
+        The titles present in only one of the models
+    """
+
+    titles, rows_a, rows_b, only_a, only_b = align_titles(titles_a, titles_b)
+    vocabulary, columns_a, columns_b = shared_vocabulary(feature_names_a, feature_names_b)
+
+    A = remap_columns(sparse.csr_matrix(X_a)[rows_a], columns_a, vocabulary.size)
+    B = remap_columns(sparse.csr_matrix(X_b)[rows_b], columns_b, vocabulary.size)
+
+    top_a = top_n_indicator(A, n)
+    top_b = top_n_indicator(B, n)
+    overlap = np.asarray(top_a.multiply(top_b).sum(axis=1)).ravel()
+    size_a = np.diff(top_a.indptr)
+    size_b = np.diff(top_b.indptr)
+    union_size = size_a + size_b - overlap
+
+    table = pd.DataFrame({
+        "title": titles,
+        "cosine": rowwise_cosine(A, B),
+        "overlap": overlap.astype(np.int64),
+        "jaccard": np.divide(overlap, union_size, out=np.ones(len(titles)), where=union_size > 0),
+        "spearman": rowwise_spearman(A, B, ((top_a + top_b) > 0).astype(np.float64)),
+        "n_summary": np.diff(A.indptr),
+        "n_full_text": np.diff(B.indptr),
+    })
+
+    return table, only_a, only_b
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Per book comparison of the summary and full text keywords")
+    parser.add_argument("--summary", required=True, help="Summary model, a tfidf_store directory or <pickle>:<books.db column>")
+    parser.add_argument("--full-text", required=True, help="Full text model, a tfidf_store directory or <pickle>:<books.db column>")
+    parser.add_argument("--db", default="books.db", help="books.db, for the titles of pickled models")
+    parser.add_argument("--n", type=int, default=15, help="Number of keywords compared per book")
+    parser.add_argument("--output", default=None, help="Write the table to this CSV file")
+    args = parser.parse_args(argv)
+
+    X_a, feature_names_a, titles_a = tfidf_store.load_model(args.summary, args.db)
+    X_b, feature_names_b, titles_b = tfidf_store.load_model(args.full_text, args.db)
+    table, only_a, only_b = compare_models(X_a, feature_names_a, titles_a, X_b, feature_names_b, titles_b, args.n)
+
+    print(f"{len(table)} books in both, {len(only_a)} only in the summaries, {len(only_b)} only in the full texts")
+    if len(table):
+        print(table[["cosine", "overlap", "jaccard", "spearman"]].describe().loc[["mean", "50%", "min", "max"]].to_string())
+
+    if args.output:
+        table.to_csv(args.output, index=False)
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,26 +1,376 @@
-from requests import get, RequestException
-from contextlib import closing
+from requests import RequestException, Request, Response, Session
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+import random
+import threading
 import time
+from http_cache import HttpCache
+import instrumentation
 
-def simple_get(url, max_retries=3):
+
+# Per-host limits: maximum number of requests per second (token bucket, allowing bursts of `burst` requests)
+# and maximum number of simultaneous requests. Hosts not listed here use DEFAULT_HOST_LIMIT.
+HOST_LIMITS = {
+    "www.goodreads.com": {"rate": 2, "burst": 2, "max_concurrency": 2},
+    "gutendex.com": {"rate": 4, "burst": 4, "max_concurrency": 4},
+    "www.gutenberg.org": {"rate": 4, "burst": 4, "max_concurrency": 4},
+}
+DEFAULT_HOST_LIMIT = {"rate": 5, "burst": 5, "max_concurrency": 4}
+
+# HTTP status codes worth retrying
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. acquire() blocks until a token is available. Tokens refill at `rate` per second, up to `burst`.
+    """
+
+    def __init__(self, rate, burst = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostLimiter:
+    """
+    Context manager holding one of the concurrent request slots of a host, after taking a token from its rate limiter.
+    """
+
+    def __init__(self, rate, burst, max_concurrency):
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+
+    def acquire(self):
+        self.slots.acquire()
+        if self.bucket is not None:
+            self.bucket.acquire()
+
+    def release(self):
+        self.slots.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+def release_on_close(resp, limiter):
+    """ Makes a streamed response hold its host slot until it is closed, since its body is only read after Session.get() returns """
+
+    close = resp.close
+    released = threading.Event()
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            if not released.is_set():
+                released.set()
+                limiter.release()
+
+    resp.close = close_and_release
+    return resp
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def host_limiter(url):
+    """ The shared HostLimiter of the host of a url, created on first use from HOST_LIMITS """
+
+    host = urlsplit(url).netloc.lower()
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = HostLimiter(**HOST_LIMITS.get(host, DEFAULT_HOST_LIMIT))
+        return _limiters[host]
+
+
+# Response headers kept in the HTTP cache, needed for revalidation and by is_good_response()
+CACHED_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+# Default on-disk HTTP cache, see configure_cache()
+HTTP_CACHE_DIR = "http_cache"
+HTTP_CACHE_TTL = 7 * 24 * 3600
+HTTP_CACHE_MAX_BYTES = 1_000_000_000
+
+_session = None
+_cache = None
+_cache_configured = False
+_setup_lock = threading.Lock()
+
+# Number of active revalidating() blocks
+_revalidate = 0
+
+
+def get_session():
+    """ The shared requests Session, pooling keep-alive connections across all requests and threads """
+
+    global _session
+    with _setup_lock:
+        if _session is None:
+            _session = Session()
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def configure_cache(cache_dir = HTTP_CACHE_DIR, ttl = HTTP_CACHE_TTL, max_bytes = HTTP_CACHE_MAX_BYTES):
+    """
+    Sets up the on-disk HTTP cache used by http_get(). Without a call, the defaults above are used on first request.
+
+    Parameters
+    ----------
+    cache_dir : string or None
+        Directory of the cache. None disables caching.
+    ttl : float
+        Number of seconds a cached response is used without revalidating it
+    max_bytes : int
+        Maximum total size of the compressed cached bodies
+    """
+
+    global _cache, _cache_configured
+    with _setup_lock:
+        _cache = HttpCache(cache_dir, ttl, max_bytes) if cache_dir is not None else None
+        _cache_configured = True
+
+
+def get_cache():
+    """ The configured HttpCache, or None if caching is disabled """
+
+    if not _cache_configured:
+        configure_cache()
+    return _cache
+
+
+@contextmanager
+def revalidating():
+    """
+    Within the block, fresh cache entries are revalidated like stale ones, in all threads: every cached url gets a conditional request, and a changed page is downloaded again.
+    Used when a page is refetched on purpose to detect changes, see ingestion.ingest().
+    """
+
+    global _revalidate
+    with _setup_lock:
+        _revalidate += 1
+    try:
+        yield
+    finally:
+        with _setup_lock:
+            _revalidate -= 1
+
+
+def cached_response(url, entry):
+    """ Builds a requests Response from a cache entry, so callers cannot tell it apart from a network response """
+
+    resp = Response()
+    resp.status_code = 200
+    resp.url = url
+    resp.headers = CaseInsensitiveDict(entry["headers"])
+    resp._content = entry["body"]
+    resp.encoding = get_encoding_from_headers(resp.headers)
+    return resp
+
+
+def http_get(url, params = None, headers = None, use_cache = True, **kwargs):
+    """
+    GET request through the shared session and the on-disk cache. Fresh cache entries are returned directly (except within revalidating()); stale ones are revalidated with If-None-Match / If-Modified-Since, and a 304 reply serves the cached body.
+    Only network requests count against the host's rate and concurrency limits.
+
+    Parameters
+    ----------
+    url : string
+        The url to request
+    params : dict or None
+        Query parameters
+    headers : dict or None
+        Request headers
+    use_cache : bool
+        If False, always go to the network and do not store the response
+    **kwargs
+        Passed on to Session.get(). With stream=True and no cache, the response keeps its host slot until it is closed, so close it (e.g. with contextlib.closing) once the body is read.
+
+    Returns
+    -------
+    resp : requests.Response
+    """
+
+    session = get_session()
+    cache = get_cache() if use_cache else None
+    if cache is None:
+        limiter = host_limiter(url)
+        limiter.acquire()
+        try:
+            with instrumentation.stage("http.request", document=url):
+                resp = session.get(url, params=params, headers=headers, **kwargs)
+        except BaseException:
+            limiter.release()
+            raise
+        if kwargs.get("stream"):
+            return release_on_close(resp, limiter)
+        limiter.release()
+        return resp
+
+    # The cache is keyed by the full url, including the query string
+    url = Request("GET", url, params=params).prepare().url
+    entry = cache.get(url)
+    if entry is not None and entry["fresh"] and not _revalidate:
+        instrumentation.count("http.cache_hit")
+        return cached_response(url, entry)
+
+    headers = dict(headers or {})
+    if entry is not None:
+        cached_headers = CaseInsensitiveDict(entry["headers"])
+        if "ETag" in cached_headers:
+            headers["If-None-Match"] = cached_headers["ETag"]
+        if "Last-Modified" in cached_headers:
+            headers["If-Modified-Since"] = cached_headers["Last-Modified"]
+
+    # The body is always read in full to store it, so streaming is not used
+    kwargs.pop("stream", None)
+    with host_limiter(url), instrumentation.stage("http.request", document=url):
+        resp = session.get(url, headers=headers, **kwargs)
+
+    if resp.status_code == 304 and entry is not None:
+        instrumentation.count("http.cache_revalidated")
+        cache.touch(url)
+        return cached_response(url, entry)
+    if resp.status_code == 200:
+        cache.put(url, {name: resp.headers[name] for name in CACHED_HEADERS if name in resp.headers}, resp.content)
+
+    return resp
+
+
+def backoff_delay(attempt, base = 1.0, cap = 30.0):
+    """ Exponential backoff with jitter: roughly base, 2*base, 4*base, ... seconds, at most cap """
+    return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def retry_after(resp):
+    """ The delay in seconds requested by a Retry-After header, if any """
+    try:
+        return float(resp.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def rate_limited_get(url, max_retries = 3, backoff = 1.0, **kwargs):
+    """
+    http_get() (shared session, cache and the limiter of the url's host), retrying failed connections and retryable HTTP statuses (429, 5xx) with exponential backoff.
+
+    Parameters
+    ----------
+    url : string
+        The url to request
+    max_retries : int
+        Maximum number of attempts
+    backoff : float
+        Base delay in seconds of the exponential backoff
+    **kwargs
+        Passed on to http_get()
+
+    Returns
+    -------
+    resp : requests.Response
+        The last response. Raises the last RequestException if no attempt got a response.
+    """
+
+    for attempt in range(max_retries):
+        last = attempt == max_retries - 1
+        try:
+            resp = http_get(url, **kwargs)
+        except RequestException:
+            if last:
+                raise
+            time.sleep(backoff_delay(attempt, backoff))
+            continue
+
+        if resp.status_code not in RETRY_STATUSES or last:
+            return resp
+        # Frees the host slot of a streamed response before waiting
+        resp.close()
+        time.sleep(retry_after(resp) or backoff_delay(attempt, backoff))
+
+
+def fetch_concurrently(func, args_list, max_workers = 8):
+    """
+    Runs a scraping function over many argument tuples in a thread pool. Rate and concurrency limits per host are enforced inside simple_get() and rate_limited_get().
+
+    Parameters
+    ----------
+    func : function
+        The function to call, e.g. get_goodreads_description
+    args_list : iterable
+        One tuple of positional arguments per call
+    max_workers : int
+        Number of threads
+
+    Yields
+    ------
+    (i, result) : tuple
+        The position of the arguments in args_list and the result of the call, as the calls finish. If a call raises, the error is printed and the result is None.
+    """
+
+    args_list = list(args_list)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(func, *args): i for i, args in enumerate(args_list)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                yield i, future.result()
+            except Exception as e:
+                print(f"The following error occurred for {args_list[i]}: {str(e)}")
+                yield i, None
+
+
+@instrumentation.instrumented("http.simple_get", document="url")
+def simple_get(url, max_retries=3, backoff=1.0):
     """
     Attempts to get the content at `url` by making an HTTP GET request.
     If the content-type of response is some kind of HTML/XML, return the
     text content, otherwise return None.
-    Retry up to `max_retries` times on HTTP errors with a 1-second delay.
+    Retry up to `max_retries` times on HTTP errors with exponential backoff
+    starting at `backoff` seconds. Requests go through the shared session,
+    the HTTP cache and the rate and concurrency limits of the host (see
+    http_get() and HOST_LIMITS).
     """
     try:
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.76 Safari/537.36'
         }
-        for _ in range(max_retries):
-            with closing(get(url, stream=True, headers=headers)) as resp:
+        for attempt in range(max_retries):
+            with closing(http_get(url, stream=True, headers=headers)) as resp:
                 if is_good_response(resp):
                     return resp.content
                 else:
+                    delay = retry_after(resp) or backoff_delay(attempt, backoff)
                     print(f"Recieved a HTTP {resp.status_code} ERROR for {url}.")
-                    print("Retrying in 1 second...")
-                    time.sleep(1)
+            if attempt < max_retries - 1:
+                print(f"Retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
         print("-------------------------------------")
         print(f"Retrieving {url} FAILED. Visit this URL in your browser to confirm correctness.")
         print("-------------------------------------")
@@ -0,0 +1,193 @@
+import os
+import shutil
+from itertools import islice
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+import tfidf
+from tfidf import batches
+import tfidf_store
+import instrumentation
+
+
+# Number of hash buckets. Collisions are rare as long as the vocabulary is well below this.
+N_FEATURES = 2 ** 22
+
+# Files of the raw term counts written by the first pass, removed once the model is complete
+COUNT_FILES = ("counts.data", "counts.indices")
+
+
+def update_reverse_map(reverse_map, tokens, buckets, weights):
+    """
+    Updates the token each hash bucket is labelled with, by a weighted majority vote (Boyer-Moore) per bucket: a bucket keeps the token that occurs in most documents, as long as it occurs in more than half the documents of the bucket.
+    Needs one (token, weight) pair per bucket instead of a full vocabulary.
+
+    Parameters
+    ----------
+    reverse_map : dict
+        Bucket -> [token, weight], updated in place
+    tokens, buckets, weights : iterable
+        Tokens, their hash buckets and their document frequencies in the current batch
+    """
+
+    for token, bucket, weight in zip(tokens, buckets, weights):
+        entry = reverse_map.get(bucket)
+        if entry is None:
+            reverse_map[bucket] = [token, weight]
+        elif entry[0] == token:
+            entry[1] += weight
+        elif weight > entry[1]:
+            entry[0], entry[1] = token, weight - entry[1]
+        else:
+            entry[1] -= weight
+
+
+def max_doc_count(max_df, n_docs):
+    """ The maximum document frequency of a kept token, interpreting max_df as TfidfVectorizer does """
+    return max_df if isinstance(max_df, (int, np.integer)) and not isinstance(max_df, bool) else max_df * n_docs
+
+
+@instrumentation.instrumented("tfidf.hashing_tf_idf")
+def hashing_tf_idf(corpus, path, max_df, analyzer = tfidf.lemmatize, titles = None, n_features = N_FEATURES, chunk_docs = 1000, reverse_map = True, **analyze_kwargs):
+    """
+    Out-of-core version of tfidf.tf_idf() for corpora that do not fit in memory. Tokens are mapped to columns by feature hashing instead of a vocabulary, and the corpus is consumed once, chunk_docs documents at a time.
+    Pass 1 counts the terms of every batch, accumulates the document frequencies and appends the raw counts to disk. Pass 2 reads the counts back, drops buckets above max_df, applies the smoothed IDF and l2 normalization of TfidfVectorizer and writes the result straight into a memory-mapped stored model (see tfidf_store).
+    Without hash collisions, the result equals tf_idf() with its columns in bucket instead of alphabetical order.
+
+    Parameters
+    ----------
+    corpus : iterable
+        The documents, in string format (or token lists, with analyzer=tfidf.pretokenized). May be a generator, e.g. storage.SqlCorpus.
+    path : string
+        Directory to write the model to. An existing directory at this path is replaced. Open it with tfidf_store.load_tfidf().
+    max_df : float or int
+        Maximum document frequency allowed for each token, as in tf_idf()
+    analyzer : function
+        Tokenization function, by default lemmatize
+    titles : iterable or None
+        The titles of the documents, consumed alongside the corpus
+    n_features : int
+        Number of hash buckets
+    chunk_docs : int
+        Number of documents held in memory at once
+    reverse_map : bool
+        If True, every column is labelled with the token hashed to it (the most frequent one, on collisions), so that tfidf.top_n() on the stored model gives readable keywords. Otherwise columns are named "#<bucket>".
+    **analyze_kwargs
+        Passed on to tfidf.analyze_corpus() for every chunk of documents, e.g. batch_size (documents spacy parses at once), n_process, cache_dir or chunk_size (characters per parsed piece of a document)
+
+    Returns
+    -------
+    shape : tuple
+        The shape (documents, columns) of the stored matrix
+    """
+
+    # The vectorizer only hashes and counts, the analyzers run through analyze_corpus() so that batching and the lemma cache apply
+    vectorizer = HashingVectorizer(analyzer=tfidf.pretokenized, n_features=n_features, alternate_sign=False, norm=None)
+
+    tmp_path = f"{path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    data_path, indices_path = (os.path.join(tmp_path, name) for name in COUNT_FILES)
+
+    df = np.zeros(n_features, dtype=np.int64)
+    row_nnz = []
+    all_titles = [] if titles is not None else None
+    title_iter = iter(titles) if titles is not None else None
+    majority = {}
+
+    # Pass 1: term counts and document frequencies
+    with instrumentation.stage("tfidf.hashing_count"), open(data_path, "wb") as data_file, open(indices_path, "wb") as indices_file:
+        for batch in batches(corpus, chunk_docs):
+            corpus_lemmas = batch if analyzer is tfidf.pretokenized else tfidf.analyze_corpus(batch, analyzer, **analyze_kwargs)
+            counts = vectorizer.transform(corpus_lemmas).tocsr()
+            counts.sum_duplicates()
+
+            counts.data.astype(np.int32).tofile(data_file)
+            counts.indices.astype(np.int32).tofile(indices_file)
+            row_nnz.extend(np.diff(counts.indptr).tolist())
+            df += np.bincount(counts.indices, minlength=n_features)
+
+            if title_iter is not None:
+                all_titles.extend(str(title) for title in islice(title_iter, len(batch)))
+
+            if reverse_map:
+                # Document frequencies of the tokens of this batch, and their buckets. No vocabulary is kept across batches.
+                batch_df = {}
+                for lemmas in corpus_lemmas:
+                    for token in set(lemmas):
+                        batch_df[token] = batch_df.get(token, 0) + 1
+                if batch_df:
+                    token_buckets = vectorizer.transform([[token] for token in batch_df]).indices
+                    update_reverse_map(majority, batch_df, token_buckets.tolist(), batch_df.values())
+
+    n_docs = len(row_nnz)
+    if all_titles is not None and len(all_titles) != n_docs:
+        raise ValueError(f"Got {len(all_titles)} titles for {n_docs} documents")
+
+    # Keep the buckets occurring in at least one and at most max_df documents, and number them as columns
+    keep = (df > 0) & (df <= max_doc_count(max_df, n_docs))
+    buckets = np.flatnonzero(keep)
+    idf = np.log((1 + n_docs) / (1 + df[buckets])) + 1
+    nnz = int(df[buckets].sum())
+
+    # Pass 2: apply IDF and normalization, writing the CSR arrays directly into their .npy files
+    with instrumentation.stage("tfidf.hashing_weight"):
+        data_out = np.lib.format.open_memmap(os.path.join(tmp_path, "csr.data.npy"), mode="w+", dtype=np.float64, shape=(nnz,))
+        indices_out = np.lib.format.open_memmap(os.path.join(tmp_path, "csr.indices.npy"), mode="w+", dtype=np.int32, shape=(nnz,))
+        indptr_out = np.lib.format.open_memmap(os.path.join(tmp_path, "csr.indptr.npy"), mode="w+", dtype=np.int64, shape=(n_docs + 1,))
+        indptr_out[0] = 0
+
+        counts_data = np.memmap(data_path, dtype=np.int32, mode="r") if os.path.getsize(data_path) else np.zeros(0, dtype=np.int32)
+        counts_indices = np.memmap(indices_path, dtype=np.int32, mode="r") if os.path.getsize(indices_path) else np.zeros(0, dtype=np.int32)
+        row_starts = np.zeros(n_docs + 1, dtype=np.int64)
+        row_starts[1:] = np.cumsum(row_nnz)
+
+        written = 0
+        for first in range(0, n_docs, chunk_docs):
+            last = min(first + chunk_docs, n_docs)
+            start, end = row_starts[first], row_starts[last]
+            counts = sparse.csr_matrix((np.asarray(counts_data[start:end], dtype=np.float64), np.asarray(counts_indices[start:end]), row_starts[first:last + 1] - start),
+                                       shape=(last - first, n_features))
+
+            # Dropping pruned buckets keeps the order of the others, as columns increase with buckets
+            weighted = counts[:, buckets].tocsr()
+            weighted.sort_indices()
+            weighted.data *= idf[weighted.indices]
+            weighted = normalize(weighted, copy=False)
+
+            data_out[written:written + weighted.nnz] = weighted.data
+            indices_out[written:written + weighted.nnz] = weighted.indices
+            indptr_out[first + 1:last + 1] = written + weighted.indptr[1:]
+            written += weighted.nnz
+
+        for array in (data_out, indices_out, indptr_out):
+            array.flush()
+        del data_out, indices_out, indptr_out, counts_data, counts_indices
+
+    for name in COUNT_FILES:
+        os.remove(os.path.join(tmp_path, name))
+
+    # Column labels, and what is needed to hash further documents into the same columns
+    if reverse_map:
+        feature_names = [majority[bucket][0] if bucket in majority else f"#{bucket}" for bucket in buckets.tolist()]
+    else:
+        feature_names = [f"#{bucket}" for bucket in buckets.tolist()]
+    tfidf_store.save_strings(tmp_path, "feature_names", feature_names)
+    if all_titles is not None:
+        tfidf_store.save_strings(tmp_path, "titles", all_titles)
+    np.save(os.path.join(tmp_path, "hashing.buckets.npy"), buckets)
+    np.save(os.path.join(tmp_path, "hashing.idf.npy"), idf)
+
+    params = {
+        "hashing": True,
+        "n_features": n_features,
+        "max_df": max_df,
+        "analyzer": getattr(analyzer, "__name__", repr(analyzer)),
+    }
+    tfidf_store.write_meta(tmp_path, (n_docs, buckets.size), nnz, ("csr",), all_titles is not None, params)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+    return n_docs, buckets.size
@@ -0,0 +1,111 @@
+import sqlite3
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+
+
+CACHE_FILE = "http_cache.db"
+
+
+class HttpCache:
+    """
+    On-disk cache of HTTP response bodies, stored zlib-compressed in a sqlite file together with their validators (ETag, Last-Modified).
+    Entries younger than ttl are served without a request; older ones are revalidated with a conditional request. When the compressed bodies exceed max_bytes, the least recently used entries are evicted.
+
+    Parameters
+    ----------
+    cache_dir : string
+        Directory in which the cache database is stored
+    ttl : float
+        Number of seconds an entry is used without revalidation
+    max_bytes : int
+        Maximum total size of the compressed bodies
+    """
+
+    def __init__(self, cache_dir, ttl = 7 * 24 * 3600, max_bytes = 1_000_000_000):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(cache_dir, CACHE_FILE), check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                key TEXT PRIMARY KEY,
+                                url TEXT NOT NULL,
+                                headers TEXT NOT NULL,
+                                body BLOB NOT NULL,
+                                size INTEGER NOT NULL,
+                                fetched_at REAL NOT NULL,
+                                accessed_at REAL NOT NULL);""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at);")
+
+
+    @staticmethod
+    def key(url):
+        """ Cache key of a full url (including its query string) """
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+    def get(self, url):
+        """
+        Looks up a cached response.
+
+        Returns
+        -------
+        entry : dict or None
+            {"url", "headers", "body", "fresh"}, where fresh tells whether the entry is younger than ttl. None if the url is not cached.
+        """
+
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT url, headers, body, fetched_at FROM responses WHERE key = ?;", (self.key(url),)).fetchone()
+            if row is None:
+                return None
+            with self.conn:
+                self.conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?;", (now, self.key(url)))
+
+        url, headers, body, fetched_at = row
+        return {
+            "url": url,
+            "headers": json.loads(headers),
+            "body": zlib.decompress(body),
+            "fresh": now - fetched_at < self.ttl,
+        }
+
+
+    def put(self, url, headers, body):
+        """ Stores (or replaces) the response to a url, then evicts old entries if the cache is too large """
+
+        compressed = zlib.compress(body)
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, url, headers, body, size, fetched_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?);",
+                              (self.key(url), url, json.dumps(dict(headers)), compressed, len(compressed), now, now))
+            self._evict()
+
+
+    def touch(self, url):
+        """ Marks an entry as freshly validated, after a 304 Not Modified """
+
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE responses SET fetched_at = ?, accessed_at = ? WHERE key = ?;", (now, now, self.key(url)))
+
+
+    def _evict(self):
+        """ Deletes the least recently used entries until the bodies fit in max_bytes. Called with the lock held. """
+
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses;").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        stale = []
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed_at;"):
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?;", stale)
@@ -0,0 +1,184 @@
+import numbers
+import pickle
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+import tfidf
+
+
+class IncrementalTfidf:
+    """
+    TF-IDF model that keeps the raw term counts and document frequencies of every document, so that books can be added or removed without re-tokenizing the rest of the corpus.
+    matrix() gives the same result as tfidf.tf_idf() on the current documents, in insertion order (up to floating point rounding).
+
+    Parameters
+    ----------
+    max_df : float or int
+        Maximum document frequency allowed for each token, as in tfidf.tf_idf()
+    analyzer : function
+        Tokenization function of the module tfidf, by default tfidf.lemmatize
+    """
+
+    def __init__(self, max_df, analyzer = tfidf.lemmatize):
+        self.max_df = max_df
+        self.analyzer = analyzer
+
+        # Vocabulary of every token seen so far, and the number of current documents containing it
+        self.terms = []
+        self.vocabulary = {}
+        self.df = np.zeros(0, dtype=np.int64)
+
+        # Document id -> (column indices, counts) of its tokens
+        self.rows = {}
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def add_documents(self, ids, corpus, pretokenized = False, **analyze_kwargs):
+        """
+        Adds documents to the model. A document with an id already in the model replaces it, keeping its position.
+
+        Parameters
+        ----------
+        ids : iterable
+            Unique identifiers of the documents, e.g. titles
+        corpus : iterable
+            The documents, in string format
+        pretokenized : bool
+            If True, corpus already contains lists of tokens and is not analyzed again
+        **analyze_kwargs
+            Passed on to tfidf.analyze_corpus(), e.g. batch_size, n_process, cache_dir or chunk_size
+        """
+
+        ids = list(ids)
+        corpus_lemmas = list(corpus) if pretokenized else tfidf.analyze_corpus(corpus, self.analyzer, **analyze_kwargs)
+        if len(ids) != len(corpus_lemmas):
+            raise ValueError(f"Got {len(ids)} ids for {len(corpus_lemmas)} documents")
+
+        for doc_id, lemmas in zip(ids, corpus_lemmas):
+            if doc_id in self.rows:
+                self._discount(doc_id)
+
+            # Map tokens to columns, growing the vocabulary with unseen tokens
+            cols = np.empty(len(lemmas), dtype=np.int64)
+            for i, lemma in enumerate(lemmas):
+                col = self.vocabulary.get(lemma)
+                if col is None:
+                    col = self.vocabulary[lemma] = len(self.terms)
+                    self.terms.append(lemma)
+                cols[i] = col
+            if len(self.terms) > self.df.size:
+                self.df = np.concatenate([self.df, np.zeros(len(self.terms) - self.df.size, dtype=np.int64)])
+
+            cols, counts = np.unique(cols, return_counts=True)
+            self.df[cols] += 1
+            self.rows[doc_id] = (cols, counts)
+
+
+    def remove_documents(self, ids):
+        """
+        Removes documents from the model.
+
+        Parameters
+        ----------
+        ids : iterable
+            Identifiers of the documents to remove. Raises KeyError for unknown ids.
+        """
+
+        for doc_id in ids:
+            self._discount(doc_id)
+            del self.rows[doc_id]
+
+
+    def _discount(self, doc_id):
+        """ Removes the document frequencies of a document """
+        cols, _ = self.rows[doc_id]
+        self.df[cols] -= 1
+
+
+    def matrix(self):
+        """
+        Computes the tf-idf matrix of the current documents from the stored counts, applying max_df pruning and smoothed idf weights like TfidfVectorizer.
+
+        Returns
+        -------
+        X : sparse.csr_matrix
+            The tf-idf matrix (documents, tokens)
+        feature_names : np.ndarray
+            The tokens of the columns of X, sorted alphabetically
+        ids : list
+            The document ids of the rows of X
+        """
+
+        n_docs = len(self.rows)
+        max_doc_count = self.max_df if isinstance(self.max_df, numbers.Integral) else self.max_df * n_docs
+
+        # Keep tokens that occur in at least one document and in no more than max_df of them
+        kept = np.flatnonzero((self.df >= 1) & (self.df <= max_doc_count))
+        if kept.size == 0:
+            raise ValueError("After pruning, no terms remain. Try a lower min_df or a higher max_df.")
+        feature_names = np.array([self.terms[col] for col in kept], dtype=object)
+        order = np.argsort(feature_names, kind="stable")
+        feature_names = feature_names[order]
+        kept = kept[order]
+
+        # Old column -> new column, -1 for pruned tokens
+        new_col = np.full(len(self.terms), -1, dtype=np.int64)
+        new_col[kept] = np.arange(kept.size)
+        idf = np.log((n_docs + 1) / (self.df[kept] + 1.0)) + 1.0
+
+        # Assemble the count matrix in the new column order
+        ids = list(self.rows)
+        indptr = [0]
+        indices = []
+        data = []
+        for doc_id in ids:
+            cols, counts = self.rows[doc_id]
+            cols = new_col[cols]
+            mask = cols >= 0
+            indices.append(cols[mask])
+            data.append(counts[mask].astype(np.float64))
+            indptr.append(indptr[-1] + int(mask.sum()))
+
+        indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+        data = np.concatenate(data) if data else np.zeros(0)
+        X = sparse.csr_matrix((data, indices, np.array(indptr)), shape=(n_docs, kept.size))
+        X.sort_indices()
+
+        # Weight by idf and normalize rows, as TfidfTransformer does
+        X.data *= idf[X.indices]
+        X = normalize(X, norm="l2", copy=False)
+
+        return X, feature_names, ids
+
+
+    def save(self, path):
+        """ Stores the counts and document frequencies of the model in a pickle file """
+
+        state = {
+            "max_df": self.max_df,
+            "analyzer": self.analyzer.__name__,
+            "terms": self.terms,
+            "df": self.df,
+            "rows": self.rows,
+        }
+        with open(path, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+    @classmethod
+    def load(cls, path):
+        """ Loads a model stored with save() """
+
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+
+        model = cls(state["max_df"], getattr(tfidf, state["analyzer"]))
+        model.terms = state["terms"]
+        model.vocabulary = {term: col for col, term in enumerate(model.terms)}
+        model.df = state["df"]
+        model.rows = state["rows"]
+
+        return model
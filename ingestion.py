@@ -0,0 +1,368 @@
+"""
+Resumable, checkpointed ingestion of scraped texts into books.db.
+
+The table ingestion holds one row per book and source column (description, full_text):
+    status          "pending", "done", "missing" (the scraper found nothing) or "failed" (the scraper raised)
+    content_hash    sha256 of the stored text
+    fetched_at      time of the last successful fetch, changed_at time the stored text last changed
+    dirty           1 once the text changed, until downstream analysis calls mark_clean()
+    attempts, error number of fetches and the last error
+
+ingest() only fetches the books that are not done yet (or whose fetch is older than max_age), and writes every batch of results together with their statuses in one transaction, so an interrupted run resumes where it stopped. A text whose hash did not change is not written again and does not become dirty.
+
+With Fixtures, the results of the scraping functions are recorded to a directory once and replayed later, so a whole ingestion can run offline.
+"""
+
+import argparse
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+from tqdm import tqdm
+from contextlib import nullcontext
+from download_webpage import fetch_concurrently, revalidating
+import storage
+
+
+STATUSES = ("pending", "done", "missing", "failed")
+
+
+def content_hash(text):
+    """ sha256 hex digest of a text, None for None """
+    return None if text is None else hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def ensure_tables(db_path = "books.db"):
+    """ Creates the books table (if it does not exist yet) and the ingestion table. Existing rows are never touched. """
+
+    conn = storage.connect(db_path)
+    try:
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS books (book_id INTEGER, title TEXT, description TEXT, author TEXT, PRIMARY KEY(book_id));")
+            conn.execute("CREATE INDEX IF NOT EXISTS books_title ON books (title);")
+            conn.execute("""CREATE TABLE IF NOT EXISTS ingestion (
+                                title TEXT NOT NULL,
+                                source TEXT NOT NULL,
+                                status TEXT NOT NULL DEFAULT 'pending',
+                                content_hash TEXT,
+                                fetched_at REAL,
+                                changed_at REAL,
+                                dirty INTEGER NOT NULL DEFAULT 0,
+                                attempts INTEGER NOT NULL DEFAULT 0,
+                                error TEXT,
+                                PRIMARY KEY (title, source));""")
+    finally:
+        conn.close()
+
+
+def add_books(titles, authors, db_path = "books.db"):
+    """
+    Inserts the books whose title is not in the books table yet, in the given order. Existing books keep their book_id and contents; books missing from titles are left in place.
+
+    Returns
+    -------
+    new_titles : list
+        The inserted titles
+    """
+
+    conn = storage.connect(db_path)
+    try:
+        existing = {title for (title,) in conn.execute("SELECT title FROM books;")}
+        new = [(title, author) for title, author in zip(titles, authors) if title not in existing]
+        with conn:
+            conn.executemany("INSERT INTO books (title, author) VALUES (?, ?);", new)
+    finally:
+        conn.close()
+
+    return [title for title, _ in new]
+
+
+def track(db_path, source):
+    """
+    Adds an ingestion row for every book that has none yet. Books that already have a text in the source column (e.g. from a books.db made before ingestion was tracked) are adopted as done, with the hash of that text and no fetch time.
+    """
+
+    storage.ensure_column(db_path, "books", source)
+    conn = storage.connect(db_path)
+    try:
+        untracked = conn.execute(f"""SELECT title, {source} FROM books
+                                     WHERE title NOT IN (SELECT title FROM ingestion WHERE source = ?);""", (source,)).fetchall()
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO ingestion (title, source, status, content_hash) VALUES (?, ?, ?, ?);",
+                             [(title, source, "pending" if text is None else "done", content_hash(text)) for title, text in untracked])
+    finally:
+        conn.close()
+
+
+def due_titles(db_path, source, titles = None, max_age = None):
+    """
+    The titles ingest() has to fetch: those not done yet and, with max_age, those fetched more than max_age seconds ago (or never, for adopted texts).
+
+    Parameters
+    ----------
+    titles : iterable or None
+        Only consider these titles, by default all books
+    max_age : float or None
+        Maximum age in seconds of a done fetch. None keeps done texts forever.
+    """
+
+    query = "SELECT title FROM ingestion WHERE source = ? AND (status != 'done'"
+    params = [source]
+    if max_age is not None:
+        query += " OR fetched_at IS NULL OR fetched_at < ?"
+        params.append(time.time() - max_age)
+    conn = storage.connect(db_path, readonly=True)
+    try:
+        due = {title for (title,) in conn.execute(query + ");", params)}
+    finally:
+        conn.close()
+
+    return [title for title in (due if titles is None else titles) if title in due]
+
+
+def _guarded(fetch, *args):
+    """ Calls fetch, returning ("ok", result) or ("failed", error message) instead of raising """
+    try:
+        return "ok", fetch(*args)
+    except Exception as e:
+        return "failed", f"{type(e).__name__}: {e}"
+
+
+def ingest(fetch, arguments, source, db_path = "books.db", max_age = None, max_workers = 8, batch_size = 10):
+    """
+    Fetches the texts of the due books concurrently and stores them in the source column of books, checkpointing after every batch.
+
+    Parameters
+    ----------
+    fetch : function
+        Scraping function returning the text of a book or None, e.g. scraper_guardian.scrape_gutenberg
+    arguments : dict
+        Title -> tuple of the positional arguments of fetch for that book, in the order to ingest them
+    source : string
+        The column of books to fill, e.g. "description" or "full_text"
+    db_path : string
+        Path to the sql file
+    max_age : float or None
+        Refetch done books whose last fetch is older than this many seconds, see due_titles(). Cached HTTP responses are then revalidated, see download_webpage.revalidating().
+    max_workers : int
+        Number of books fetched concurrently
+    batch_size : int
+        Number of results written per transaction. An interrupted run loses at most one batch.
+
+    Returns
+    -------
+    counts : dict
+        Number of books per outcome: "changed", "unchanged", "missing", "failed", and "skipped" for books that were not due
+    """
+
+    storage.check_identifier(source)
+    ensure_tables(db_path)
+    track(db_path, source)
+
+    titles = due_titles(db_path, source, list(arguments), max_age)
+    counts = {"changed": 0, "unchanged": 0, "missing": 0, "failed": 0, "skipped": len(arguments) - len(titles)}
+    if not titles:
+        return counts
+
+    conn = storage.connect(db_path)
+    stored = dict(conn.execute("SELECT title, content_hash FROM ingestion WHERE source = ?;", (source,)))
+    batch = []
+
+    def flush():
+        with conn:
+            for title, outcome, value in batch:
+                now = time.time()
+                if outcome == "failed":
+                    conn.execute("UPDATE ingestion SET status = 'failed', attempts = attempts + 1, error = ? WHERE title = ? AND source = ?;",
+                                 (value, title, source))
+                elif outcome == "missing":
+                    # A text that disappeared is kept, the scraper may just have failed to find it this time
+                    conn.execute("UPDATE ingestion SET status = 'missing', attempts = attempts + 1, error = NULL WHERE title = ? AND source = ?;",
+                                 (title, source))
+                elif outcome == "unchanged":
+                    conn.execute("""UPDATE ingestion SET status = 'done', fetched_at = ?, attempts = attempts + 1, error = NULL
+                                    WHERE title = ? AND source = ?;""", (now, title, source))
+                else:
+                    conn.execute(f"UPDATE books SET {source} = ? WHERE title = ?;", (value, title))
+                    conn.execute("""UPDATE ingestion SET status = 'done', content_hash = ?, fetched_at = ?, changed_at = ?, dirty = 1,
+                                    attempts = attempts + 1, error = NULL WHERE title = ? AND source = ?;""",
+                                 (content_hash(value), now, now, title, source))
+
+    # A due refetch must reach the source: the HTTP cache would otherwise answer with the body it already has
+    refetch = revalidating() if max_age is not None else nullcontext()
+
+    try:
+        with refetch:
+            # Fetch concurrently, and write the results with their statuses in batches as they arrive
+            results = fetch_concurrently(functools.partial(_guarded, fetch), [arguments[title] for title in titles], max_workers)
+            for i, (state, value) in tqdm(results, total = len(titles)):
+                title = titles[i]
+                if state == "failed":
+                    outcome = "failed"
+                elif value is None:
+                    outcome = "missing"
+                elif content_hash(value) == stored.get(title):
+                    outcome = "unchanged"
+                else:
+                    outcome = "changed"
+                counts[outcome] += 1
+                batch.append((title, outcome, value))
+                if len(batch) >= batch_size:
+                    flush()
+                    batch = []
+            if batch:
+                flush()
+    finally:
+        conn.close()
+
+    return counts
+
+
+def dirty_titles(db_path, source):
+    """ Titles whose text in the source column changed since the last mark_clean(), in book order """
+
+    query = """SELECT books.title FROM books JOIN ingestion ON ingestion.title = books.title
+                WHERE ingestion.source = ? AND ingestion.dirty = 1 ORDER BY books.rowid;"""
+    conn = storage.connect(db_path, readonly=True)
+    try:
+        return [title for (title,) in conn.execute(query, (source,))]
+    finally:
+        conn.close()
+
+
+def dirty_documents(db_path, source):
+    """
+    The changed documents of a column, e.g. for incremental_tfidf.IncrementalTfidf.add_documents(), which replaces documents with a known id.
+
+    Returns
+    -------
+    titles, texts : list
+    """
+
+    conn = storage.connect(db_path, readonly=True)
+    try:
+        rows = conn.execute(f"""SELECT books.title, books.{storage.check_identifier(source)} FROM books JOIN ingestion ON ingestion.title = books.title
+                                WHERE ingestion.source = ? AND ingestion.dirty = 1 AND books.{source} IS NOT NULL ORDER BY books.rowid;""",
+                            (source,)).fetchall()
+    finally:
+        conn.close()
+
+    return [title for title, _ in rows], [text for _, text in rows]
+
+
+def mark_clean(db_path, source, titles = None):
+    """ Clears the dirty flag of the given titles (by default all) once their new text has been analyzed """
+
+    conn = storage.connect(db_path)
+    try:
+        with conn:
+            if titles is None:
+                conn.execute("UPDATE ingestion SET dirty = 0 WHERE source = ?;", (source,))
+            else:
+                conn.executemany("UPDATE ingestion SET dirty = 0 WHERE title = ? AND source = ?;", [(title, source) for title in titles])
+    finally:
+        conn.close()
+
+
+def status(db_path = "books.db"):
+    """
+    Returns
+    -------
+    summary : dict
+        Source -> {status: number of books, "dirty": number of dirty books}
+    """
+
+    conn = storage.connect(db_path, readonly=True)
+    try:
+        summary = {}
+        for source, state, n, dirty in conn.execute("SELECT source, status, COUNT(*), SUM(dirty) FROM ingestion GROUP BY source, status;"):
+            counts = summary.setdefault(source, {"dirty": 0})
+            counts[state] = n
+            counts["dirty"] += dirty
+        return summary
+    finally:
+        conn.close()
+
+
+class Fixtures:
+    """
+    Directory of recorded results of scraping functions, one JSON file per call, so an ingestion can be replayed offline.
+
+    Parameters
+    ----------
+    path : string
+        The fixture directory
+    mode : string
+        "replay" answers from the recordings, raising KeyError for calls that were never recorded. "record" calls the real function and stores its result.
+    """
+
+    def __init__(self, path, mode = "replay"):
+        if mode not in ("replay", "record"):
+            raise ValueError(f"mode must be 'replay' or 'record', not {mode}")
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        if mode == "record":
+            os.makedirs(path, exist_ok=True)
+
+
+    def filename(self, name, args):
+        key = hashlib.sha256(json.dumps([name, list(args)]).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, f"{name}-{key[:16]}.json")
+
+
+    def wrap(self, func):
+        """ func, recorded or replayed according to mode. Its arguments and results must be JSON serializable. """
+
+        name = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            path = self.filename(name, args)
+            if self.mode == "replay":
+                if not os.path.exists(path):
+                    raise KeyError(f"No recording of {name}{args} in {self.path}")
+                with open(path, encoding="utf-8") as f:
+                    return json.load(f)["result"]
+
+            result = func(*args)
+            with self.lock:
+                tmp_path = path + f".tmp-{threading.get_ident()}"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"function": name, "args": list(args), "result": result}, f)
+                os.replace(tmp_path, path)
+            return result
+
+        return wrapper
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Resumable ingestion of the summaries and full texts into books.db")
+    parser.add_argument("--db", default="books.db")
+    parser.add_argument("--full-text", action="store_true", help="Also ingest the Gutenberg full texts")
+    parser.add_argument("--max-age", type=float, default=None, help="Refetch texts older than this many days, to detect changes")
+    parser.add_argument("--fixtures", default=None, help="Directory of recorded scraping results")
+    parser.add_argument("--record", action="store_true", help="Record the scraping results to --fixtures instead of replaying them")
+    parser.add_argument("--status", action="store_true", help="Only print the ingestion status")
+    args = parser.parse_args(argv)
+
+    if not args.status:
+        import scraper_guardian
+        fixtures = Fixtures(args.fixtures, "record" if args.record else "replay") if args.fixtures else None
+        max_age = args.max_age * 24 * 3600 if args.max_age is not None else None
+        scraper_guardian.create_relational_databases(db_path=args.db, max_age=max_age, fixtures=fixtures)
+        if args.full_text:
+            books = storage.load_columns(args.db, "books", ["title", "author"])
+            scraper_guardian.add_gutenberg_SQL([book["title"] for book in books], [book["author"] for book in books],
+                                               db_path=args.db, max_age=max_age, fixtures=fixtures)
+
+    for source, counts in status(args.db).items():
+        print(f"{source:12s} " + "  ".join(f"{key} {counts.get(key, 0)}" for key in STATUSES + ("dirty",)))
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,351 @@
+"""
+Lightweight instrumentation of the scraping, analysis and search stages: timers, counters and memory high-water marks.
+
+Stages are recorded with the stage() context manager or the instrumented() decorator. Instrumentation is off by default, in which case both cost a single flag check; it is switched on with enable(), or by setting the environment variable BOOK_PROFILE=1 (BOOK_PROFILE=memory also tracks memory, which is considerably slower).
+Metrics are kept per stage and, where a stage has a document key (e.g. the title of a book), per document. They are exported with to_json() or to_prometheus(), e.g. to find the slowest books and stages of a run:
+
+    instrumentation.enable()
+    scraper_guardian.create_relational_databases()
+    instrumentation.to_json("metrics.json")
+"""
+
+import functools
+import inspect
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+
+
+ENABLED = False
+TRACK_MEMORY = False
+
+_lock = threading.Lock()
+_local = threading.local()
+
+# stage name -> {"calls", "errors", "seconds", "max_seconds", "units", "peak_bytes"}
+_stages = {}
+# stage name -> {document key -> {"calls", "errors", "seconds", "units"}}
+_documents = {}
+# counter name -> value
+_counters = {}
+
+
+def enable(memory = False):
+    """
+    Switches instrumentation on.
+
+    Parameters
+    ----------
+    memory : bool
+        If True, also records the memory high-water mark of every stage with tracemalloc. Slows down allocation-heavy code (e.g. spacy) noticeably.
+    """
+
+    global ENABLED, TRACK_MEMORY
+    TRACK_MEMORY = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    ENABLED = True
+
+
+def disable():
+    """ Switches instrumentation off. Collected metrics are kept until reset(). """
+
+    global ENABLED, TRACK_MEMORY
+    ENABLED = False
+    if TRACK_MEMORY and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    TRACK_MEMORY = False
+
+
+def reset():
+    """ Discards all collected metrics """
+
+    with _lock:
+        _stages.clear()
+        _documents.clear()
+        _counters.clear()
+
+
+def count(name, n = 1):
+    """ Adds n to a named counter, e.g. the number of cache hits """
+
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def record(name, seconds, document = None, units = None, error = False, peak_bytes = None):
+    """ Adds one measured call to the metrics of a stage, and of a document within it if given """
+
+    with _lock:
+        stats = _stages.get(name)
+        if stats is None:
+            stats = _stages[name] = {"calls": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0, "units": 0, "peak_bytes": 0}
+        stats["calls"] += 1
+        stats["errors"] += error
+        stats["seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        if units is not None:
+            stats["units"] += units
+        if peak_bytes is not None:
+            stats["peak_bytes"] = max(stats["peak_bytes"], peak_bytes)
+
+        if document is not None:
+            docs = _documents.setdefault(name, {})
+            doc = docs.get(document)
+            if doc is None:
+                doc = docs[document] = {"calls": 0, "errors": 0, "seconds": 0.0, "units": 0}
+            doc["calls"] += 1
+            doc["errors"] += error
+            doc["seconds"] += seconds
+            if units is not None:
+                doc["units"] += units
+
+
+class _NullStage:
+    """ Stage used while instrumentation is disabled, does nothing """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Stage:
+    """
+    Times a block of code as one call of a stage. Use through stage().
+
+    With memory tracking, nested stages each get their own high-water mark: tracemalloc's peak is reset on entering a stage, and carried over to the enclosing stage on exit.
+    Memory is traced process-wide, so with concurrent threads the marks include the allocations of other threads.
+    """
+
+    def __init__(self, name, document = None, units = None):
+        self.name = name
+        self.document = document
+        self.units = units
+
+    def __enter__(self):
+        self.memory = TRACK_MEMORY and tracemalloc.is_tracing()
+        if self.memory:
+            frames = getattr(_local, "frames", None)
+            if frames is None:
+                frames = _local.frames = []
+            current, peak = tracemalloc.get_traced_memory()
+            if frames:
+                frames[-1][1] = max(frames[-1][1], peak)
+            # [allocated at entry, highest peak seen so far]
+            frames.append([current, 0])
+            tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        peak_bytes = None
+        if self.memory:
+            frames = _local.frames
+            start, carried = frames.pop()
+            peak = max(carried, tracemalloc.get_traced_memory()[1])
+            peak_bytes = peak - start
+            if frames:
+                frames[-1][1] = max(frames[-1][1], peak)
+        record(self.name, seconds, self.document, self.units, exc_type is not None, peak_bytes)
+        return False
+
+
+def stage(name, document = None, units = None):
+    """
+    Context manager timing a block of code as one call of a stage.
+
+    Parameters
+    ----------
+    name : string
+        Name of the stage, e.g. "scrape.parse_html"
+    document : string or None
+        Key of the document being processed, e.g. a book title, for per-document metrics
+    units : int or None
+        Amount of work done, e.g. characters or documents, for throughput
+
+    Examples
+    --------
+    >>> with stage("scrape.parse_html", document=title):
+    ...     dom = BeautifulSoup(html, "html.parser")
+    """
+
+    if not ENABLED:
+        return _NULL_STAGE
+    return Stage(name, document, units)
+
+
+def _argument_getter(func, param):
+    """ Returns a function extracting the value of parameter param from the (args, kwargs) of a call to func """
+
+    if param is None:
+        return None
+    if callable(param):
+        return param
+
+    params = list(inspect.signature(func).parameters)
+    position = params.index(param)
+
+    def get(args, kwargs):
+        if len(args) > position:
+            return args[position]
+        return kwargs.get(param)
+
+    return get
+
+
+def instrumented(name = None, document = None, units = None):
+    """
+    Decorator recording every call of a function as one call of a stage.
+
+    Parameters
+    ----------
+    name : string or None
+        Name of the stage, by default module.function
+    document : string, function or None
+        Name of the parameter holding the document key (e.g. "title"), or a function (args, kwargs) -> key
+    units : string, function or None
+        Name of a parameter whose length is the amount of work (e.g. "text"), or a function (args, kwargs) -> amount
+
+    Examples
+    --------
+    >>> @instrumented("scrape.goodreads", document="title")
+    ... def get_goodreads_description(title):
+    ...     ...
+    """
+
+    def decorator(func):
+        stage_name = name or f"{func.__module__}.{func.__qualname__}"
+        get_document = _argument_getter(func, document)
+        get_units = _argument_getter(func, units)
+        # A parameter name measures the length of the argument, a function returns the amount itself
+        measure_length = isinstance(units, str)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+
+            key = get_document(args, kwargs) if get_document else None
+            amount = get_units(args, kwargs) if get_units else None
+            if measure_length and amount is not None:
+                try:
+                    amount = len(amount)
+                except TypeError:
+                    amount = None
+            with Stage(stage_name, key, amount):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def report(slowest = None):
+    """
+    Snapshot of the collected metrics.
+
+    Parameters
+    ----------
+    slowest : int or None
+        If given, only the slowest documents of every stage are included
+
+    Returns
+    -------
+    metrics : dict
+        {"stages": {name: stats}, "documents": {stage: {key: stats}}, "counters": {name: value}, "max_rss_bytes": int}
+    """
+
+    with _lock:
+        stages = {name: dict(stats) for name, stats in _stages.items()}
+        documents = {name: {key: dict(stats) for key, stats in docs.items()} for name, docs in _documents.items()}
+        counters = dict(_counters)
+
+    for stats in stages.values():
+        stats["mean_seconds"] = stats["seconds"] / stats["calls"] if stats["calls"] else 0.0
+    if slowest is not None:
+        for name, docs in documents.items():
+            top = sorted(docs.items(), key=lambda item: item[1]["seconds"], reverse=True)[:slowest]
+            documents[name] = dict(top)
+
+    return {
+        "stages": stages,
+        "documents": documents,
+        "counters": counters,
+        # ru_maxrss is in kilobytes on Linux
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def to_json(path, slowest = None):
+    """ Writes report() to a JSON file """
+
+    with open(path, "w") as f:
+        json.dump(report(slowest), f, indent=2)
+
+
+def _label(value):
+    """ Escapes a Prometheus label value """
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def to_prometheus(path, slowest = None, prefix = "books"):
+    """
+    Writes the collected metrics in the Prometheus text exposition format, e.g. for the node exporter's textfile collector.
+
+    Parameters
+    ----------
+    path : string
+        The file to write
+    slowest : int or None
+        If given, only the slowest documents of every stage are written
+    prefix : string
+        Prefix of all metric names
+    """
+
+    metrics = report(slowest)
+    lines = []
+
+    def family(metric, kind, help_text, samples):
+        lines.append(f"# HELP {prefix}_{metric} {help_text}")
+        lines.append(f"# TYPE {prefix}_{metric} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{_label(val)}"' for key, val in labels.items())
+            lines.append(f"{prefix}_{metric}{{{label_text}}} {value}")
+
+    stages = metrics["stages"]
+    family("stage_calls_total", "counter", "Number of calls of a stage", [({"stage": n}, s["calls"]) for n, s in stages.items()])
+    family("stage_errors_total", "counter", "Number of calls of a stage that raised", [({"stage": n}, s["errors"]) for n, s in stages.items()])
+    family("stage_seconds_total", "counter", "Total wall time of a stage", [({"stage": n}, s["seconds"]) for n, s in stages.items()])
+    family("stage_seconds_max", "gauge", "Longest single call of a stage", [({"stage": n}, s["max_seconds"]) for n, s in stages.items()])
+    family("stage_units_total", "counter", "Amount of work done by a stage", [({"stage": n}, s["units"]) for n, s in stages.items()])
+    if TRACK_MEMORY or any(s["peak_bytes"] for s in stages.values()):
+        family("stage_peak_bytes", "gauge", "Memory high-water mark of a stage", [({"stage": n}, s["peak_bytes"]) for n, s in stages.items()])
+
+    documents = [(name, key, stats) for name, docs in metrics["documents"].items() for key, stats in docs.items()]
+    family("document_seconds_total", "counter", "Total wall time of a stage for one document",
+           [({"stage": name, "document": key}, stats["seconds"]) for name, key, stats in documents])
+    family("document_calls_total", "counter", "Number of calls of a stage for one document",
+           [({"stage": name, "document": key}, stats["calls"]) for name, key, stats in documents])
+
+    family("counter_total", "counter", "Named event counters", [({"name": n}, v) for n, v in metrics["counters"].items()])
+    lines.append(f"# TYPE {prefix}_process_max_rss_bytes gauge")
+    lines.append(f"{prefix}_process_max_rss_bytes {metrics['max_rss_bytes']}")
+
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+# Switch on from the environment, so scripts and notebooks can be profiled without code changes
+if os.environ.get("BOOK_PROFILE"):
+    enable(memory=os.environ["BOOK_PROFILE"].lower() == "memory")
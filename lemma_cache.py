@@ -0,0 +1,113 @@
+import sqlite3
+import hashlib
+import zlib
+import os
+
+
+CACHE_FILE = "lemma_cache.db"
+
+
+def open_cache(cache_dir):
+    """
+    Opens (and creates if necessary) the on-disk lemma cache in a directory.
+
+    Parameters
+    ----------
+    cache_dir : string
+        Directory in which the cache database is stored
+
+    Returns
+    -------
+    conn : sqlite3.Connection
+        Connection to the cache database
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(cache_dir, CACHE_FILE))
+    conn.execute("CREATE TABLE IF NOT EXISTS lemmas (key TEXT PRIMARY KEY, tokens BLOB NOT NULL);")
+
+    return conn
+
+
+def document_key(text, fingerprint):
+    """
+    Content address of a document for a given analyzer. Changing either the text or anything in the analyzer fingerprint gives a new key, so stale entries are never read.
+
+    Parameters
+    ----------
+    text : string
+        The raw document text
+    fingerprint : string
+        Identity of the analyzer (see tfidf.analyzer_fingerprint())
+
+    Returns
+    -------
+    key : string
+        Hex digest identifying the (document, analyzer) pair
+    """
+
+    h = hashlib.sha256()
+    h.update(fingerprint.encode("utf-8"))
+    h.update(b"\0")
+    h.update(text.encode("utf-8", errors="surrogatepass"))
+
+    return h.hexdigest()
+
+
+def encode_lemmas(lemmas):
+    """ Compress a list of tokens into a blob. Tokens are alphabetic, so a newline separator is safe."""
+    return zlib.compress("\n".join(lemmas).encode("utf-8"))
+
+
+def decode_lemmas(blob):
+    """ Inverse of encode_lemmas() """
+    joined = zlib.decompress(blob).decode("utf-8")
+    return joined.split("\n") if joined else []
+
+
+def get_lemmas(conn, keys):
+    """
+    Looks up cached token lists.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection returned by open_cache()
+    keys : iterable
+        Document keys, see document_key()
+
+    Returns
+    -------
+    found : dict
+        Maps every key present in the cache to its list of tokens
+    """
+
+    found = {}
+    keys = list(keys)
+
+    # Query in chunks to stay below sqlite's limit on bound parameters
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        rows = conn.execute(f"SELECT key, tokens FROM lemmas WHERE key IN ({placeholders});", chunk)
+        for key, blob in rows:
+            found[key] = decode_lemmas(blob)
+
+    return found
+
+
+def put_lemmas(conn, items):
+    """
+    Stores token lists in the cache, in one transaction.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection returned by open_cache()
+    items : iterable
+        Iterable of (key, lemmas) pairs
+    """
+
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO lemmas (key, tokens) VALUES (?, ?);",
+                         ((key, encode_lemmas(lemmas)) for key, lemmas in items))
@@ -0,0 +1,128 @@
+"""
+Load test of a running query_service.py on localhost. Opens a number of keep-alive connections that send search, keyword and recommendation requests back to back, and reports the latency percentiles and throughput.
+
+Usage:
+    python load_test.py --port 8080 --concurrency 32 --duration 10
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from urllib.parse import urlencode
+import numpy as np
+
+
+async def request(reader, writer, host, method, target, body = None):
+    """ Sends one HTTP/1.1 request on an open connection and reads the answer. Returns (status, JSON answer). """
+
+    payload = json.dumps(body).encode("utf-8") if body is not None else b""
+    head = f"{method} {target} HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(payload)}\r\n"
+    if body is not None:
+        head += "Content-Type: application/json\r\n"
+    writer.write((head + "\r\n").encode("latin-1") + payload)
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        if key.strip().lower() == "content-length":
+            length = int(value)
+
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def workload(host, port, n_queries, seed):
+    """
+    Builds a mix of requests from the models the service reports: searches for keywords of random books, keyword lookups and recommendations for random collections of 1-5 books.
+    """
+
+    rng = random.Random(seed)
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        _, models = await request(reader, writer, host, "GET", "/models")
+        queries = []
+        for _ in range(n_queries):
+            name = rng.choice(list(models))
+            titles = models[name]["titles"]
+            kind = rng.random()
+            if kind < 0.5:
+                title = rng.choice(titles)
+                _, answer = await request(reader, writer, host, "GET", "/keywords?" + urlencode({"model": name, "title": title, "n": 10}))
+                terms = [k["token"] for k in rng.sample(answer["keywords"], min(2, len(answer["keywords"])))]
+                queries.append(("GET", "/search?" + urlencode({"model": name, "q": " ".join(terms), "n": 10}), None))
+            elif kind < 0.7:
+                queries.append(("GET", "/keywords?" + urlencode({"model": name, "title": rng.choice(titles), "n": 15}), None))
+            else:
+                collection = rng.sample(titles, min(len(titles) - 1, rng.randint(1, 5)))
+                queries.append(("POST", "/recommend", {"model": name, "titles": collection, "n": 10}))
+    finally:
+        writer.close()
+
+    return queries
+
+
+async def client(host, port, queries, deadline, latencies, errors, rng):
+    """ One keep-alive connection sending random requests of the workload until the deadline """
+
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while time.perf_counter() < deadline:
+            method, target, body = rng.choice(queries)
+            start = time.perf_counter()
+            status, _ = await request(reader, writer, host, method, target, body)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def run(host, port, concurrency, duration, n_queries, seed):
+    queries = await workload(host, port, n_queries, seed)
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(*(client(host, port, queries, deadline, latencies, errors, random.Random(seed + i)) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection(host, port)
+    _, health = await request(reader, writer, host, "GET", "/health")
+    writer.close()
+
+    return latencies, errors, elapsed, health
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Load test of query_service.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--concurrency", type=int, default=32, help="Number of simultaneous connections")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to run")
+    parser.add_argument("--queries", type=int, default=1000, help="Number of distinct requests in the workload. Fewer means more LRU cache hits.")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    latencies, errors, elapsed, health = asyncio.run(run(args.host, args.port, args.concurrency, args.duration, args.queries, args.seed))
+    if not latencies:
+        print("No requests completed")
+        return 1
+
+    ms = np.asarray(latencies) * 1000
+    print(f"requests:    {len(latencies)} in {elapsed:.1f} s, {len(errors)} errors")
+    print(f"throughput:  {len(latencies) / elapsed:.0f} QPS")
+    print(f"latency ms:  p50 {np.percentile(ms, 50):.2f}  p90 {np.percentile(ms, 90):.2f}  p99 {np.percentile(ms, 99):.2f}  max {ms.max():.2f}")
+    print(f"cache:       {health['cache']}")
+    print(f"batches:     {health['batches']}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
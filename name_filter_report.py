@@ -0,0 +1,151 @@
+"""
+Benchmark and keyword-agreement report of the fast name filter (tfidf.lemmatize_fast_no_names) against the full entity recognizer (tfidf.lemmatize_no_names).
+
+For every book, both analyzers are timed, and the top-n keywords of the two resulting tf-idf matrices are compared. The names only one of the two removes are listed, to judge which one is right.
+
+Usage:
+    python name_filter_report.py --db books.db --column full_text --limit 10
+    python name_filter_report.py --synthetic 20 --length 20000 --output report.json
+"""
+
+import argparse
+import json
+import time
+from collections import Counter
+import numpy as np
+import tfidf
+import storage
+
+
+def load_corpus(args):
+    """ (titles, texts) of the books to compare, from books.db or synthetic """
+
+    if args.synthetic:
+        import benchmark
+        texts = benchmark.synthetic_corpus(args.synthetic, args.length)
+        return [f"synthetic {i}" for i in range(len(texts))], texts
+
+    corpus = storage.SqlCorpus(args.db, args.column)
+    titles, texts = corpus.titles(), list(corpus)
+    if args.limit:
+        titles, texts = titles[:args.limit], texts[:args.limit]
+    return titles, texts
+
+
+def timed(analyzer, texts):
+    """ Token lists of every text, and the seconds the analyzer took on each """
+
+    lemmas, seconds = [], []
+    for text in texts:
+        start = time.perf_counter()
+        lemmas.append(analyzer(text))
+        seconds.append(time.perf_counter() - start)
+    return lemmas, np.array(seconds)
+
+
+def jaccard(a, b):
+    a, b = set(a) - {""}, set(b) - {""}
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def compare(titles, texts, n = 15, max_df = 0.8):
+    """
+    Runs both analyzers on every text and compares their output.
+
+    Returns
+    -------
+    report : dict
+        "books": per book timings and top-n Jaccard similarity, "summary": totals and means, "removed_only_by_ner" / "removed_only_by_gazetteer": the most frequent words only one of the filters removes
+    """
+
+    # Load the model and warm up both pipelines before timing
+    tfidf.lemmatize_no_names(texts[0][:1000])
+    tfidf.lemmatize_fast_no_names(texts[0][:1000])
+
+    reference, ref_seconds = timed(tfidf.lemmatize_no_names, texts)
+    fast, fast_seconds = timed(tfidf.lemmatize_fast_no_names, texts)
+    full, _ = timed(tfidf.lemmatize, texts)
+
+    X_ref, names_ref = tfidf.tf_idf(reference, max_df, analyzer=tfidf.pretokenized)
+    X_fast, names_fast = tfidf.tf_idf(fast, max_df, analyzer=tfidf.pretokenized)
+    top_ref, _ = tfidf.top_n(X_ref, names_ref, n)
+    top_fast, _ = tfidf.top_n(X_fast, names_fast, n)
+
+    # Words that one filter removes and the other keeps, counted over the lowercased lemmas of the unfiltered output
+    only_ner, only_gazetteer = Counter(), Counter()
+    for all_lemmas, ref_lemmas, fast_lemmas in zip(full, reference, fast):
+        ref_kept, fast_kept = set(ref_lemmas), set(fast_lemmas)
+        for lemma in (lemma.lower() for lemma in all_lemmas):
+            if lemma not in ref_kept and lemma in fast_kept:
+                only_ner[lemma] += 1
+            elif lemma in ref_kept and lemma not in fast_kept:
+                only_gazetteer[lemma] += 1
+
+    books = []
+    for i, title in enumerate(titles):
+        books.append({
+            "title": title,
+            "characters": len(texts[i]),
+            "seconds_ner": float(ref_seconds[i]),
+            "seconds_fast": float(fast_seconds[i]),
+            "speedup": float(ref_seconds[i] / fast_seconds[i]) if fast_seconds[i] > 0 else None,
+            "top_n_jaccard": jaccard(top_ref[i], top_fast[i]),
+            "token_agreement": jaccard(reference[i], fast[i]),
+        })
+
+    summary = {
+        "books": len(books),
+        "seconds_ner": float(ref_seconds.sum()),
+        "seconds_fast": float(fast_seconds.sum()),
+        "speedup": float(ref_seconds.sum() / fast_seconds.sum()) if fast_seconds.sum() > 0 else None,
+        "mean_top_n_jaccard": float(np.mean([book["top_n_jaccard"] for book in books])),
+        "mean_token_agreement": float(np.mean([book["token_agreement"] for book in books])),
+        "n": n,
+    }
+
+    return {
+        "summary": summary,
+        "books": books,
+        "removed_only_by_ner": only_ner.most_common(25),
+        "removed_only_by_gazetteer": only_gazetteer.most_common(25),
+    }
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Speed and keyword agreement of the fast name filter")
+    parser.add_argument("--db", default="books.db")
+    parser.add_argument("--column", default="full_text", help="Text column of books.db")
+    parser.add_argument("--limit", type=int, default=None, help="Only compare the first books")
+    parser.add_argument("--synthetic", type=int, default=None, help="Use this many synthetic documents instead of books.db")
+    parser.add_argument("--length", type=int, default=20000, help="Words per synthetic document")
+    parser.add_argument("--n", type=int, default=15, help="Number of keywords compared per book")
+    parser.add_argument("--max-df", type=float, default=0.8)
+    parser.add_argument("--output", default=None, help="Write the report to this JSON file")
+    args = parser.parse_args(argv)
+
+    titles, texts = load_corpus(args)
+    if not texts:
+        print("No documents to compare")
+        return 1
+    report = compare(titles, texts, args.n, args.max_df)
+
+    print(f"{'title':40s} {'chars':>10s} {'ner s':>8s} {'fast s':>8s} {'speedup':>8s} {'top-n J':>8s}")
+    for book in report["books"]:
+        speedup = f"{book['speedup']:8.1f}" if book["speedup"] is not None else f"{'-':>8s}"
+        print(f"{book['title'][:40]:40s} {book['characters']:10d} {book['seconds_ner']:8.2f} {book['seconds_fast']:8.2f} {speedup} {book['top_n_jaccard']:8.2f}")
+
+    summary = report["summary"]
+    print(f"\nTotal: {summary['seconds_ner']:.1f} s with NER, {summary['seconds_fast']:.1f} s fast ({summary['speedup']:.1f}x)")
+    print(f"Mean top-{summary['n']} Jaccard: {summary['mean_top_n_jaccard']:.3f}, mean token agreement: {summary['mean_token_agreement']:.3f}")
+    print(f"Removed only by NER:       {report['removed_only_by_ner'][:10]}")
+    print(f"Removed only by gazetteer: {report['removed_only_by_gazetteer'][:10]}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
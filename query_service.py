@@ -0,0 +1,438 @@
+"""
+Long-running local HTTP/JSON service answering keyword searches, top-n keyword lookups and recommendations from tf-idf models that are loaded once and kept in memory.
+
+Usage:
+    python query_service.py --model summary=data/summary_results_1.pkl:description --model full_text=models/full_text --port 8080
+
+A model is either a directory written by tfidf_store.save_tfidf() (which contains the titles), or an (X, feature_names) pickle followed by ":<column>", the column of books.db whose non-empty rows the matrix was computed from (for the titles).
+
+Endpoints (all answers are JSON):
+    GET  /health
+    GET  /models
+    GET  /search?model=summary&q=whale+sea&n=10&mode=or
+    GET  /keywords?model=summary&title=Moby+Dick&n=15
+    GET  /recommend?model=summary&title=Moby+Dick&title=Ulysses&n=10
+    POST /recommend   {"model": "summary", "titles": ["Moby Dick", "Ulysses"], "n": 10}
+
+Concurrent searches and recommendations are gathered into micro-batches and answered with one KeywordIndex.batch_query() or Recommender.recommend_batch() call. Recent answers are kept in an LRU cache.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import tfidf
+import tfidf_store
+import instrumentation
+from search_engine import KeywordIndex, Recommender
+
+
+MAX_BATCH = 64
+MAX_DELAY = 0.002
+CACHE_SIZE = 10_000
+# Keywords per book computed at startup, larger requests are computed on demand
+TOP_KEYWORDS = 50
+MAX_N = 1000
+MAX_BODY = 1 << 20
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class HttpError(Exception):
+    """ Error answered to the client with an HTTP status and a JSON {"error": message} body """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class LruCache:
+    """
+    Least recently used cache of query answers.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of answers kept
+    """
+
+    def __init__(self, maxsize = CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ The cached answer of key, or None """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+class MicroBatcher:
+    """
+    Gathers concurrent requests into batches: the first request of a batch waits at most max_delay seconds for others to arrive, and a batch is sent as soon as it holds max_batch requests.
+    The batch function runs in a worker thread, so the event loop keeps accepting requests meanwhile. If a batch fails, its requests are retried one by one, so one bad request does not fail the others.
+
+    Parameters
+    ----------
+    func : function
+        Takes a list of requests and returns the list of their answers, e.g. a wrapper of KeywordIndex.batch_query()
+    max_batch : int
+        Maximum number of requests per batch
+    max_delay : float
+        Maximum number of seconds a request waits for its batch to fill up
+    """
+
+    def __init__(self, func, max_batch = MAX_BATCH, max_delay = MAX_DELAY):
+        self.func = func
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending = []
+        self.timer = None
+        self.batches = 0
+
+    async def submit(self, item):
+        """ Adds a request to the current batch and waits for its answer """
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_delay, self.flush)
+
+        return await future
+
+    def flush(self):
+        """ Sends the pending requests as one batch """
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            self.batches += 1
+            asyncio.get_running_loop().create_task(self.run(batch))
+
+    async def run(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            answers = await asyncio.to_thread(self.func, items)
+        except Exception:
+            answers = []
+            for item in items:
+                try:
+                    answers.append((await asyncio.to_thread(self.func, [item]))[0])
+                except Exception as e:
+                    answers.append(e)
+
+        for (_, future), answer in zip(batch, answers):
+            if future.cancelled():
+                continue
+            if isinstance(answer, Exception):
+                future.set_exception(answer)
+            else:
+                future.set_result(answer)
+
+
+class ServedModel:
+    """
+    One tf-idf model with everything the endpoints need precomputed: the keyword index, the recommender, the top keywords of every book and the micro-batchers.
+
+    Parameters
+    ----------
+    name : string
+        Name of the model in requests, e.g. "summary"
+    X : sparse.matrix
+        The tf-idf matrix (titles, tokens)
+    feature_names : iterable
+        The tokens of the columns of X
+    titles : iterable
+        The titles of the rows of X
+    """
+
+    def __init__(self, name, X, feature_names, titles):
+        self.name = name
+        self.X = X.tocsr()
+        self.feature_names = np.asarray(feature_names, dtype=object)
+        self.titles = [str(title) for title in titles]
+        self.index = KeywordIndex(self.X, self.feature_names, self.titles)
+        self.recommender = Recommender(self.X, self.titles)
+        self.title_rows = tfidf.title_rows(self.titles)
+        self.top_tokens, self.top_scores = tfidf.top_n(self.X, self.feature_names, TOP_KEYWORDS)
+
+        self.search_batcher = MicroBatcher(self.search_batch)
+        self.recommend_batcher = MicroBatcher(self.recommend_batch)
+
+    def search_batch(self, requests):
+        """ Answers (terms, n, mode) requests, grouped so that every group is one batch_query() """
+
+        answers = [None] * len(requests)
+        groups = {}
+        for i, (terms, n, mode) in enumerate(requests):
+            groups.setdefault(mode, []).append(i)
+        for mode, members in groups.items():
+            n_max = max(requests[i][1] for i in members)
+            results = self.index.batch_query([requests[i][0] for i in members], n_max, mode)
+            for i, result in zip(members, results):
+                answers[i] = result[:requests[i][1]]
+
+        return answers
+
+    def recommend_batch(self, requests):
+        """ Answers (titles, n) requests with one recommend_batch() """
+
+        n_max = max(n for _, n in requests)
+        results = self.recommender.recommend_batch([titles for titles, _ in requests], n_max)
+
+        return [result[:n] for result, (_, n) in zip(results, requests)]
+
+    def keywords(self, title, n):
+        """ The n keywords of a book with their tf-idf scores """
+
+        row = self.title_rows[title]
+        if n <= TOP_KEYWORDS:
+            tokens, scores = self.top_tokens[row, :n], self.top_scores[row, :n]
+        else:
+            tokens, scores = tfidf.top_n(self.X[row], self.feature_names, n)
+            tokens, scores = tokens[0], scores[0]
+
+        return [(str(token), float(score)) for token, score in zip(tokens, scores) if token != ""]
+
+    def describe(self):
+        return {"books": self.X.shape[0], "terms": self.X.shape[1], "titles": self.titles}
+
+
+def load_model(name, spec, db_path = "books.db"):
+    """ Loads a ServedModel, see tfidf_store.load_model() for the spec """
+    return ServedModel(name, *tfidf_store.load_model(spec, db_path))
+
+
+class QueryService:
+    """
+    The HTTP/JSON front end of a set of ServedModels.
+
+    Parameters
+    ----------
+    models : dict
+        Name -> ServedModel
+    cache_size : int
+        Maximum number of answers in the LRU cache
+    """
+
+    def __init__(self, models, cache_size = CACHE_SIZE):
+        self.models = models
+        self.cache = LruCache(cache_size)
+        self.requests = 0
+        self.started = time.time()
+
+    def model(self, params):
+        name = params.get("model", next(iter(self.models)))
+        if not isinstance(name, str):
+            raise HttpError(400, "Give exactly one model")
+        if name not in self.models:
+            raise HttpError(404, f"Unknown model {name}, available: {list(self.models)}")
+        return self.models[name]
+
+    @staticmethod
+    def count(params, default = 10):
+        try:
+            n = int(params.get("n", default))
+        except (TypeError, ValueError):
+            raise HttpError(400, "n must be an integer") from None
+        if not 0 < n <= MAX_N:
+            raise HttpError(400, f"n must be between 1 and {MAX_N}")
+        return n
+
+    async def cached(self, key, compute):
+        """ Answers from the LRU cache, or computes and caches the answer """
+
+        answer = self.cache.get(key)
+        if answer is None:
+            instrumentation.count("service.cache_miss")
+            answer = await compute()
+            self.cache.put(key, answer)
+        else:
+            instrumentation.count("service.cache_hit")
+        return answer
+
+    async def search(self, params):
+        model = self.model(params)
+        terms = params.get("q", "")
+        terms = terms.split() if isinstance(terms, str) else list(terms)
+        if not terms or not all(isinstance(term, str) for term in terms):
+            raise HttpError(400, "Missing search terms q")
+        mode = params.get("mode", "or")
+        if mode not in ("or", "and"):
+            raise HttpError(400, "mode must be 'or' or 'and'")
+        n = self.count(params)
+
+        key = ("search", model.name, tuple(sorted(set(terms))), n, mode)
+        results = await self.cached(key, lambda: model.search_batcher.submit((terms, n, mode)))
+        return {"model": model.name, "terms": terms, "mode": mode, "results": [{"title": t, "score": s} for t, s in results]}
+
+    async def keywords(self, params):
+        model = self.model(params)
+        title = params.get("title")
+        if not isinstance(title, str):
+            raise HttpError(400, "Give exactly one title")
+        if title not in model.title_rows:
+            raise HttpError(404, f"Unknown title {title}")
+        n = self.count(params, 15)
+
+        return {"model": model.name, "title": title, "keywords": [{"token": t, "score": s} for t, s in model.keywords(title, n)]}
+
+    async def recommend(self, params):
+        model = self.model(params)
+        titles = params.get("titles") or params.get("title") or []
+        titles = [titles] if isinstance(titles, str) else list(titles)
+        if not titles or not all(isinstance(title, str) for title in titles):
+            raise HttpError(400, "Missing titles")
+        unknown = [title for title in titles if title not in model.title_rows]
+        if unknown:
+            raise HttpError(404, f"Unknown titles {unknown}")
+        n = self.count(params)
+
+        key = ("recommend", model.name, tuple(sorted(set(titles))), n)
+        results = await self.cached(key, lambda: model.recommend_batcher.submit((titles, n)))
+        return {"model": model.name, "titles": titles, "results": [{"title": t, "similarity": s} for t, s in results]}
+
+    async def health(self, params):
+        return {
+            "status": "ok",
+            "uptime": time.time() - self.started,
+            "requests": self.requests,
+            "cache": {"size": len(self.cache.entries), "hits": self.cache.hits, "misses": self.cache.misses},
+            "batches": {name: {"search": m.search_batcher.batches, "recommend": m.recommend_batcher.batches} for name, m in self.models.items()},
+        }
+
+    async def list_models(self, params):
+        return {name: model.describe() for name, model in self.models.items()}
+
+    async def dispatch(self, method, target, body):
+        """ Answers one request, returning (status, JSON-serializable answer) """
+
+        url = urlsplit(target)
+        # Repeated parameters (e.g. title=a&title=b) become lists
+        params = {key: values if len(values) > 1 or key == "titles" else values[0] for key, values in parse_qs(url.query).items()}
+        if method == "POST":
+            try:
+                payload = json.loads(body or b"{}")
+            except ValueError:
+                raise HttpError(400, "Body is not valid JSON") from None
+            if not isinstance(payload, dict):
+                raise HttpError(400, "Body must be a JSON object")
+            params.update(payload)
+
+        routes = {
+            "/search": (self.search, ("GET", "POST")),
+            "/keywords": (self.keywords, ("GET", "POST")),
+            "/recommend": (self.recommend, ("GET", "POST")),
+            "/health": (self.health, ("GET",)),
+            "/models": (self.list_models, ("GET",)),
+        }
+        if url.path not in routes:
+            raise HttpError(404, f"Unknown endpoint {url.path}")
+        handler, methods = routes[url.path]
+        if method not in methods:
+            raise HttpError(405, f"{url.path} does not accept {method}")
+
+        with instrumentation.stage(f"service{url.path}"):
+            return 200, await handler(params)
+
+    async def handle(self, reader, writer):
+        """ Serves the requests of one (keep-alive) connection """
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                length = int(headers.get("content-length", 0) or 0)
+                self.requests += 1
+                try:
+                    if length > MAX_BODY:
+                        raise HttpError(413, "Request body too large")
+                    body = await reader.readexactly(length) if length else b""
+                    status, answer = await self.dispatch(method, target, body)
+                except HttpError as e:
+                    status, answer = e.status, {"error": str(e)}
+                except ValueError as e:
+                    status, answer = 400, {"error": str(e)}
+                except Exception as e:
+                    status, answer = 500, {"error": f"{type(e).__name__}: {e}"}
+
+                payload = json.dumps(answer).encode("utf-8")
+                writer.write(f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                             f"Content-Type: application/json\r\n"
+                             f"Content-Length: {len(payload)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + payload)
+                await writer.drain()
+                if not keep_alive or status == 413:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host = "127.0.0.1", port = 8080):
+        """ Serves until cancelled """
+
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving {list(self.models)} on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Local query service for keyword search and recommendations")
+    parser.add_argument("--model", action="append", required=True, help="name=path, a tfidf_store directory or <pickle>:<books.db column>")
+    parser.add_argument("--db", default="books.db", help="books.db, for the titles of pickled models")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE, help="Number of answers kept in the LRU cache")
+    args = parser.parse_args(argv)
+
+    models = {}
+    for spec in args.model:
+        name, _, path = spec.partition("=")
+        if not path:
+            parser.error(f"--model must be name=path, not {spec}")
+        models[name] = load_model(name, path, args.db)
+
+    try:
+        asyncio.run(QueryService(models, args.cache_size).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
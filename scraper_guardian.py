@@ -1,12 +1,18 @@
-from download_webpage import simple_get
+from download_webpage import simple_get, rate_limited_get, fetch_concurrently
+from text_storage import START_MARKER, END_MARKER, trim_gutenberg_stream, write_text_stream
+import storage
+import ingestion
+import instrumentation
 from bs4 import BeautifulSoup
-import requests
+from contextlib import closing
 import unicodedata
+import codecs
+import os
 import re
-from cs50 import SQL
 from tqdm import tqdm
 
 
+@instrumentation.instrumented("scrape.goodreads_description", document="title")
 def get_goodreads_description(title):
     """
     Extracts the summary of a book title from the webpage goodreads.
@@ -27,7 +33,8 @@ def get_goodreads_description(title):
         # Navigate to search page of title, and extract the link to book description
         search_url = f"https://www.goodreads.com/search?utf8=%E2%9C%93&q={title.strip().replace(" ", "+")}&search_type=books"
         search_html = simple_get(search_url)
-        search_dom = BeautifulSoup(search_html, 'html.parser')
+        with instrumentation.stage("scrape.parse_html", document=title, units=len(search_html or "")):
+            search_dom = BeautifulSoup(search_html, 'html.parser')
         
     except Exception as E:
         print(f"Error in extracting DOM for search page")
@@ -41,7 +48,8 @@ def get_goodreads_description(title):
 
         # Extract DOM of the summary page
         description_html = simple_get("https://www.goodreads.com" + posfix)
-        description_dom = BeautifulSoup(description_html, 'html.parser')
+        with instrumentation.stage("scrape.parse_html", document=title, units=len(description_html or "")):
+            description_dom = BeautifulSoup(description_html, 'html.parser')
 
     except Exception as E:
         print("Error in either extracting href to new page or extracting DOM for new page")
@@ -101,9 +109,10 @@ def remove_problematic_words(text):
     return clean_text
 
 
-def scrape_gutenberg(title, author):
+@instrumentation.instrumented("scrape.gutendex_search", document="title")
+def find_gutenberg_txt_url(title, author):
     """
-    Sends a query to https://gutendex.com to extract the full text of a title from the author.
+    Sends a query to https://gutendex.com to find the url of the plain text version of a title from the author.
     
     Parameters
     ----------
@@ -114,8 +123,8 @@ def scrape_gutenberg(title, author):
     
     Returns
     -------
-    text : string
-        The full text of the book in question. If the book is not found on Gutendex, returns None.
+    txt_url : string
+        The url of the txt file. If the book is not found on Gutendex, returns None.
     """
 
     try:
@@ -125,7 +134,7 @@ def scrape_gutenberg(title, author):
 
         # Query to Gutendex
         query = f"{title} {author}"
-        search_result = requests.get(f"https://gutendex.com/books", params={"search": query})
+        search_result = rate_limited_get(f"https://gutendex.com/books", params={"search": query})
         data = search_result.json()
 
         try:
@@ -136,24 +145,7 @@ def scrape_gutenberg(title, author):
                 if 'text/plain' in f.lower():
                     txt_format = f
 
-            try:
-                # Request the txt file. 
-                txt_url = data['results'][0]['formats'][txt_format]
-                text = requests.get(txt_url).text
-
-                # Cut off irrelevant additions by Gutenberg
-                start = "START OF THE PROJECT GUTENBERG EBOOK"
-                end = "END OF THE PROJECT GUTENBERG EBOOK"
-                start_idx = text.find(start)
-                start_idx += len(start)
-                end_idx = text.find(end)
-                text = text[start_idx:end_idx].strip()
-
-                return text
-            
-            except Exception as e:
-                print(f"Error in extracting txt file")
-                return None
+            return data['results'][0]['formats'][txt_format]
                 
         except Exception as e:
             print(f"text/plain could not be found in {formats}")
@@ -162,11 +154,143 @@ def scrape_gutenberg(title, author):
     except Exception as e:
         print(f"Couldn't retrieve! Author: {author}, Title: {title}")
         return None
+
+
+@instrumentation.instrumented("scrape.gutenberg", document="title")
+def scrape_gutenberg(title, author):
+    """
+    Sends a query to https://gutendex.com to extract the full text of a title from the author.
+    
+    Parameters
+    ----------
+    title : string
+        The title of the book
+    author : string
+        The author of the book
+    
+    Returns
+    -------
+    text : string
+        The full text of the book in question. If the book is not found on Gutendex, returns None.
+    """
+
+    txt_url = find_gutenberg_txt_url(title, author)
+    if txt_url is None:
+        return None
+
+    try:
+        # Request the txt file. 
+        text = rate_limited_get(txt_url).text
+
+        # Cut off irrelevant additions by Gutenberg
+        start = START_MARKER
+        end = END_MARKER
+        start_idx = text.find(start)
+        start_idx += len(start)
+        end_idx = text.find(end)
+        text = text[start_idx:end_idx].strip()
+
+        return text
+    
+    except Exception as e:
+        print(f"Error in extracting txt file")
+        return None
+
+
+@instrumentation.instrumented("scrape.gutenberg_stream", document="title")
+def stream_gutenberg(title, author, path, chunk_size = 1 << 16):
+    """
+    Streaming version of scrape_gutenberg(). The txt file is decoded chunk by chunk as it downloads, the Gutenberg header and license are cut off on the fly, and only the body is written to path, compressed according to its extension (.gz, .zst).
+    An existing file at path is kept, so books are never downloaded twice.
+
+    Parameters
+    ----------
+    title : string
+        The title of the book
+    author : string
+        The author of the book
+    path : string
+        The file to write the full text to, e.g. "texts/ulysses.txt.gz"
+    chunk_size : int
+        Number of bytes read from the network at once
+
+    Returns
+    -------
+    path : string
+        The path of the stored text. If the book is not found on Gutendex or the download fails, returns None.
+    """
+
+    if os.path.exists(path):
+        return path
+
+    txt_url = find_gutenberg_txt_url(title, author)
+    if txt_url is None:
+        return None
+
+    try:
+        # The text file is not kept in the HTTP cache, the stored file takes its place
+        with closing(rate_limited_get(txt_url, stream=True, use_cache=False)) as resp:
+            resp.raise_for_status()
+            decoder = codecs.getincrementaldecoder(resp.encoding or "utf-8")(errors="replace")
+
+            def decoded():
+                for chunk in resp.iter_content(chunk_size):
+                    yield decoder.decode(chunk)
+                yield decoder.decode(b"", final=True)
+
+            write_text_stream(path, trim_gutenberg_stream(decoded()))
+
+        return path
+
+    except Exception as e:
+        print(f"Error in streaming txt file of {title}: {str(e)}")
+        return None
+
+
+def text_filename(title, compression = "gz"):
+    """ File name for the full text of a title, e.g. "the_pilgrim_s_progress.txt.gz" """
+
+    name = re.sub(r'[^a-z0-9]+', '_', title.lower()).strip('_')
+    return f"{name}.txt.{compression}" if compression else f"{name}.txt"
+
+
+def add_gutenberg_files(titles, authors, text_dir = "texts", compression = "gz", max_workers = 8):
+    """
+    Stream all full texts of the corpus into (compressed) files in text_dir, instead of storing them in books.db.
+    The path of every downloaded text is stored in the column full_text_path of the table books, which is added if necessary.
+    Read the texts back with text_storage.read_text_stream() or text_storage.read_text().
+
+    Parameters
+    ----------
+    titles : iterable
+        Iterable of strings, containing all titles in the corpus to be scraped
+    authors : iterable
+        Iterable of strings, containing all author names of the books to be scraped.
+    text_dir : string
+        Directory of the text files
+    compression : string or None
+        "gz", "zst" (requires the zstandard package) or None for plain text
+    max_workers : int
+        Number of books downloaded concurrently
+    """
+
+    storage.ensure_column("books.db", "books", "full_text_path")
+
+    os.makedirs(text_dir, exist_ok=True)
+    titles = list(titles)
+    authors = list(authors)
+    paths = [os.path.join(text_dir, text_filename(title, compression)) for title in titles]
+
+    # Stream texts concurrently, and record the paths of completed files in batches
+    results = fetch_concurrently(stream_gutenberg, zip(titles, authors, paths), max_workers)
+    items = ((titles[i], path) for i, path in tqdm(results, total = len(titles)))
+    storage.update_column("books.db", "books", "full_text_path", "title", items, batch_size = 10)
     
       
-def add_gutenberg_SQL(titles, authors):
+def add_gutenberg_SQL(titles, authors, max_workers = 8, batch_size = 10, db_path = "books.db", max_age = None, fixtures = None):
     """
-    Scrape and download all full texts of the corpus. Adds them to the sql table books under books.db. If the full text is not available, set the entry to NILL.
+    Scrape and download the full texts of the corpus into the column full_text of the sql table books under books.db. If the full text is not available, the entry stays NILL.
+    Only books whose full text was not ingested yet are scraped, so an interrupted run resumes where it stopped, see ingestion.ingest().
     
     Parameters
     ----------
@@ -174,15 +298,27 @@ def add_gutenberg_SQL(titles, authors):
         Iterable of strings, containing all titles in the corpus to be scraped
     authors : iterable
         Iterable of strings, containing all author names of the books to be scraped.
+    max_workers : int
+        Number of books downloaded concurrently. Requests per host are rate limited in download_webpage.
+    batch_size : int
+        Number of full texts written to the sql table per transaction
+    db_path : string
+        Path to the sql file
+    max_age : float or None
+        Scrape full texts older than this many seconds again, only storing (and marking dirty) those that changed
+    fixtures : ingestion.Fixtures or None
+        Record or replay the scraping results, e.g. to run offline
+
+    Returns
+    -------
+    counts : dict
+        Number of books per outcome, see ingestion.ingest()
     """
 
-    # Instantiate SQL command object
-    db = SQL("sqlite:///books.db")
+    scrape = fixtures.wrap(scrape_gutenberg) if fixtures is not None else scrape_gutenberg
+    arguments = {title: (title, author) for title, author in zip(titles, authors)}
 
-    # Attempt to scrape full text for every title, and add to sql table
-    for title, author in tqdm(zip(titles, authors), total = len(titles)):
-        text = scrape_gutenberg(title, author)
-        db.execute("UPDATE books SET full_text=? WHERE title=?", text, title)
+    return ingestion.ingest(scrape, arguments, "full_text", db_path, max_age, max_workers, batch_size)
 
 
 def get_title_and_author():
@@ -225,25 +361,52 @@ def get_title_and_author():
     return titles, authors
 
 
-def create_relational_databases():
+def create_relational_databases(max_workers = 4, db_path = "books.db", max_age = None, fixtures = None):
     """
-    Create an sql table called books, under books.db. Table contains the title, author, and goodreads summary of the top 100 novels.
+    Create or update the sql table books, under books.db. Table contains the title, author, and goodreads summary of the top 100 novels.
+    An existing database is kept: new titles are added, and only summaries that were not ingested yet (or are older than max_age) are scraped, see ingestion.ingest().
+
+    Parameters
+    ----------
+    max_workers : int
+        Number of summaries scraped concurrently. Requests per host are rate limited in download_webpage.
+    db_path : string
+        Path to the sql file
+    max_age : float or None
+        Scrape summaries older than this many seconds again, only storing (and marking dirty) those that changed
+    fixtures : ingestion.Fixtures or None
+        Record or replay the scraping results, e.g. to run offline
+
+    Returns
+    -------
+    counts : dict
+        Number of summaries per outcome, see ingestion.ingest()
     """
 
-    # Create SQL table
-    open("books.db", "w").close()
-    db = SQL("sqlite:///books.db")
-    db.execute("CREATE TABLE books (book_id INTEGER, title TEXT, description TEXT, author TEXT, PRIMARY KEY(book_id));")
+    # Create the SQL tables if they do not exist yet
+    conn = storage.connect(db_path)
+    has_fts = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'books_fts';").fetchone() is not None
+    conn.close()
+    ingestion.ensure_tables(db_path)
+
+    # Full-text index over summaries and full texts, kept in sync with books by triggers
+    if not has_fts:
+        storage.create_fts_index(db_path)
 
     # Get book information, remive newlines and whitespaces
-    titles, authors = get_title_and_author()
-    for title, author in tqdm(zip(titles, authors), total = len(titles)):
-        title = title.replace('\n', '').replace('\r', '').strip().upper()
-        author = author.replace('\n', '').replace('\r', '').strip().upper()
-        
-        # Use title to get summary, and fill all information into table
-        description = get_goodreads_description(title)
-        id  = db.execute("INSERT INTO books (title, description, author) VALUES(?, ?, ?);", title, description, author)
+    list_books = fixtures.wrap(get_title_and_author) if fixtures is not None else get_title_and_author
+    titles, authors = list_books()
+    titles = [title.replace('\n', '').replace('\r', '').strip().upper() for title in titles]
+    authors = [author.replace('\n', '').replace('\r', '').strip().upper() for author in authors]
+
+    # Add new books in the original order, so that book ids stay the same
+    ingestion.add_books(titles, authors, db_path)
+
+    # Use titles to get summaries concurrently, writing them as they finish
+    scrape = fixtures.wrap(get_goodreads_description) if fixtures is not None else get_goodreads_description
+    arguments = {title: (title,) for title in titles}
+
+    return ingestion.ingest(scrape, arguments, "description", db_path, max_age, max_workers)
 
 
 # Test
@@ -1,8 +1,14 @@
 import numpy as np
 from scipy import sparse
 from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
+from sklearn.decomposition import TruncatedSVD
+import tfidf_store
+import storage
+import instrumentation
 
 
+@instrumentation.instrumented("search.keyword_search1", document="feature")
 def keyword_search1(X, feature_names, feature, titles, top_n):
     """ Finds the maximum tf-idf value of a word in the corpus, and returns the name of the title with the maximum value of that word """
     word_idx = int(np.where(feature_names == feature)[0][0])
@@ -21,15 +27,248 @@ def keyword_search1(X, feature_names, feature, titles, top_n):
     return [(titles[rows_slice[i]], float(data_slice[i])) for i in order]
 
 
+class KeywordIndex:
+    """
+    Inverted keyword index over a tf-idf matrix, built once and reused for every query.
+    Keeps a term -> column hash map, the column-major (csc) matrix and, for every term, the top_k books with the highest tf-idf score (the postings).
+
+    Parameters
+    ----------
+    X : sparse.matrix
+        The tf-idf matrix (titles, tokens)
+    feature_names : iterable
+        The tokens of the columns of X
+    titles : iterable
+        The titles of the rows of X
+    top_k : int
+        Number of books precomputed per term. Larger queries fall back to the csc matrix.
+    """
+
+    @instrumentation.instrumented("search.keyword_index.build")
+    def __init__(self, X, feature_names, titles, top_k = 20):
+        self.X_csc = X if sparse.isspmatrix_csc(X) else sparse.csc_matrix(X)
+        self.feature_names = np.asarray(feature_names, dtype=object)
+        self.titles = np.asarray(titles, dtype=object)
+        self.term_index = {term: i for i, term in enumerate(self.feature_names)}
+        self.top_k = top_k
+
+        # Title -> its rows, to map the hits of the full-text index back to the matrix
+        self.title_rows = {}
+        for row, title in enumerate(self.titles):
+            self.title_rows.setdefault(title, []).append(row)
+
+        # Binary matrix of which book contains which token, used for AND queries
+        self.X_bin = self.X_csc.copy()
+        self.X_bin.data = np.ones_like(self.X_bin.data)
+
+        # Sort every column by descending score (ties by row) and keep the first top_k entries as the postings
+        indptr = self.X_csc.indptr
+        data = self.X_csc.data
+        rows = self.X_csc.indices
+        counts = np.diff(indptr)
+        cols = np.repeat(np.arange(counts.size), counts)
+        order = np.lexsort((rows, -data, cols))
+        rank = np.arange(order.size) - indptr[cols]
+        keep = order[rank < top_k]
+
+        self.postings_indptr = np.concatenate([[0], np.cumsum(np.minimum(counts, top_k))])
+        self.postings_rows = rows[keep]
+        self.postings_scores = data[keep]
+
+
+    @classmethod
+    def from_store(cls, path, top_k = 20):
+        """ Builds the index from a model stored with tfidf_store.save_tfidf(), using its csc layout when available """
+
+        fmt = "csc" if "csc" in tfidf_store.load_meta(path)["formats"] else "csr"
+        X, feature_names, titles, _ = tfidf_store.load_tfidf(path, fmt)
+        if titles is None:
+            raise ValueError(f"{path} was stored without titles")
+
+        return cls(X, feature_names, titles, top_k)
+
+
+    def __contains__(self, term):
+        return term in self.term_index
+
+
+    @instrumentation.instrumented("search.keyword_index.search", document="feature")
+    def search(self, feature, top_n):
+        """
+        Same as keyword_search1(), but with O(1) term lookup. Unknown or pruned terms give an empty list instead of an error.
+
+        Parameters
+        ----------
+        feature : string
+            The token to search
+        top_n : int
+            Maximum number of titles to return
+
+        Returns
+        -------
+        results : list
+            (title, tf-idf score) pairs in descending order of score
+        """
+
+        word_idx = self.term_index.get(feature)
+        if word_idx is None:
+            return []
+
+        # Serve from the precomputed postings where possible
+        if top_n <= self.top_k:
+            start = self.postings_indptr[word_idx]
+            end = min(self.postings_indptr[word_idx + 1], start + top_n)
+            return [(self.titles[row], float(score)) for row, score in zip(self.postings_rows[start:end], self.postings_scores[start:end])]
+
+        start, end = self.X_csc.indptr[word_idx], self.X_csc.indptr[word_idx + 1]
+        return self._top(self.X_csc.data[start:end], self.X_csc.indices[start:end], top_n)
+
+
+    def query(self, terms, top_n, mode = "or"):
+        """
+        Ranked multi-term query, see batch_query()
+        """
+        return self.batch_query([terms], top_n, mode)[0]
+
+
+    @instrumentation.instrumented("search.keyword_index.batch_query", units="queries")
+    def batch_query(self, queries, top_n, mode = "or"):
+        """
+        Runs many multi-term queries in one sparse matrix product. A book's score for a query is the sum of the tf-idf scores of the query terms.
+
+        Parameters
+        ----------
+        queries : iterable
+            Every query is a string (one term) or an iterable of terms
+        top_n : int
+            Maximum number of titles to return per query
+        mode : string
+            "or" ranks books containing any of the terms, "and" only books containing all of them
+
+        Returns
+        -------
+        results : list
+            For every query, a list of (title, summed tf-idf score) pairs in descending order of score
+        """
+
+        if mode not in ("or", "and"):
+            raise ValueError(f"mode must be 'or' or 'and', not {mode}")
+
+        # Build a (queries, tokens) indicator matrix of the known terms of every query
+        q_rows = []
+        q_cols = []
+        n_terms = []
+        for i, terms in enumerate(queries):
+            terms = {terms} if isinstance(terms, str) else set(terms)
+            n_terms.append(len(terms))
+            for term in terms:
+                col = self.term_index.get(term)
+                if col is not None:
+                    q_rows.append(i)
+                    q_cols.append(col)
+        n_queries = len(n_terms)
+        Q = sparse.csr_matrix((np.ones(len(q_rows)), (q_rows, q_cols)), shape=(n_queries, len(self.feature_names)))
+
+        # Summed scores of every book for every query, and for AND the number of matched terms
+        scores = (self.X_csc @ Q.T).tocsc()
+        if mode == "and":
+            matched = (self.X_bin @ Q.T).tocsc()
+
+        results = []
+        for i in range(n_queries):
+            start, end = scores.indptr[i], scores.indptr[i + 1]
+            data = scores.data[start:end]
+            rows = scores.indices[start:end]
+
+            if mode == "and":
+                m_start, m_end = matched.indptr[i], matched.indptr[i + 1]
+                complete = set(matched.indices[m_start:m_end][matched.data[m_start:m_end] == n_terms[i]])
+                mask = np.fromiter((row in complete for row in rows), dtype=bool, count=rows.size)
+                data = data[mask]
+                rows = rows[mask]
+
+            results.append(self._top(data, rows, top_n))
+
+        return results
+
+
+    @instrumentation.instrumented("search.keyword_index.query_prefiltered")
+    def query_prefiltered(self, db_path, terms, top_n, mode = "or", n_candidates = 200):
+        """
+        Multi-term query with the FTS5 index of books.db (see storage.create_fts_index()) as a candidate pre-filter: only books the full-text index matches are ranked by tf-idf.
+        If none of the terms is in the tf-idf vocabulary (e.g. pruned by max_df), the BM25 ranking of the full-text index is returned instead of nothing.
+
+        Parameters
+        ----------
+        db_path : string
+            Path to books.db
+        terms : string or iterable
+            The search terms
+        top_n : int
+            Maximum number of titles to return
+        mode : string
+            "or" or "and"
+        n_candidates : int
+            Maximum number of candidates taken from the full-text index
+
+        Returns
+        -------
+        results : list
+            (title, score) pairs in descending order of score. Scores are summed tf-idf values, or BM25 scores in the fallback case.
+        """
+
+        hits = storage.fts_search(db_path, terms, mode, limit=n_candidates)
+
+        terms = {terms} if isinstance(terms, str) else set(terms)
+        cols = [self.term_index[term] for term in terms if term in self.term_index]
+        if not cols:
+            return [(title, score) for title, score, _ in hits[:top_n]]
+
+        # Score only the candidate rows, over only the columns of the query terms
+        rows = np.array(sorted({row for title, _, _ in hits for row in self.title_rows.get(title, ())}), dtype=np.int64)
+        if rows.size == 0:
+            return []
+        sub = self.X_csc[:, cols].tocsr()[rows]
+        scores = np.asarray(sub.sum(axis=1)).ravel()
+        matched = sub.getnnz(axis=1)
+
+        # As in batch_query(), OR keeps the books with any of the terms, AND those with all of them (unknown terms included)
+        keep = matched == len(terms) if mode == "and" else matched > 0
+        return self._top(scores[keep], rows[keep], top_n)
+
+
+    def _top(self, data, rows, top_n):
+        """ The top_n (title, score) pairs of a column slice, in descending order of score (ties by row) """
+
+        k = min(top_n, data.size)
+        if k == 0:
+            return []
+        if k < data.size:
+            kth = -np.partition(-data, k - 1)[k - 1]
+            part = np.flatnonzero(data >= kth)
+        else:
+            part = np.arange(data.size)
+        order = part[np.lexsort((rows[part], -data[part]))][:k]
+
+        return [(self.titles[rows[i]], float(data[i])) for i in order]
+
+
 def profile_books(collection_indices, book_titles, tfidf_mat):
-    
-    profile = tfidf_mat[collection_indices].mean(axis=0)
-    print(profile.shape)
-    print(type(profile))
+    """
+    Reader profile of a collection: the mean tf-idf row of its books.
+
+    Returns
+    -------
+    profile : np.ndarray
+        Array of shape (1, tokens). A plain ndarray, not the np.matrix that mean() returns on sparse matrices, which current scikit-learn rejects in cosine_similarity()
+    """
+
+    profile = np.asarray(tfidf_mat[collection_indices].mean(axis=0))
     profile = profile.reshape(1, -1)
 
     return profile
 
+@instrumentation.instrumented("search.similar_books", units="collection")
 def similar_books(collection, book_titles, tfidf_mat, n):
 
     indices = []
@@ -52,9 +291,198 @@ def similar_books(collection, book_titles, tfidf_mat, n):
     return recommends
 
 
+class Recommender:
+    """
+    Fast version of similar_books() for many readers. The tf-idf matrix is l2-normalized once, titles are looked up in a hash map, and the profiles of many readers are scored in one sparse matrix product.
 
+    Parameters
+    ----------
+    X : sparse.matrix
+        The tf-idf matrix (titles, tokens)
+    titles : iterable
+        The titles of the rows of X
+    gram_limit : int
+        For corpora up to this many books, the dense (books, books) matrix of dot products is precomputed, so scoring a reader no longer depends on the vocabulary size
+    """
 
-    
+    @instrumentation.instrumented("search.recommender.build")
+    def __init__(self, X, titles, gram_limit = 5000):
+        self.X = normalize(sparse.csr_matrix(X), norm="l2")
+        self.titles = np.asarray(titles, dtype=object)
+        self.title_index = {title: i for i, title in enumerate(self.titles)}
+        self.gram = (self.X @ self.X.T).toarray() if self.X.shape[0] <= gram_limit else None
+
+
+    def indices(self, collection):
+        """ Rows of the titles in a collection. Raises ValueError for unknown titles, like similar_books(). """
+
+        try:
+            return [self.title_index[book] for book in collection]
+        except KeyError as e:
+            raise ValueError(f"{e.args[0]} is not in the corpus") from None
+
+
+    def recommend(self, collection, n):
+        """
+        Recommends the n books most similar to the reader profile of a collection, see recommend_batch()
+        """
+        return self.recommend_batch([collection], n)[0]
+
+
+    @instrumentation.instrumented("search.recommender.recommend_batch", units="collections")
+    def recommend_batch(self, collections, n):
+        """
+        Recommends books for many readers at once. As in similar_books(), a reader profile is the mean tf-idf vector of the books in the collection, and books are ranked by cosine similarity to the profile, excluding the books of the collection.
+
+        Parameters
+        ----------
+        collections : iterable
+            One iterable of titles per reader
+        n : int
+            Number of recommendations per reader
+
+        Returns
+        -------
+        recommends : list
+            For every reader, a list of (title, cosine similarity) pairs in descending order of similarity
+        """
+
+        collections = [self.indices(collection) for collection in collections]
+        n_readers = len(collections)
+        n_books = self.X.shape[0]
+
+        # Averaging matrix (readers, books), so that P @ X holds the mean tf-idf vector of every collection
+        rows = np.repeat(np.arange(n_readers), [len(c) for c in collections])
+        cols = np.concatenate([np.asarray(c, dtype=np.int64) for c in collections]) if n_readers else np.zeros(0, dtype=np.int64)
+        weights = np.concatenate([np.full(len(c), 1 / len(c)) for c in collections if c] or [np.zeros(0)])
+        P = sparse.csr_matrix((weights, (rows, cols)), shape=(n_readers, n_books))
+
+        # Cosine similarity of every normalized profile to every normalized book.
+        # With the gram matrix G, the dot products are P @ G and the squared profile norms are the row sums of P * (P @ G).
+        if self.gram is not None:
+            sims = np.asarray(P @ self.gram)
+            norms = np.sqrt(np.maximum(np.asarray(P.multiply(sims).sum(axis=1)).ravel(), 0))
+            sims /= np.where(norms > 0, norms, 1)[:, None]
+        else:
+            profiles = normalize(P @ self.X, norm="l2")
+            sims = (profiles @ self.X.T).toarray()
+
+        # Exclude the books of each collection
+        exclude = np.zeros((n_readers, n_books), dtype=bool)
+        exclude[rows, cols] = True
+        sims[exclude] = -np.inf
+
+        k = min(n, n_books)
+        recommends = []
+        for i in range(n_readers):
+            k_i = min(k, n_books - int(exclude[i].sum()))
+            if k_i <= 0:
+                recommends.append([])
+                continue
+            part = np.argpartition(-sims[i], k_i - 1)[:k_i]
+            order = part[np.argsort(-sims[i][part], kind="stable")]
+            recommends.append([(self.titles[j], float(sims[i, j])) for j in order])
+
+        return recommends
+
+
+class LsaIndex:
+    """
+    Compact latent-semantic (truncated SVD) index for similarity search. Every book is stored as an L2-normalized float32 vector of n_components dimensions, so query cost no longer depends on the vocabulary size.
+    Optionally, the best candidates are re-ranked with the exact tf-idf cosine similarity.
+
+    Parameters
+    ----------
+    X : sparse.matrix
+        The tf-idf matrix (titles, tokens)
+    titles : iterable
+        The titles of the rows of X
+    n_components : int
+        Dimension of the embedding. Capped below the number of books and tokens.
+    random_state : int
+        Seed of the randomized SVD
+    """
+
+    @instrumentation.instrumented("search.lsa.build")
+    def __init__(self, X, titles, n_components = 100, random_state = 42):
+        self.X = normalize(sparse.csr_matrix(X), norm="l2")
+        self.titles = np.asarray(titles, dtype=object)
+        self.title_index = {title: i for i, title in enumerate(self.titles)}
+
+        n_components = max(1, min(n_components, min(self.X.shape) - 1))
+        self.svd = TruncatedSVD(n_components=n_components, random_state=random_state)
+
+        # Projections of the books, raw (to average reader profiles) and normalized (for cosine similarity)
+        self.projections = np.ascontiguousarray(self.svd.fit_transform(self.X), dtype=np.float32)
+        self.embeddings = np.ascontiguousarray(normalize(self.projections, norm="l2"), dtype=np.float32)
+
+
+    def indices(self, collection):
+        """ Rows of the titles in a collection. Raises ValueError for unknown titles, like similar_books(). """
+
+        try:
+            return [self.title_index[book] for book in collection]
+        except KeyError as e:
+            raise ValueError(f"{e.args[0]} is not in the corpus") from None
+
+
+    def recommend(self, collection, n, rerank = None):
+        """
+        Recommends the n books most similar to a collection, see recommend_batch()
+        """
+        return self.recommend_batch([collection], n, rerank)[0]
+
+
+    @instrumentation.instrumented("search.lsa.recommend_batch", units="collections")
+    def recommend_batch(self, collections, n, rerank = None):
+        """
+        Recommends books for many readers at once. A reader profile is the mean of the books in the collection, compared to all books by cosine similarity in the embedding space, excluding the books of the collection.
+
+        Parameters
+        ----------
+        collections : iterable
+            One iterable of titles per reader
+        n : int
+            Number of recommendations per reader
+        rerank : int or None
+            If given, this many candidates are taken from the embedding and re-ranked by exact tf-idf cosine similarity, as in similar_books()
+
+        Returns
+        -------
+        recommends : list
+            For every reader, a list of (title, cosine similarity) pairs in descending order of similarity
+        """
+
+        collections = [self.indices(collection) for collection in collections]
+        n_books = self.X.shape[0]
+
+        # Profiles as the mean of the raw projections, which equals the projection of the mean tf-idf vector
+        profiles = np.zeros((len(collections), self.projections.shape[1]), dtype=np.float32)
+        for i, collection in enumerate(collections):
+            if collection:
+                profiles[i] = self.projections[collection].mean(axis=0)
+        profiles = normalize(profiles, norm="l2")
+        sims = profiles @ self.embeddings.T
+
+        recommends = []
+        for i, collection in enumerate(collections):
+            sim = sims[i]
+            sim[collection] = -np.inf
+
+            k = min(n if rerank is None else max(n, rerank), n_books - len(set(collection)))
+            if k <= 0:
+                recommends.append([])
+                continue
+            candidates = np.argpartition(-sim, k - 1)[:k]
+
+            # Exact tf-idf cosine for the candidates only
+            if rerank is not None:
+                profile = normalize(sparse.csr_matrix(self.X[collection].mean(axis=0)), norm="l2") if collection else sparse.csr_matrix((1, self.X.shape[1]))
+                sim = np.zeros(n_books)
+                sim[candidates] = (self.X[candidates] @ profile.T).toarray().ravel()
 
+            order = candidates[np.argsort(-sim[candidates], kind="stable")][:n]
+            recommends.append([(self.titles[j], float(sim[j])) for j in order])
 
+        return recommends
 
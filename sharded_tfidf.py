@@ -0,0 +1,148 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.preprocessing import normalize
+import tfidf
+import instrumentation
+from hashing_tfidf import max_doc_count
+
+
+def split_shards(corpus, n_shards):
+    """ Splits a list of documents into n_shards contiguous slices of (nearly) equal length, keeping the document order """
+
+    bounds = np.linspace(0, len(corpus), n_shards + 1).astype(int)
+    return [corpus[start:end] for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+@instrumentation.instrumented("tfidf.shard_count", units="corpus")
+def count_shard(corpus, analyzer = tfidf.lemmatize, **analyze_kwargs):
+    """
+    Map step of sharded_tf_idf(): analyzes one shard of the corpus and counts its terms against a vocabulary local to the shard.
+
+    Parameters
+    ----------
+    corpus : list
+        The documents of the shard, in string format (or token lists, with analyzer=tfidf.pretokenized)
+    analyzer : function
+        Tokenization function, by default lemmatize
+    **analyze_kwargs
+        Passed on to tfidf.analyze_corpus(), e.g. batch_size or cache_dir
+
+    Returns
+    -------
+    counts : sparse.csr_matrix
+        Term counts (documents, terms) of the shard
+    terms : np.ndarray
+        The terms of the columns of counts, sorted
+    """
+
+    corpus_lemmas = corpus if analyzer is tfidf.pretokenized else tfidf.analyze_corpus(corpus, analyzer, **analyze_kwargs)
+
+    # Documents without any token give an empty vocabulary, which CountVectorizer refuses
+    if not any(len(lemmas) for lemmas in corpus_lemmas):
+        return sparse.csr_matrix((len(corpus_lemmas), 0), dtype=np.int64), np.array([], dtype=object)
+
+    vectorizer = CountVectorizer(analyzer=tfidf.pretokenized)
+    counts = vectorizer.fit_transform(corpus_lemmas)
+
+    return counts.tocsr(), vectorizer.get_feature_names_out()
+
+
+def _count_shard(args):
+    """ count_shard() with its arguments packed in one tuple, for executor.map """
+    corpus, analyzer, analyze_kwargs = args
+    return count_shard(corpus, analyzer, **analyze_kwargs)
+
+
+@instrumentation.instrumented("tfidf.shard_merge")
+def merge_shards(shards, max_df):
+    """
+    Reduce step of sharded_tf_idf(): merges the vocabularies of the shards, sums their document frequencies, applies max_df and computes the tf-idf matrix as TfidfVectorizer does (smoothed idf, l2 normalization).
+    The shards may have been counted anywhere, e.g. on other machines, as long as they are passed in corpus order.
+
+    Parameters
+    ----------
+    shards : iterable
+        (counts, terms) of every shard, as returned by count_shard()
+    max_df : float or int
+        Maximum document frequency allowed for each token, as in tfidf.tf_idf()
+
+    Returns
+    -------
+    X : sparse.matrix
+        The tf-idf matrix (titles, tokens) in sparse form
+    feature_names : np.ndarray
+        The unique tokens of the matrix, sorted like TfidfVectorizer.get_feature_names_out()
+    """
+
+    shards = list(shards)
+    terms = np.unique(np.concatenate([np.asarray(shard_terms, dtype=object) for _, shard_terms in shards])) if shards else np.array([], dtype=object)
+    if terms.size == 0:
+        raise ValueError("empty vocabulary; perhaps the documents only contain stop words")
+
+    # Renumber the local columns of every shard into the merged vocabulary, and stack the shards
+    blocks = []
+    for counts, shard_terms in shards:
+        counts = counts.tocsr()
+        columns = np.searchsorted(terms, np.asarray(shard_terms, dtype=object)) if len(shard_terms) else np.zeros(0, dtype=np.int64)
+        blocks.append(sparse.csr_matrix((counts.data, columns[counts.indices], counts.indptr), shape=(counts.shape[0], terms.size)))
+    counts = sparse.vstack(blocks, format="csr")
+    n_docs = counts.shape[0]
+
+    # Document frequencies over all shards, and the terms max_df keeps
+    df = np.bincount(counts.indices, minlength=terms.size)
+    keep = np.flatnonzero(df <= max_doc_count(max_df, n_docs))
+    if keep.size == 0:
+        raise ValueError("After pruning, no terms remain. Try a lower min_df or a higher max_df.")
+
+    X = counts[:, keep].astype(np.float64).tocsr()
+    X.sort_indices()
+    idf = np.log((1 + n_docs) / (1 + df[keep])) + 1
+    X.data *= idf[X.indices]
+
+    return normalize(X, copy=False), terms[keep]
+
+
+def sharded_tf_idf(corpus, max_df, analyzer = tfidf.lemmatize, n_workers = None, n_shards = None, **analyze_kwargs):
+    """
+    Multi-process version of tfidf.tf_idf(). The corpus is split into contiguous shards; every worker process analyzes and counts its shards (count_shard()), and the counts are merged into the tf-idf matrix (merge_shards()).
+    Gives the same (X, feature_names) as tf_idf() (up to floating point rounding).
+
+    Parameters
+    ----------
+    corpus : iterable
+        An iterable of all documents, in string format
+    max_df : float or int
+        Maximum document frequency allowed for each token
+    analyzer : function
+        Tokenization function, by default lemmatize. Must be a module level function, so that it can be sent to the workers.
+    n_workers : int or None
+        Number of worker processes, by default the number of cores. With 1, the shards are counted in this process.
+    n_shards : int or None
+        Number of shards, by default 4 per worker so that uneven shards (e.g. some very long books) are balanced out
+    **analyze_kwargs
+        Passed on to tfidf.analyze_corpus() in the workers, e.g. batch_size, cache_dir or chunk_size
+
+    Returns
+    -------
+    X : sparse.matrix
+        The tf-idf matrix (titles, tokens) in sparse form
+    feature_names : np.ndarray
+        An array of all the unique tokens in the matrix
+    """
+
+    corpus = list(corpus)
+    n_workers = n_workers or os.cpu_count() or 1
+    n_shards = n_shards or 4 * n_workers
+    tasks = [(shard, analyzer, analyze_kwargs) for shard in split_shards(corpus, n_shards)]
+
+    if n_workers == 1 or len(tasks) <= 1:
+        shards = [_count_shard(task) for task in tasks]
+    else:
+        # The spacy model is loaded once per worker, on its first shard
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            shards = list(executor.map(_count_shard, tasks))
+
+    return merge_shards(shards, max_df)
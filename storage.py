@@ -0,0 +1,312 @@
+import os
+import re
+import sqlite3
+from urllib.request import pathname2url
+
+
+# Table and column names are interpolated into queries, so only plain identifiers are accepted
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def check_identifier(name):
+    """ Raises ValueError for table or column names that are not plain identifiers """
+    if not IDENTIFIER.match(name):
+        raise ValueError(f"Invalid table or column name: {name!r}")
+    return name
+
+
+def connect(db_path = "books.db", readonly = False):
+    """
+    Opens a sqlite3 connection.
+    Writing connections (the default) create the file if needed and switch it to WAL mode, so readers (e.g. the analyzers) do not block the ingestion writes.
+    Read-only connections write nothing, so they also work on read-only files and mounts, and a mistyped path raises FileNotFoundError instead of creating an empty database.
+
+    Parameters
+    ----------
+    db_path : string
+        Path to the sql file
+    readonly : bool
+        Open the file with mode=ro
+
+    Returns
+    -------
+    conn : sqlite3.Connection
+    """
+
+    if readonly:
+        if not os.path.exists(db_path):
+            raise FileNotFoundError(f"No database at {db_path}")
+        return sqlite3.connect(f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro", uri=True)
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+
+    return conn
+
+
+def ensure_column(db_path, table, column, column_type = "TEXT"):
+    """ Adds a column to a table if it does not exist yet """
+
+    conn = connect(db_path)
+    try:
+        existing = [col[1] for col in conn.execute(f"PRAGMA table_info({check_identifier(table)});")]
+        if column not in existing:
+            with conn:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {check_identifier(column)} {column_type};")
+    finally:
+        conn.close()
+
+
+def iter_rows(db_path, table, columns, where = None, params = (), batch_size = 16):
+    """
+    Streams the selected columns of a table, fetching batch_size rows at a time instead of loading the whole table like tfidf.load_table().
+
+    Parameters
+    ----------
+    db_path : string
+        Path to the sql file
+    table : string
+        The table to read
+    columns : iterable
+        Names of the columns to select
+    where : string or None
+        Optional SQL condition, with ? placeholders for params
+    params : tuple
+        Values of the placeholders in where
+    batch_size : int
+        Number of rows fetched from sqlite at once
+
+    Yields
+    ------
+    row : tuple
+        The values of the selected columns, in order of book_id where the table has one
+    """
+
+    columns = [check_identifier(col) for col in columns]
+    query = f"SELECT {', '.join(columns)} FROM {check_identifier(table)}"
+    if where:
+        query += f" WHERE {where}"
+    query += " ORDER BY rowid;"
+
+    conn = connect(db_path, readonly=True)
+    try:
+        cursor = conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
+
+
+def load_columns(db_path, table, columns):
+    """
+    Like tfidf.load_table(), but only reads the given columns.
+
+    Returns
+    -------
+    sql_list : list
+        A list of all rows of the table, as dictionaries from column name to value
+    """
+
+    columns = list(columns)
+    return [dict(zip(columns, row)) for row in iter_rows(db_path, table, columns)]
+
+
+class SqlCorpus:
+    """
+    Re-iterable corpus of one text column of books.db, streamed from sqlite. Can be passed directly as the corpus argument of tfidf.tf_idf(). Rows where the column is NULL are skipped.
+
+    Parameters
+    ----------
+    db_path : string
+        Path to the sql file
+    column : string
+        The text column, e.g. "description" or "full_text"
+    table : string
+        The table to read
+    """
+
+    def __init__(self, db_path = "books.db", column = "description", table = "books"):
+        self.db_path = db_path
+        self.column = check_identifier(column)
+        self.table = check_identifier(table)
+
+    def __iter__(self):
+        for (text,) in iter_rows(self.db_path, self.table, [self.column], where=f"{self.column} IS NOT NULL"):
+            yield text
+
+    def __len__(self):
+        conn = connect(self.db_path, readonly=True)
+        try:
+            return conn.execute(f"SELECT COUNT(*) FROM {self.table} WHERE {self.column} IS NOT NULL;").fetchone()[0]
+        finally:
+            conn.close()
+
+    def titles(self):
+        """ The titles of the documents, in the order they are iterated """
+        return [title for (title,) in iter_rows(self.db_path, self.table, ["title"], where=f"{self.column} IS NOT NULL")]
+
+
+def update_column(db_path, table, column, key_column, items, batch_size = 100):
+    """
+    Sets one column for many rows with executemany, committing once per batch instead of once per row.
+
+    Parameters
+    ----------
+    db_path : string
+        Path to the sql file
+    table : string
+        The table to update
+    column : string
+        The column to set
+    key_column : string
+        The column identifying the rows, e.g. "title"
+    items : iterable
+        (key, value) pairs, e.g. (title, full_text). May be a generator; rows are written as batches fill up.
+    batch_size : int
+        Number of rows written per transaction
+
+    Returns
+    -------
+    n_rows : int
+        Number of (key, value) pairs written
+    """
+
+    query = f"UPDATE {check_identifier(table)} SET {check_identifier(column)}=? WHERE {check_identifier(key_column)}=?;"
+    conn = connect(db_path)
+    n_rows = 0
+    batch = []
+
+    # Every row is looked up by its key, e.g. books_title for the books table
+    with conn:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_{key_column} ON {table} ({key_column});")
+
+    def flush():
+        with conn:
+            conn.executemany(query, [(value, key) for key, value in batch])
+
+    try:
+        for key, value in items:
+            batch.append((key, value))
+            n_rows += 1
+            if len(batch) >= batch_size:
+                flush()
+                batch = []
+        if batch:
+            flush()
+    finally:
+        conn.close()
+
+    return n_rows
+
+
+# Columns of books covered by the full-text index, and the column indices used by snippet()
+FTS_COLUMNS = ("description", "full_text")
+
+
+def create_fts_index(db_path = "books.db"):
+    """
+    Creates the FTS5 full-text index books_fts over the description and full_text columns of books, and triggers that keep it in sync with every INSERT, UPDATE and DELETE on books.
+    An existing index is rebuilt from the current contents of books.
+
+    Parameters
+    ----------
+    db_path : string
+        Path to the sql file
+    """
+
+    for column in FTS_COLUMNS:
+        ensure_column(db_path, "books", column)
+
+    conn = connect(db_path)
+    try:
+        with conn:
+            # External content table: the texts are only stored once, in books
+            conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+                                title UNINDEXED, description, full_text,
+                                content='books', content_rowid='book_id', tokenize='porter unicode61');""")
+
+            conn.execute("""CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+                                INSERT INTO books_fts (rowid, title, description, full_text)
+                                VALUES (new.book_id, new.title, new.description, new.full_text);
+                            END;""")
+            conn.execute("""CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+                                INSERT INTO books_fts (books_fts, rowid, title, description, full_text)
+                                VALUES ('delete', old.book_id, old.title, old.description, old.full_text);
+                            END;""")
+            # Only changes to the indexed columns re-index a book, not e.g. full_text_path or status columns. Dropped first, so indexes made with the older catch-all trigger are upgraded.
+            conn.execute("DROP TRIGGER IF EXISTS books_fts_update;")
+            conn.execute("""CREATE TRIGGER books_fts_update AFTER UPDATE OF title, description, full_text ON books BEGIN
+                                INSERT INTO books_fts (books_fts, rowid, title, description, full_text)
+                                VALUES ('delete', old.book_id, old.title, old.description, old.full_text);
+                                INSERT INTO books_fts (rowid, title, description, full_text)
+                                VALUES (new.book_id, new.title, new.description, new.full_text);
+                            END;""")
+
+            conn.execute("INSERT INTO books_fts (books_fts) VALUES ('rebuild');")
+    finally:
+        conn.close()
+
+
+def fts_query(terms, mode = "or"):
+    """
+    Builds an FTS5 query string from plain terms, quoting every term so that FTS syntax characters in it are matched literally.
+
+    Parameters
+    ----------
+    terms : string or iterable
+        One term, or an iterable of terms
+    mode : string
+        "or" matches documents containing any term, "and" only documents containing all of them
+    """
+
+    if mode not in ("or", "and"):
+        raise ValueError(f"mode must be 'or' or 'and', not {mode}")
+    terms = [terms] if isinstance(terms, str) else list(terms)
+    quoted = ['"' + term.replace('"', '""') + '"' for term in terms if term.strip()]
+
+    return f" {mode.upper()} ".join(quoted)
+
+
+def fts_search(db_path, terms, mode = "or", limit = 10, column = "description", raw = False):
+    """
+    Searches the full-text index (see create_fts_index()) and ranks the hits by BM25.
+
+    Parameters
+    ----------
+    db_path : string
+        Path to the sql file
+    terms : string or iterable
+        The search terms. With raw, a complete FTS5 query string instead.
+    mode : string
+        "or" or "and", see fts_query()
+    limit : int
+        Maximum number of hits
+    column : string
+        The column a snippet is taken from, "description" or "full_text"
+    raw : bool
+        If True, terms is passed to FTS5 as it is, allowing phrase, prefix and NEAR queries
+
+    Returns
+    -------
+    hits : list
+        (title, score, snippet) tuples, best first. The score is the negated BM25 rank, so higher is better.
+    """
+
+    query = terms if raw else fts_query(terms, mode)
+    if not query:
+        return []
+    # Column 0 is the title, so the snippet column index is offset by one
+    snippet_col = FTS_COLUMNS.index(column) + 1
+
+    conn = connect(db_path, readonly=True)
+    try:
+        rows = conn.execute(f"""SELECT title, -bm25(books_fts), snippet(books_fts, {snippet_col}, '[', ']', '...', 12)
+                                FROM books_fts WHERE books_fts MATCH ? ORDER BY bm25(books_fts) LIMIT ?;""", (query, limit))
+        return rows.fetchall()
+    finally:
+        conn.close()
+
@@ -0,0 +1,101 @@
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import download_webpage
+
+
+class StubServer:
+    """
+    Local HTTP server answering every path from a list of canned (status, headers, body) responses, served in order with the last one repeated.
+    Records the time and headers of every request, and the highest number of requests handled at once.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self.delay = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub.lock:
+                    stub.active += 1
+                    stub.max_active = max(stub.max_active, stub.active)
+                    stub.requests.append((self.path, time.monotonic(), dict(self.headers)))
+                    path = self.path.split("?")[0]
+                    responses = stub.routes.get(path, [(404, {}, b"")])
+                    status, headers, body = responses.pop(0) if len(responses) > 1 else responses[0]
+                try:
+                    time.sleep(stub.delay)
+                    # Conditional requests get a 304 if the ETag still matches
+                    if "ETag" in headers and self.headers.get("If-None-Match") == headers["ETag"]:
+                        status, body = 304, b""
+                    self.send_response(status)
+                    headers = {"Content-Type": "text/html; charset=utf-8", **headers}
+                    for key, value in headers.items():
+                        self.send_header(key, value)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                finally:
+                    with stub.lock:
+                        stub.active -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.host = f"127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def route(self, path, *responses):
+        """ Sets the responses of a path, each a body or a (status, headers, body) tuple """
+        self.routes[path] = [r if isinstance(r, tuple) else (200, {}, r) for r in responses]
+
+    def url(self, path):
+        return f"http://{self.host}{path}"
+
+    def hits(self, path):
+        return sum(1 for p, _, _ in self.requests if p.split("?")[0] == path)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    server = StubServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture(autouse=True)
+def isolated_http(monkeypatch):
+    """ Every test starts without HTTP cache and with fresh per-host limiters """
+
+    monkeypatch.setattr(download_webpage, "HOST_LIMITS", dict(download_webpage.HOST_LIMITS))
+    download_webpage.configure_cache(None)
+    download_webpage._limiters.clear()
+    yield
+    download_webpage.configure_cache(None)
+    download_webpage._limiters.clear()
+
+
+@pytest.fixture
+def http_cache(tmp_path):
+    """ A fresh on-disk HTTP cache in a temporary directory """
+
+    download_webpage.configure_cache(str(tmp_path / "http_cache"))
+    return download_webpage.get_cache()
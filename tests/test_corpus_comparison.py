@@ -0,0 +1,32 @@
+import numpy as np
+from scipy import sparse
+import corpus_comparison
+import tfidf_store
+
+
+X = sparse.csr_matrix(np.array([[0.5, 0.1, 0.0], [0.0, 0.3, 0.2]]))
+FEATURES = ["sea", "ship", "whale"]
+
+
+def test_compare_models():
+    # The same scores, doubled and with the rows in another order
+    table, only_a, only_b = corpus_comparison.compare_models(X, FEATURES, ["A", "B"], 2 * X[[1, 0]], FEATURES, ["B", "A"], n=2)
+
+    assert list(table["title"]) == ["A", "B"]
+    assert np.allclose(table["cosine"], 1.0)
+    assert list(table["overlap"]) == [2, 2]
+    assert np.allclose(table["spearman"], 1.0)
+    assert only_a == only_b == []
+
+
+def test_no_shared_titles(tmp_path, capsys):
+    table, only_a, only_b = corpus_comparison.compare_models(X, FEATURES, ["A", "B"], X, FEATURES, ["C", "D"])
+
+    assert len(table) == 0
+    assert only_a == ["A", "B"] and only_b == ["C", "D"]
+
+    # main() prints the counts instead of crashing
+    tfidf_store.save_tfidf(str(tmp_path / "a"), X, FEATURES, ["A", "B"])
+    tfidf_store.save_tfidf(str(tmp_path / "b"), X, FEATURES, ["C", "D"])
+    assert corpus_comparison.main(["--summary", str(tmp_path / "a"), "--full-text", str(tmp_path / "b")]) == 0
+    assert "0 books in both" in capsys.readouterr().out
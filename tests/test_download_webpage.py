@@ -0,0 +1,143 @@
+import threading
+import time
+from contextlib import closing
+import download_webpage
+from download_webpage import fetch_concurrently, http_get, rate_limited_get, simple_get
+
+
+HTML = (200, {"Content-Type": "text/html; charset=utf-8"}, b"<html>ok</html>")
+
+
+def no_sleep(monkeypatch):
+    """ Replaces time.sleep with a recorder, returning the list of requested delays """
+
+    delays = []
+    monkeypatch.setattr(download_webpage.time, "sleep", lambda seconds: delays.append(seconds) if seconds > 0 else None)
+    return delays
+
+
+def test_rate_limit_per_host(stub_server):
+    download_webpage.HOST_LIMITS[stub_server.host] = {"rate": 10, "burst": 1, "max_concurrency": 4}
+    stub_server.route("/page", HTML)
+
+    for _ in range(6):
+        http_get(stub_server.url("/page"))
+
+    times = [t for _, t, _ in stub_server.requests]
+    # One token up front, then one every 0.1 seconds
+    assert times[-1] - times[0] >= 0.45
+
+
+def test_concurrency_cap(stub_server):
+    download_webpage.HOST_LIMITS[stub_server.host] = {"rate": 1000, "burst": 1000, "max_concurrency": 2}
+    stub_server.route("/slow", HTML)
+    stub_server.delay = 0.1
+
+    results = dict(fetch_concurrently(lambda url: http_get(url).status_code, [(stub_server.url("/slow"),)] * 8, max_workers=8))
+
+    assert list(results.values()) == [200] * 8
+    assert stub_server.max_active == 2
+
+
+def test_streamed_body_holds_host_slot(stub_server):
+    download_webpage.HOST_LIMITS[stub_server.host] = {"rate": 1000, "burst": 1000, "max_concurrency": 2}
+    stub_server.route("/text", (200, {"Content-Type": "text/plain"}, b"x" * 4096))
+    lock = threading.Lock()
+    reading = [0, 0]
+
+    def read_slowly(url):
+        with closing(rate_limited_get(url, stream=True, use_cache=False)) as resp:
+            with lock:
+                reading[0] += 1
+                reading[1] = max(reading[1], reading[0])
+            for _ in resp.iter_content(1024):
+                time.sleep(0.02)
+            with lock:
+                reading[0] -= 1
+        return resp.status_code
+
+    results = dict(fetch_concurrently(read_slowly, [(stub_server.url("/text"),)] * 6, max_workers=6))
+
+    assert list(results.values()) == [200] * 6
+    # Bodies are read while the response is open, so at most two at a time
+    assert reading[1] == 2
+
+
+def test_retry_after_429_and_503(stub_server, monkeypatch):
+    delays = no_sleep(monkeypatch)
+    stub_server.route("/flaky", (503, {}, b""), (429, {"Retry-After": "2"}, b""), HTML)
+
+    resp = rate_limited_get(stub_server.url("/flaky"), max_retries=3, backoff=1.0)
+
+    assert resp.status_code == 200
+    assert stub_server.hits("/flaky") == 3
+    # Exponential backoff with jitter after the 503, the requested delay after the 429
+    assert len(delays) == 2
+    assert 0.5 <= delays[0] <= 1.0
+    assert delays[1] == 2.0
+
+
+def test_streamed_retry_frees_host_slot(stub_server, monkeypatch):
+    no_sleep(monkeypatch)
+    download_webpage.HOST_LIMITS[stub_server.host] = {"rate": 1000, "burst": 1000, "max_concurrency": 1}
+    stub_server.route("/flaky", (503, {}, b""), HTML)
+
+    with closing(rate_limited_get(stub_server.url("/flaky"), stream=True, use_cache=False)) as resp:
+        assert resp.status_code == 200
+    # The slot is free again once the response is closed
+    assert http_get(stub_server.url("/flaky"), use_cache=False).status_code == 200
+
+
+def test_retries_give_up(stub_server, monkeypatch):
+    delays = no_sleep(monkeypatch)
+    stub_server.route("/down", (503, {}, b""))
+
+    resp = rate_limited_get(stub_server.url("/down"), max_retries=3, backoff=1.0)
+
+    assert resp.status_code == 503
+    assert stub_server.hits("/down") == 3
+    assert len(delays) == 2
+    assert 1.0 <= delays[1] <= 2.0
+
+
+def test_simple_get_backoff(stub_server, monkeypatch):
+    delays = no_sleep(monkeypatch)
+    stub_server.route("/page", (503, {}, b""), HTML)
+
+    assert simple_get(stub_server.url("/page")) == b"<html>ok</html>"
+    assert stub_server.hits("/page") == 2
+    assert len(delays) == 1 and 0.5 <= delays[0] <= 1.0
+
+
+def test_cache_hit(stub_server, http_cache):
+    stub_server.route("/page", HTML)
+
+    first = http_get(stub_server.url("/page"), params={"q": "a"})
+    second = http_get(stub_server.url("/page"), params={"q": "a"})
+    other = http_get(stub_server.url("/page"), params={"q": "b"})
+
+    assert first.content == second.content == other.content == b"<html>ok</html>"
+    assert second.headers["Content-Type"] == "text/html; charset=utf-8"
+    # The second request is answered from the cache, another query string is not
+    assert stub_server.hits("/page") == 2
+
+
+def test_cache_revalidation(stub_server, tmp_path):
+    download_webpage.configure_cache(str(tmp_path / "http_cache"), ttl=0)
+    stub_server.route("/page", (200, {"Content-Type": "text/html", "ETag": '"v1"'}, b"<html>v1</html>"))
+
+    http_get(stub_server.url("/page"))
+    resp = http_get(stub_server.url("/page"))
+
+    assert resp.status_code == 200 and resp.content == b"<html>v1</html>"
+    assert stub_server.hits("/page") == 2
+    assert stub_server.requests[-1][2].get("If-None-Match") == '"v1"'
+
+
+def test_no_cache(stub_server, http_cache):
+    stub_server.route("/page", HTML)
+
+    http_get(stub_server.url("/page"), use_cache=False)
+    http_get(stub_server.url("/page"), use_cache=False)
+
+    assert stub_server.hits("/page") == 2
@@ -0,0 +1,133 @@
+import sqlite3
+import pytest
+import ingestion
+from download_webpage import simple_get
+
+
+def page(body, etag = None):
+    headers = {"Content-Type": "text/html; charset=utf-8"}
+    if etag:
+        headers["ETag"] = etag
+    return (200, headers, body.encode("utf-8"))
+
+
+def stored_text(db_path, title):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT description FROM books WHERE title = ?;", (title,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def setup_books(db_path, titles):
+    ingestion.ensure_tables(db_path)
+    ingestion.add_books(titles, ["AUTHOR"] * len(titles), db_path)
+
+
+def test_due_refetch_sees_upstream_change(stub_server, http_cache, tmp_path):
+    db_path = str(tmp_path / "books.db")
+    setup_books(db_path, ["BOOK"])
+    stub_server.route("/book", page("<p>first</p>"))
+    fetch = lambda title: simple_get(stub_server.url("/book")).decode("utf-8")
+    arguments = {"BOOK": ("BOOK",)}
+
+    assert ingestion.ingest(fetch, arguments, "description", db_path)["changed"] == 1
+    ingestion.mark_clean(db_path, "description")
+
+    # Done books are not fetched again without max_age
+    assert ingestion.ingest(fetch, arguments, "description", db_path)["skipped"] == 1
+    assert stub_server.hits("/book") == 1
+
+    # The page changes upstream while the cached copy is still fresh
+    stub_server.route("/book", page("<p>second</p>"))
+    counts = ingestion.ingest(fetch, arguments, "description", db_path, max_age=0)
+
+    assert counts["changed"] == 1
+    assert stub_server.hits("/book") == 2
+    assert stored_text(db_path, "BOOK") == "<p>second</p>"
+    assert ingestion.dirty_titles(db_path, "description") == ["BOOK"]
+
+
+def test_due_refetch_revalidates_unchanged(stub_server, http_cache, tmp_path):
+    db_path = str(tmp_path / "books.db")
+    setup_books(db_path, ["BOOK"])
+    stub_server.route("/book", page("<p>same</p>", etag='"v1"'))
+    fetch = lambda title: simple_get(stub_server.url("/book")).decode("utf-8")
+    arguments = {"BOOK": ("BOOK",)}
+
+    ingestion.ingest(fetch, arguments, "description", db_path)
+    ingestion.mark_clean(db_path, "description")
+    counts = ingestion.ingest(fetch, arguments, "description", db_path, max_age=0)
+
+    # A conditional request is sent, the 304 keeps the text unchanged and clean
+    assert counts["unchanged"] == 1
+    assert stub_server.requests[-1][2].get("If-None-Match") == '"v1"'
+    assert ingestion.dirty_titles(db_path, "description") == []
+
+
+def test_resume_after_failure(tmp_path):
+    db_path = str(tmp_path / "books.db")
+    titles = [f"BOOK {i}" for i in range(4)]
+    setup_books(db_path, titles)
+    arguments = {title: (title,) for title in titles}
+    calls = []
+
+    def flaky(title):
+        calls.append(title)
+        if title == "BOOK 2":
+            raise RuntimeError("timeout")
+        return f"text of {title}"
+
+    counts = ingestion.ingest(flaky, arguments, "description", db_path, max_workers=1, batch_size=1)
+    assert counts["changed"] == 3 and counts["failed"] == 1
+
+    calls.clear()
+    counts = ingestion.ingest(lambda title: calls.append(title) or f"text of {title}", arguments, "description", db_path)
+    assert calls == ["BOOK 2"]
+    assert counts == {"changed": 1, "unchanged": 0, "missing": 0, "failed": 0, "skipped": 3}
+    assert ingestion.status(db_path)["description"]["done"] == 4
+
+
+
+def books_rows(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT book_id, title, author, description FROM books ORDER BY book_id;").fetchall()
+    finally:
+        conn.close()
+
+
+def test_record_and_replay_fixtures(stub_server, tmp_path, monkeypatch):
+    titles = ["MOBY-DICK", "EMMA"]
+    summaries = {"MOBY-DICK": "A sea captain hunts a whale.", "EMMA": "A young woman plays matchmaker."}
+    for title in titles:
+        stub_server.route(f"/book/{title}", page(summaries[title]))
+    arguments = {title: (title,) for title in titles}
+
+    def get_summary(title):
+        return simple_get(stub_server.url(f"/book/{title}")).decode("utf-8")
+
+    # Record against the stub server
+    recorded_db = str(tmp_path / "recorded.db")
+    setup_books(recorded_db, titles)
+    fixtures = str(tmp_path / "fixtures")
+    counts = ingestion.ingest(ingestion.Fixtures(fixtures, "record").wrap(get_summary), arguments, "description", recorded_db)
+    assert counts["changed"] == 2 and stub_server.hits("/book/EMMA") == 1
+
+    # Replay with the network blocked
+    stub_server.close()
+    monkeypatch.setattr("download_webpage.Session.get", lambda *args, **kwargs: pytest.fail("replay used the network"))
+    replayed_db = str(tmp_path / "replayed.db")
+    setup_books(replayed_db, titles)
+    counts = ingestion.ingest(ingestion.Fixtures(fixtures, "replay").wrap(get_summary), arguments, "description", replayed_db)
+
+    assert counts["changed"] == 2 and counts["failed"] == 0
+    assert books_rows(replayed_db) == books_rows(recorded_db)
+    assert [row[3] for row in books_rows(replayed_db)] == [summaries[title] for title in titles]
+
+
+def test_replay_unrecorded_call(tmp_path):
+    replay = ingestion.Fixtures(str(tmp_path), "replay").wrap(lambda title: title)
+
+    with pytest.raises(KeyError):
+        replay("UNKNOWN")
@@ -0,0 +1,108 @@
+import asyncio
+import json
+import numpy as np
+from scipy import sparse
+from query_service import QueryService, ServedModel
+
+
+def small_service():
+    X = sparse.csr_matrix(np.array([[0.5, 0.0, 0.2], [0.0, 0.7, 0.1], [0.3, 0.6, 0.0]]))
+    model = ServedModel("summary", X, ["whale", "ship", "sea"], ["MOBY DICK", "TREASURE ISLAND", "KIDNAPPED"])
+    return QueryService({"summary": model})
+
+
+async def send_all(service, requests):
+    """ Sends (method, target, body) requests at once, each on its own connection to a local server running service, returning their (status, answer) """
+
+    server = await asyncio.start_server(service.handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    async def send(method, target, body):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"{method} {target} HTTP/1.1\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        head, _, payload = response.partition(b"\r\n\r\n")
+        return int(head.split()[1]), json.loads(payload)
+
+    try:
+        return await asyncio.gather(*(send(*request) for request in requests))
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+def get(service, target):
+    return asyncio.run(send_all(service, [("GET", target, b"")]))[0]
+
+
+def recording(batcher):
+    """ Records the number of requests of every batch the batcher runs """
+
+    sizes = []
+    func = batcher.func
+
+    def recorded(items):
+        sizes.append(len(items))
+        return func(items)
+
+    batcher.func = recorded
+    return sizes
+
+
+def test_keywords():
+    status, answer = get(small_service(), "/keywords?model=summary&title=MOBY%20DICK&n=1")
+
+    assert status == 200
+    assert answer["keywords"] == [{"token": "whale", "score": 0.5}]
+
+
+def test_search():
+    status, answer = get(small_service(), "/search?model=summary&q=whale+sea&n=2")
+
+    assert status == 200
+    assert answer == {"model": "summary", "terms": ["whale", "sea"], "mode": "or",
+                      "results": [{"title": "MOBY DICK", "score": 0.7}, {"title": "KIDNAPPED", "score": 0.3}]}
+
+
+def test_recommend():
+    service = small_service()
+    status, answer = get(service, "/recommend?title=TREASURE%20ISLAND&n=1")
+    body = json.dumps({"model": "summary", "titles": ["TREASURE ISLAND"], "n": 1}).encode("utf-8")
+    posted = asyncio.run(send_all(service, [("POST", "/recommend", body)]))[0]
+
+    assert status == 200
+    assert answer["model"] == "summary" and answer["titles"] == ["TREASURE ISLAND"]
+    # The most similar other book, not the book itself
+    assert [result["title"] for result in answer["results"]] == ["KIDNAPPED"]
+    assert 0 < answer["results"][0]["similarity"] <= 1
+    assert posted == (status, answer)
+
+
+def test_concurrent_requests_share_a_batch():
+    service = small_service()
+    model = service.models["summary"]
+    # Long enough for all connections to arrive before the first batch is sent
+    model.search_batcher.max_delay = model.recommend_batcher.max_delay = 0.5
+    search_sizes = recording(model.search_batcher)
+    recommend_sizes = recording(model.recommend_batcher)
+
+    terms = ["whale", "ship", "sea", "whale+ship", "ship+sea", "whale+sea"]
+    searches = [("GET", f"/search?q={q}&n=3", b"") for q in terms]
+    recommendations = [("GET", f"/recommend?title={title}&n=2", b"") for title in ("MOBY%20DICK", "KIDNAPPED")]
+    answers = asyncio.run(send_all(service, searches + recommendations))
+
+    assert [status for status, _ in answers] == [200] * 8
+    assert search_sizes == [6]
+    assert recommend_sizes == [2]
+    # Every request gets the answer it would get on its own
+    for (_, target, _), (_, answer) in zip(searches + recommendations, answers):
+        assert get(small_service(), target)[1] == answer
+
+
+def test_repeated_model_is_bad_request():
+    status, answer = get(small_service(), "/keywords?model=summary&model=summary&title=MOBY%20DICK")
+
+    assert status == 400
+    assert answer["error"] == "Give exactly one model"
@@ -0,0 +1,77 @@
+import os
+import sqlite3
+import pytest
+import storage
+
+
+def make_books(db_path):
+    conn = storage.connect(db_path)
+    with conn:
+        conn.execute("CREATE TABLE books (book_id INTEGER, title TEXT, description TEXT, author TEXT, PRIMARY KEY(book_id));")
+        conn.executemany("INSERT INTO books (title, description) VALUES (?, ?);", [("MOBY DICK", "a whale of a tale"), ("ULYSSES", "a day in dublin")])
+    conn.close()
+    storage.create_fts_index(db_path)
+
+
+def test_fts_follows_indexed_columns(tmp_path):
+    db_path = str(tmp_path / "books.db")
+    make_books(db_path)
+
+    storage.update_column(db_path, "books", "description", "title", [("ULYSSES", "a whale in dublin")])
+
+    assert sorted(title for title, _, _ in storage.fts_search(db_path, "whale")) == ["MOBY DICK", "ULYSSES"]
+
+
+def test_fts_ignores_other_columns(tmp_path):
+    db_path = str(tmp_path / "books.db")
+    make_books(db_path)
+    storage.ensure_column(db_path, "books", "full_text_path")
+
+    conn = storage.connect(db_path)
+    try:
+        before = conn.total_changes
+        with conn:
+            conn.execute("UPDATE books SET full_text_path = 'texts/ulysses.txt.gz' WHERE title = 'ULYSSES';")
+        # Only the row itself changed, the trigger did not re-index the book
+        assert conn.total_changes - before == 1
+    finally:
+        conn.close()
+
+
+def test_reads_do_not_write(tmp_path):
+    db_path = str(tmp_path / "books.db")
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute("CREATE TABLE books (book_id INTEGER, title TEXT, description TEXT, PRIMARY KEY(book_id));")
+        conn.execute("INSERT INTO books (title, description) VALUES ('MOBY DICK', 'a whale of a tale');")
+    conn.close()
+    before = open(db_path, "rb").read()
+
+    assert list(storage.SqlCorpus(db_path, "description")) == ["a whale of a tale"]
+    assert len(storage.SqlCorpus(db_path, "description")) == 1
+
+    # Neither the journal mode nor the indexes changed
+    assert open(db_path, "rb").read() == before
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("PRAGMA journal_mode;").fetchone()[0] == "delete"
+    assert conn.execute("SELECT name FROM sqlite_master WHERE type = 'index';").fetchall() == []
+    conn.close()
+
+
+def test_read_missing_database(tmp_path):
+    db_path = str(tmp_path / "boks.db")
+
+    with pytest.raises(FileNotFoundError):
+        list(storage.iter_rows(db_path, "books", ["title"]))
+    assert not os.path.exists(db_path)
+
+
+def test_update_column_indexes_key(tmp_path):
+    db_path = str(tmp_path / "books.db")
+    make_books(db_path)
+
+    storage.update_column(db_path, "books", "description", "title", [("ULYSSES", "a day")])
+
+    conn = storage.connect(db_path, readonly=True)
+    assert conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'books_title';").fetchone()
+    conn.close()
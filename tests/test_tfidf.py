@@ -0,0 +1,54 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_fresh(script, seed, *args):
+    """
+    Runs a script in a new python process with its own hash seed, and returns the JSON it prints last.
+    The spacy model is replaced by a blank English pipeline, which is enough for the fingerprints and the caches.
+    """
+
+    setup = "import spacy, tfidf, instrumentation\ntfidf._nlp = spacy.blank('en')\n"
+    env = dict(os.environ, PYTHONHASHSEED=str(seed))
+    out = subprocess.run([sys.executable, "-c", setup + textwrap.dedent(script), *args], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True).stdout
+
+    return json.loads(out.strip().splitlines()[-1])
+
+
+FINGERPRINTS = """
+    import json
+    print(json.dumps([tfidf.analyzer_fingerprint(analyzer) for analyzer in
+                      (tfidf.lemmatize, tfidf.lemmatize_no_names, tfidf.doc_names, tfidf.lemmatize_fast_no_names)]))
+"""
+
+
+def test_fingerprints_match_across_processes():
+    first = run_fresh(FINGERPRINTS, 1)
+    second = run_fresh(FINGERPRINTS, 2)
+
+    assert first == second
+    assert len(set(first)) == 4
+
+
+GAZETTEER = """
+    import json, sys
+    instrumentation.enable()
+    doc = tfidf.get_nlp()("The captain met Ahab on the deck. Later Ahab walked with Starbuck.")
+    tfidf.book_gazetteer(doc, cache_dir=sys.argv[1])
+    tfidf.analyze_corpus(["A whale swam in the sea."], tfidf.lemmatize_fast_no_names, cache_dir=sys.argv[1])
+    print(json.dumps(instrumentation._stages.get("tfidf.build_gazetteer", {}).get("calls", 0)))
+"""
+
+
+def test_gazetteer_cache_hits_across_processes(tmp_path):
+    cache_dir = str(tmp_path / "lemma_cache")
+
+    # The first process builds the gazetteers of both documents, the second finds them and the lemmas in the cache
+    assert run_fresh(GAZETTEER, 1, cache_dir) == 2
+    assert run_fresh(GAZETTEER, 2, cache_dir) == 0
@@ -0,0 +1,151 @@
+import gzip
+import os
+from itertools import chain
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+START_MARKER = "START OF THE PROJECT GUTENBERG EBOOK"
+END_MARKER = "END OF THE PROJECT GUTENBERG EBOOK"
+
+
+def trim_gutenberg_stream(pieces, header_limit = 100_000):
+    """
+    Cuts off the Project Gutenberg header and license from a text as it streams in, like the slicing in scrape_gutenberg(), without holding the whole text in memory.
+    The result is stripped of leading and trailing whitespace. If no start marker occurs in the first header_limit characters, the text is kept from the beginning; without an end marker it is kept to the end.
+
+    Parameters
+    ----------
+    pieces : iterable
+        The decoded text, as consecutive string pieces
+    header_limit : int
+        Number of characters searched for the start marker
+
+    Yields
+    ------
+    piece : string
+        Consecutive pieces of the book body
+    """
+
+    pieces = iter(pieces)
+
+    # Find the start marker within the header, dropping everything up to and including it
+    buffer = ""
+    for piece in pieces:
+        buffer += piece
+        idx = buffer.find(START_MARKER)
+        if idx >= 0:
+            buffer = buffer[idx + len(START_MARKER):]
+            break
+        if len(buffer) > header_limit:
+            break
+
+    # Emit the body, holding back enough characters to spot an end marker split over two pieces
+    keep = len(END_MARKER) - 1
+    tail = ""
+    held = ""
+    leading = True
+    done = False
+    for piece in chain([buffer], pieces):
+        text = tail + piece
+        idx = text.find(END_MARKER)
+        if idx >= 0:
+            out, tail, done = text[:idx], "", True
+        elif len(text) > keep:
+            out, tail = text[:len(text) - keep], text[len(text) - keep:]
+        else:
+            out, tail = "", text
+        if not done and out == "":
+            continue
+
+        # Strip leading whitespace of the body, and hold back trailing whitespace until more text follows
+        if leading:
+            out = out.lstrip()
+            leading = not out
+        stripped = out.rstrip()
+        if stripped:
+            yield held + stripped
+            held = out[len(stripped):]
+        else:
+            held += out
+
+        if done:
+            return
+
+    # No end marker, the remaining tail is part of the body
+    out = tail.lstrip() if leading else tail
+    if out.rstrip():
+        yield held + out.rstrip()
+
+
+def open_text(path, mode = "r"):
+    """
+    Opens a text file for reading ("r") or writing ("w"), compressed according to its extension: .gz (gzip), .zst (zstandard, if installed), otherwise plain utf-8. Line endings are kept as they are.
+    """
+
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8", newline="")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError("Reading or writing .zst files requires the zstandard package")
+        return zstandard.open(path, mode + "t", encoding="utf-8", newline="")
+
+    return open(path, mode, encoding="utf-8", newline="")
+
+
+def write_text_stream(path, pieces):
+    """
+    Writes a streamed text to a (possibly compressed, see open_text()) file. The file only appears once it is complete.
+
+    Parameters
+    ----------
+    path : string
+        The file to write
+    pieces : iterable
+        The text, as consecutive string pieces
+
+    Returns
+    -------
+    n_chars : int
+        Number of characters written
+    """
+
+    # Keep the compression extension on the temporary file
+    head, tail = os.path.split(path)
+    tmp_path = os.path.join(head, f".tmp-{tail}")
+
+    n_chars = 0
+    with open_text(tmp_path, "w") as f:
+        for piece in pieces:
+            f.write(piece)
+            n_chars += len(piece)
+    os.replace(tmp_path, path)
+
+    return n_chars
+
+
+def read_text_stream(path, chunk_size = 1 << 16):
+    """
+    Reads a stored text in pieces of chunk_size characters, e.g. to feed tfidf.lemmatize_chunked() without loading the whole book.
+
+    Yields
+    ------
+    piece : string
+    """
+
+    with open_text(path, "r") as f:
+        while True:
+            piece = f.read(chunk_size)
+            if not piece:
+                return
+            yield piece
+
+
+def read_text(path):
+    """ Reads a whole stored text into one string """
+
+    with open_text(path, "r") as f:
+        return f.read()
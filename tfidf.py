@@ -4,19 +4,86 @@ from sklearn.feature_extraction.text import TfidfVectorizer
 from wordcloud import WordCloud
 import matplotlib.pyplot as plt
 import logging
+import hashlib
+import inspect
+import numpy as np
+import json
+from itertools import islice
 from IPython.display import display, HTML
+import lemma_cache
+import instrumentation
 
-nlp = spacy.load('en_core_web_sm')
-nlp.max_length = 2_100_000 
+MODEL_NAME = 'en_core_web_sm'
 
+# Only needed when parsing whole full texts at once, see lemmatize_chunked() for a streaming alternative
+MAX_LENGTH = 2_100_000
 
+# Number of documents looked up in the lemma cache at once. Documents are read from the corpus one block at a time, and the missing ones of a block are parsed together.
+CACHE_BLOCK = 1000
+
+# The spacy model is only loaded on first use, see get_nlp()
+_nlp = None
+
+
+def batches(iterable, batch_size):
+    """ Splits an iterable into lists of at most batch_size items, without reading ahead """
+
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def get_nlp():
+    """ Returns the spacy model, loading it on the first call """
+
+    global _nlp
+    if _nlp is None:
+        with instrumentation.stage("tfidf.load_model"):
+            _nlp = spacy.load(MODEL_NAME)
+        _nlp.max_length = MAX_LENGTH
+
+    return _nlp
+
+
+def __getattr__(name):
+    """ Keeps tfidf.nlp available as before, without loading the model at import time """
+    if name == "nlp":
+        return get_nlp()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def pipeline_profile(analyzer):
+    """ The pipeline components an analyzer does not need, to be passed as disable= to the spacy model (see PIPELINE_PROFILES) """
+    return PIPELINE_PROFILES.get(analyzer, [])
+
+
+@instrumentation.instrumented("tfidf.lemmatize", units="text")
 def lemmatize(text):
     """ Lemmatize a string text into list of lemmatized word tokens"""
 
-    lemmas = [] 
+    # Fit nlp model
+    doc = get_nlp()(text.strip(), disable=pipeline_profile(lemmatize))
+
+    return doc_lemmas(doc)
+
+
+@instrumentation.instrumented("tfidf.lemmatize_no_names", units="text")
+def lemmatize_no_names(text):
+    """ Lemmatize a string text into list of lemmatized word tokens, filtering out names"""
 
     # Fit nlp model
-    doc = nlp(text.strip())
+    doc = get_nlp()(text.strip(), disable=pipeline_profile(lemmatize_no_names))
+
+    return doc_lemmas_no_names(doc)
+
+
+def doc_lemmas(doc):
+    """ Filter an already parsed spacy Doc into a list of lemmatized word tokens. Used by lemmatize()."""
+
+    lemmas = [] 
 
     # Apply filters to remove unwanted tokens
     for token in doc:
@@ -27,16 +94,20 @@ def lemmatize(text):
     return lemmas
 
 
-def lemmatize_no_names(text):
-    """ Lemmatize a string text into list of lemmatized word tokens, filtering out names"""
+def doc_names(doc):
+    """ The set of lowercased PERSON entities of a parsed spacy Doc """
+    return {ent.text.lower() for ent in doc.ents if ent.label_ == "PERSON"}
 
-    lemmas = []
 
-    # Fit nlp model
-    doc = nlp(text.strip())
+def doc_lemmas_no_names(doc, names = None):
+    """ Filter an already parsed spacy Doc into a list of lemmatized word tokens, filtering out names. Used by lemmatize_no_names().
+    If names is given, it replaces the PERSON entities of the Doc itself (e.g. names collected over a whole book)."""
+
+    lemmas = []
 
     # Use doc.ents to create a set of named entities, and filter out tokens that are names
-    names = {ent.text.lower() for ent in doc.ents if ent.label_ == "PERSON"}
+    if names is None:
+        names = doc_names(doc)
 
     # Apply filters to remove unwanted tokens
     for token in doc:
@@ -47,7 +118,412 @@ def lemmatize_no_names(text):
     return lemmas
 
 
-def tf_idf(corpus, max_df, analyzer = lemmatize):
+# Settings of the fast name filter, see build_gazetteer()
+NAME_SAMPLES_PER_CANDIDATE = 3
+NAME_MAX_SAMPLES = 2000
+NAME_WINDOW = 12
+NAME_MIN_SHARE = 0.5
+NAME_MAX_LOWER_SHARE = 0.1
+
+# If set, the gazetteer of every book is cached in the lemma cache in this directory, see book_gazetteer()
+GAZETTEER_CACHE_DIR = None
+
+
+def name_candidates(doc):
+    """
+    Finds the words of a parsed Doc that could be names: words of three or more letters that are capitalized in the middle of a sentence, and almost never (at most NAME_MAX_LOWER_SHARE of their occurrences) written in lowercase.
+    Needs no entity recognizer, only the tokenizer.
+
+    Returns
+    -------
+    candidates : dict
+        Lowercased word -> token indices of its capitalized occurrences in the middle of a sentence
+    """
+
+    capitalized = {}
+    lowercase = {}
+    for token in doc:
+        text = token.text
+        if len(text) <= 2 or not text.isalpha():
+            continue
+        key = text.lower()
+        if text[0].isupper():
+            # Words after punctuation or a line break may be capitalized only because they start a sentence
+            initial = token.i == 0 or doc[token.i - 1].is_punct or doc[token.i - 1].is_space
+            if not initial and not token.is_stop:
+                capitalized.setdefault(key, []).append(token.i)
+        else:
+            lowercase[key] = lowercase.get(key, 0) + 1
+
+    return {key: positions for key, positions in capitalized.items()
+            if lowercase.get(key, 0) <= NAME_MAX_LOWER_SHARE * (len(positions) + lowercase.get(key, 0))}
+
+
+@instrumentation.instrumented("tfidf.build_gazetteer")
+def build_gazetteer(doc):
+    """
+    Builds the name gazetteer of a book without running the entity recognizer over the whole text. Only a few windows of NAME_WINDOW tokens around each name candidate (see name_candidates()) are passed through the entity recognizer, at most NAME_SAMPLES_PER_CANDIDATE per candidate, spread over the book, and at most NAME_MAX_SAMPLES in total (the most frequent candidates first).
+    A candidate is a name if it is part of a PERSON entity in at least NAME_MIN_SHARE of its sampled windows.
+
+    Parameters
+    ----------
+    doc : spacy.tokens.Doc
+        The book, parsed without entity recognizer
+
+    Returns
+    -------
+    names : set
+        The lowercased names of the book, to be used as the names argument of doc_lemmas_no_names()
+    """
+
+    candidates = sorted(name_candidates(doc).items(), key=lambda item: len(item[1]), reverse=True)
+
+    samples = []
+    for key, positions in candidates:
+        if len(positions) > NAME_SAMPLES_PER_CANDIDATE:
+            positions = [positions[i] for i in np.linspace(0, len(positions) - 1, NAME_SAMPLES_PER_CANDIDATE).astype(int)]
+        samples.extend((key, max(0, i - NAME_WINDOW), min(len(doc), i + NAME_WINDOW + 1), i) for i in positions)
+    samples = samples[:NAME_MAX_SAMPLES]
+
+    # Run the entity recognizer on the windows only, and check whether it tags the candidate token as (part of) a PERSON
+    windows = (doc[start:end].text for _, start, end, _ in samples)
+    votes = {}
+    for (key, start, _, i), window in zip(samples, get_nlp().pipe(windows, disable=pipeline_profile(build_gazetteer))):
+        offset = doc[i].idx - doc[start].idx
+        is_name = any(ent.label_ == "PERSON" and ent.start_char <= offset < ent.end_char for ent in window.ents)
+        named, total = votes.get(key, (0, 0))
+        votes[key] = (named + is_name, total + 1)
+
+    return {key for key, (named, total) in votes.items() if named > 0 and named >= NAME_MIN_SHARE * total}
+
+
+def gazetteer_fingerprint():
+    """ Identity of the gazetteer builder, the candidate search it uses and their settings, used to key cached gazetteers and the output of lemmatize_fast_no_names """
+
+    settings = [NAME_SAMPLES_PER_CANDIDATE, NAME_MAX_SAMPLES, NAME_WINDOW, NAME_MIN_SHARE, NAME_MAX_LOWER_SHARE]
+    return json.dumps({"builder": analyzer_fingerprint(build_gazetteer), "candidates": code_digest(name_candidates), "settings": settings}, sort_keys=True)
+
+
+def book_gazetteer(doc, cache_dir = None):
+    """
+    The name gazetteer of a parsed book (see build_gazetteer()), read from or written to the lemma cache in cache_dir (by default GAZETTEER_CACHE_DIR) if given, so it is only built once per book.
+    """
+
+    cache_dir = cache_dir or GAZETTEER_CACHE_DIR
+    if cache_dir is None:
+        return build_gazetteer(doc)
+
+    conn = lemma_cache.open_cache(cache_dir)
+    try:
+        key = lemma_cache.document_key(doc.text, gazetteer_fingerprint())
+        found = lemma_cache.get_lemmas(conn, [key])
+        if key in found:
+            return set(found[key])
+        names = build_gazetteer(doc)
+        lemma_cache.put_lemmas(conn, [(key, sorted(names))])
+    finally:
+        conn.close()
+
+    return names
+
+
+def doc_lemmas_fast_no_names(doc):
+    """ Filter a Doc parsed without entity recognizer into a list of lemmatized word tokens, filtering out the names of its gazetteer. Used by lemmatize_fast_no_names(). """
+    return doc_lemmas_no_names(doc, names=book_gazetteer(doc))
+
+
+@instrumentation.instrumented("tfidf.lemmatize_fast_no_names", units="text")
+def lemmatize_fast_no_names(text):
+    """
+    Faster alternative to lemmatize_no_names for long texts. The text is parsed without entity recognizer, and names are filtered with a gazetteer built from a sample of the text (see build_gazetteer()).
+    Only words that are consistently capitalized can be names, so a common word that the entity recognizer mis-tags somewhere is kept.
+    """
+
+    # Fit nlp model
+    doc = get_nlp()(text.strip(), disable=pipeline_profile(lemmatize_fast_no_names))
+
+    return doc_lemmas_fast_no_names(doc)
+
+
+# Maps every text analyzer to the function filtering its parsed Doc, so that a corpus can be parsed in batches
+DOC_FILTERS = {
+    lemmatize: doc_lemmas,
+    lemmatize_no_names: doc_lemmas_no_names,
+    lemmatize_fast_no_names: doc_lemmas_fast_no_names,
+}
+
+# Pipeline components each analyzer can skip. Lemmas only need the tagger, attribute ruler and lemmatizer,
+# and name detection additionally needs the entity recognizer. The dependency parser is never used.
+PIPELINE_PROFILES = {
+    lemmatize: ["parser", "ner"],
+    lemmatize_no_names: ["parser"],
+    doc_names: ["parser"],
+    lemmatize_fast_no_names: ["parser", "ner"],
+    # Entities only need the token vectors and the entity recognizer
+    build_gazetteer: ["tagger", "attribute_ruler", "lemmatizer", "parser"],
+}
+
+
+def lemmatize_corpus(corpus, analyzer = lemmatize, batch_size = 64, n_process = 1):
+    """
+    Lemmatize a whole corpus in batches with nlp.pipe. Yields exactly the same token lists, in the same order, as calling the analyzer on every document.
+
+    Parameters
+    ----------
+    corpus : iterable
+        An iterable of all documents, in string format
+    analyzer : function
+        Either lemmatize or lemmatize_no_names
+    batch_size : int
+        Number of documents spacy processes per batch
+    n_process : int
+        Number of worker processes spacy uses. -1 uses all cores.
+
+    Yields
+    ------
+    lemmas : list
+        The list of lemmatized word tokens for each document
+    """
+
+    if analyzer not in DOC_FILTERS:
+        raise ValueError(f"Batched lemmatization is not supported for analyzer {analyzer}")
+    doc_filter = DOC_FILTERS[analyzer]
+
+    # Parse the documents in batches, possibly over multiple processes, and filter each parsed Doc
+    texts = (text.strip() for text in corpus)
+    for doc in get_nlp().pipe(texts, batch_size=batch_size, n_process=n_process, disable=pipeline_profile(analyzer)):
+        yield doc_filter(doc)
+
+
+def split_text(text, chunk_size = 100_000):
+    """
+    Splits a text into chunks of at most chunk_size characters, cutting at paragraph boundaries where possible (then line breaks, then spaces).
+
+    Parameters
+    ----------
+    text : string or iterable
+        The document, either as one string or as an iterable of string pieces (e.g. a streamed download)
+    chunk_size : int
+        Maximum number of characters per chunk
+
+    Yields
+    ------
+    chunk : string
+        Consecutive pieces of the text. Whitespace-only chunks are skipped.
+    """
+
+    if isinstance(text, str):
+        pieces = (text[i:i + chunk_size] for i in range(0, len(text), chunk_size))
+    else:
+        pieces = text
+
+    buffer = ""
+    for piece in pieces:
+        buffer += piece
+
+        # Cut off full chunks, preferring the last paragraph break, line break or space within the chunk
+        while len(buffer) > chunk_size:
+            for sep in ("\n\n", "\n", " "):
+                cut = buffer.rfind(sep, 0, chunk_size)
+                if cut > 0:
+                    cut += len(sep)
+                    break
+            else:
+                cut = chunk_size
+
+            chunk, buffer = buffer[:cut], buffer[cut:]
+            if chunk.strip():
+                yield chunk
+
+    if buffer.strip():
+        yield buffer
+
+
+@instrumentation.instrumented("tfidf.lemmatize_chunked", units="text")
+def lemmatize_chunked(text, analyzer = lemmatize, chunk_size = 100_000, batch_size = 8, n_process = 1):
+    """
+    Streaming version of lemmatize / lemmatize_no_names for very long texts. The text is parsed chunk by chunk (see split_text()), so peak memory depends on chunk_size rather than on the length of the book.
+    For lemmatize_no_names, the PERSON entities of all chunks are merged into one set for the book before names are filtered out, as in the whole-document run.
+
+    Parameters
+    ----------
+    text : string or iterable
+        The document, either as one string or as an iterable of string pieces, e.g. text_storage.read_text_stream(path) for a stored full text
+    analyzer : function
+        Either lemmatize or lemmatize_no_names
+    chunk_size : int
+        Maximum number of characters parsed at once
+    batch_size : int
+        Number of chunks spacy processes per batch
+    n_process : int
+        Number of worker processes spacy uses for the chunks of this text
+
+    Returns
+    -------
+    lemmas : list
+        The list of lemmatized word tokens of the whole text
+    """
+
+    if analyzer not in DOC_FILTERS:
+        raise ValueError(f"Chunked lemmatization is not supported for analyzer {analyzer}")
+
+    lemmas = []
+    names = set()
+    chunks = (chunk.strip() for chunk in split_text(text, chunk_size))
+
+    # Only keep the filtered tokens (and names) of each chunk, never the parsed Docs
+    for doc in get_nlp().pipe(chunks, batch_size=batch_size, n_process=n_process, disable=pipeline_profile(analyzer)):
+        if analyzer is lemmatize_no_names:
+            names |= doc_names(doc)
+            lemmas.extend(doc_lemmas_no_names(doc, names=set()))
+        else:
+            lemmas.extend(DOC_FILTERS[analyzer](doc))
+
+    # Remove names found anywhere in the book
+    if names:
+        lemmas = [lemma for lemma in lemmas if lemma not in names]
+
+    return lemmas
+
+
+def pretokenized(lemmas):
+    """ Analyzer for documents that are already lists of tokens, e.g. the output of lemmatize_corpus() """
+    return lemmas
+
+
+def code_digest(*funcs):
+    """
+    Hash of the bytecode, names and constants of functions (not of the instrumentation wrappers around them), so editing any of them changes it. None entries are skipped.
+    Nested code objects (lambdas, comprehensions, inner functions) are hashed the same way instead of by their repr, which contains a memory address, and sets of constants in a fixed order, so the digest is the same in every process.
+    """
+
+    code_hash = hashlib.sha256()
+
+    def update(const):
+        if inspect.iscode(const):
+            code_hash.update(const.co_code)
+            code_hash.update(repr(const.co_names).encode("utf-8"))
+            update(const.co_consts)
+        elif isinstance(const, (tuple, frozenset)):
+            # Sets of constants (e.g. from "x in {...}") are ordered by hash, which differs between processes
+            items = const if isinstance(const, tuple) else sorted(const, key=repr)
+            code_hash.update(f"{type(const).__name__}:{len(items)}".encode("utf-8"))
+            for item in items:
+                update(item)
+        else:
+            code_hash.update(repr(const).encode("utf-8"))
+
+    for func in funcs:
+        func = inspect.unwrap(func) if func is not None else None
+        if func is not None and hasattr(func, "__code__"):
+            update(func.__code__)
+
+    return code_hash.hexdigest()
+
+
+def analyzer_fingerprint(analyzer, chunk_size = None):
+    """
+    Identity of an analyzer, used to key the lemma cache. Covers the analyzer and its token filter (by their bytecode, so editing a filter invalidates the cache), and the spacy model name, version and the pipeline components the analyzer runs.
+    For lemmatize_fast_no_names, it also covers the gazetteer (see gazetteer_fingerprint()).
+
+    Parameters
+    ----------
+    analyzer : function
+        Tokenization function, e.g. lemmatize or lemmatize_no_names
+    chunk_size : int or None
+        Chunk size used with lemmatize_chunked(), if any
+
+    Returns
+    -------
+    fingerprint : string
+        A string that changes whenever the analyzer output could change
+    """
+
+    nlp = get_nlp()
+    disabled = pipeline_profile(analyzer)
+    identity = {
+        "analyzer": f"{getattr(analyzer, '__module__', '')}.{getattr(analyzer, '__qualname__', repr(analyzer))}",
+        "code": code_digest(analyzer, DOC_FILTERS.get(analyzer)),
+        "model": nlp.meta.get("name"),
+        "model_version": nlp.meta.get("version"),
+        "spacy_version": spacy.__version__,
+        "pipeline": [name for name in nlp.pipe_names if name not in disabled],
+    }
+    if chunk_size is not None:
+        identity["chunk_size"] = chunk_size
+
+    # The fast name filter also depends on the name filter it delegates to, and on the gazetteer builder and its settings
+    if analyzer is lemmatize_fast_no_names:
+        identity["name_filter"] = code_digest(doc_lemmas_no_names)
+        identity["gazetteer"] = gazetteer_fingerprint()
+
+    return json.dumps(identity, sort_keys=True)
+
+
+@instrumentation.instrumented("tfidf.analyze_corpus", units="corpus")
+def analyze_corpus(corpus, analyzer = lemmatize, batch_size = None, n_process = 1, cache_dir = None, chunk_size = None):
+    """
+    Lemmatizes every document of a corpus, optionally in batches and through the on-disk lemma cache.
+
+    Parameters
+    ----------
+    corpus : iterable
+        An iterable of all documents, in string format
+    analyzer : function
+        Tokenization function, by default lemmatize
+    batch_size : int or None
+        If given, documents are parsed in batches through nlp.pipe (see lemmatize_corpus())
+    n_process : int
+        Number of worker processes for batched lemmatization
+    cache_dir : string or None
+        If given, token lists are read from and written to the lemma cache in this directory. Only documents not in the cache are parsed.
+    chunk_size : int or None
+        If given, every document is parsed in chunks of at most this many characters (see lemmatize_chunked())
+
+    Returns
+    -------
+    corpus_lemmas : list
+        The list of tokens of every document, in corpus order
+    """
+
+    batched = (batch_size is not None or n_process != 1) and analyzer in DOC_FILTERS
+
+    def run(texts):
+        if chunk_size is not None:
+            return [lemmatize_chunked(text, analyzer, chunk_size, batch_size or 8, n_process) for text in texts]
+        if batched:
+            return list(lemmatize_corpus(texts, analyzer, batch_size or 64, n_process))
+        return [analyzer(text) for text in texts]
+
+    # The corpus is read once and lazily, so a streamed corpus (e.g. storage.SqlCorpus) is never held in memory as a whole
+    if cache_dir is None:
+        return run(corpus)
+
+    # Look up the documents block by block by content address, and only parse the missing ones
+    conn = lemma_cache.open_cache(cache_dir)
+    corpus_lemmas = []
+    try:
+        fingerprint = analyzer_fingerprint(analyzer, chunk_size)
+        for texts in batches(corpus, CACHE_BLOCK):
+            keys = [lemma_cache.document_key(text, fingerprint) for text in texts]
+            found = lemma_cache.get_lemmas(conn, set(keys))
+
+            missing = list({key: text for key, text in zip(keys, texts) if key not in found}.items())
+            if missing:
+                parsed = run([text for _, text in missing])
+                new = {key: lemmas for (key, _), lemmas in zip(missing, parsed)}
+                lemma_cache.put_lemmas(conn, new.items())
+                found.update(new)
+
+            corpus_lemmas.extend(found[key] for key in keys)
+    finally:
+        conn.close()
+
+    return corpus_lemmas
+
+
+@instrumentation.instrumented("tfidf.tf_idf", units="corpus")
+def tf_idf(corpus, max_df, analyzer = lemmatize, batch_size = None, n_process = 1, cache_dir = None, chunk_size = None):
     """
     Creates a documents/token matrix of tf-idf scores. 
     
@@ -57,6 +533,16 @@ def tf_idf(corpus, max_df, analyzer = lemmatize):
         An iterable of all documents, in string format
     max_df : float
         Maximum document frequency allowed for each token    
+    analyzer : function
+        Tokenization function, by default lemmatize
+    batch_size : int or None
+        If given, the corpus is lemmatized in batches of this size through nlp.pipe (see lemmatize_corpus()). The resulting matrix is identical.
+    n_process : int
+        Number of worker processes for batched lemmatization. -1 uses all cores. Setting it other than 1 also enables batching.
+    cache_dir : string or None
+        If given, lemmatized documents are cached on disk in this directory, so unchanged documents are never parsed twice (see analyze_corpus())
+    chunk_size : int or None
+        If given, long documents are parsed in chunks of at most this many characters, bounding peak memory (see lemmatize_chunked())
 
     Returns
     -------
@@ -65,20 +551,224 @@ def tf_idf(corpus, max_df, analyzer = lemmatize):
     feature_names : iterable
         An iterable of all the unique tokens in the matrix
     """
+
+    # Lemmatize the corpus up front (batched and/or cached) and hand the token lists to the vectorizer
+    if batch_size is not None or n_process != 1 or cache_dir is not None or chunk_size is not None:
+        corpus = analyze_corpus(corpus, analyzer, batch_size, n_process, cache_dir, chunk_size)
+        analyzer = pretokenized
     
     # Instantiate the Vectorizer, specifying the tokenization function and max_df
     vectorizer = TfidfVectorizer(analyzer = analyzer, max_df=max_df)
 
     # Create Bag of Words, and compute tf-idf for each token in each document, and extract unique tokens
-    X = vectorizer.fit_transform(corpus)
-    feature_names = vectorizer.get_feature_names_out()
+    with instrumentation.stage("tfidf.vectorize"):
+        X = vectorizer.fit_transform(corpus)
+        feature_names = vectorizer.get_feature_names_out()
     
     return X, feature_names
 
 
+def merge_lemmas_both(docs):
+    """
+    Filters the parsed Docs of one document (a single Doc, or its chunks) into both token streams at once.
+
+    Parameters
+    ----------
+    docs : iterable
+        Parsed spacy Docs, all belonging to the same document
+
+    Returns
+    -------
+    lemmas : list
+        Tokens as returned by lemmatize()
+    lemmas_no_names : list
+        Tokens as returned by lemmatize_no_names()
+    names : set
+        The PERSON entities of the document, lowercased and with whitespace normalized
+    """
+
+    lemmas = []
+    candidates = []
+    names = set()
+
+    # Collect the names of all Docs before removing them, as in lemmatize_chunked()
+    for doc in docs:
+        names |= doc_names(doc)
+        lemmas.extend(doc_lemmas(doc))
+        candidates.extend(doc_lemmas_no_names(doc, names=set()))
+
+    lemmas_no_names = [lemma for lemma in candidates if lemma not in names]
+    names = {" ".join(name.split()) for name in names}
+
+    return lemmas, lemmas_no_names, names
+
+
+@instrumentation.instrumented("tfidf.lemmatize_both", units="text")
+def lemmatize_both(text, chunk_size = None):
+    """
+    Lemmatizes a text with and without names from a single parse. Equivalent to calling lemmatize() and lemmatize_no_names() (or lemmatize_chunked() with both, if chunk_size is given).
+
+    Parameters
+    ----------
+    text : string
+        The document
+    chunk_size : int or None
+        If given, the text is parsed in chunks of at most this many characters
+
+    Returns
+    -------
+    lemmas, lemmas_no_names, names
+        See merge_lemmas_both()
+    """
+
+    nlp = get_nlp()
+    disable = pipeline_profile(lemmatize_no_names)
+
+    if chunk_size is None:
+        docs = [nlp(text.strip(), disable=disable)]
+    else:
+        docs = nlp.pipe((chunk.strip() for chunk in split_text(text, chunk_size)), disable=disable)
+
+    return merge_lemmas_both(docs)
+
+
+def lemmatize_corpus_both(corpus, batch_size = 64, n_process = 1, chunk_size = None):
+    """
+    Batched version of lemmatize_both() over a whole corpus, parsing every document only once.
+
+    Parameters
+    ----------
+    corpus : iterable
+        An iterable of all documents, in string format
+    batch_size : int
+        Number of documents (or chunks, with chunk_size) spacy processes per batch
+    n_process : int
+        Number of worker processes spacy uses. -1 uses all cores.
+    chunk_size : int or None
+        If given, every document is parsed in chunks of at most this many characters
+
+    Yields
+    ------
+    lemmas, lemmas_no_names, names
+        For each document in corpus order, see merge_lemmas_both()
+    """
+
+    nlp = get_nlp()
+    disable = pipeline_profile(lemmatize_no_names)
+
+    if chunk_size is not None:
+        for text in corpus:
+            chunks = (chunk.strip() for chunk in split_text(text, chunk_size))
+            yield merge_lemmas_both(nlp.pipe(chunks, batch_size=batch_size, n_process=n_process, disable=disable))
+    else:
+        texts = (text.strip() for text in corpus)
+        for doc in nlp.pipe(texts, batch_size=batch_size, n_process=n_process, disable=disable):
+            yield merge_lemmas_both([doc])
+
+
+@instrumentation.instrumented("tfidf.analyze_corpus_both", units="corpus")
+def analyze_corpus_both(corpus, batch_size = None, n_process = 1, cache_dir = None, chunk_size = None):
+    """
+    Like analyze_corpus(), but produces the tokens of lemmatize and lemmatize_no_names (and the names) from one parse per document. The lemma cache is shared with analyze_corpus().
+
+    Parameters
+    ----------
+    corpus : iterable
+        An iterable of all documents, in string format
+    batch_size : int or None
+        Number of documents spacy processes per batch
+    n_process : int
+        Number of worker processes spacy uses
+    cache_dir : string or None
+        If given, the lemma cache directory. Only documents missing any of the three outputs are parsed.
+    chunk_size : int or None
+        If given, every document is parsed in chunks of at most this many characters
+
+    Returns
+    -------
+    corpus_lemmas : list
+        Tokens of every document, as with lemmatize
+    corpus_lemmas_no_names : list
+        Tokens of every document, as with lemmatize_no_names
+    corpus_names : list
+        The set of names of every document
+    """
+
+    def run(texts):
+        return list(lemmatize_corpus_both(texts, batch_size or 64, n_process, chunk_size))
+
+    if cache_dir is None:
+        results = run(corpus)
+        return tuple(list(column) for column in zip(*results)) if results else ([], [], [])
+
+    # Every output is cached under the fingerprint of its own analyzer, so single-analyzer runs can reuse it. As in analyze_corpus(), the corpus is read lazily, block by block.
+    conn = lemma_cache.open_cache(cache_dir)
+    corpus_lemmas, corpus_lemmas_no_names, corpus_names = [], [], []
+    try:
+        fingerprints = [analyzer_fingerprint(func, chunk_size) for func in (lemmatize, lemmatize_no_names, doc_names)]
+        for texts in batches(corpus, CACHE_BLOCK):
+            keys = [[lemma_cache.document_key(text, fingerprint) for fingerprint in fingerprints] for text in texts]
+            found = lemma_cache.get_lemmas(conn, {key for doc_keys in keys for key in doc_keys})
+
+            missing = list({tuple(doc_keys): text for doc_keys, text in zip(keys, texts) if any(key not in found for key in doc_keys)}.items())
+            if missing:
+                new = {}
+                for (doc_keys, _), (lemmas, lemmas_no_names, names) in zip(missing, run([text for _, text in missing])):
+                    new.update(zip(doc_keys, (lemmas, lemmas_no_names, sorted(names))))
+                lemma_cache.put_lemmas(conn, new.items())
+                found.update(new)
+
+            corpus_lemmas.extend(found[doc_keys[0]] for doc_keys in keys)
+            corpus_lemmas_no_names.extend(found[doc_keys[1]] for doc_keys in keys)
+            corpus_names.extend(set(found[doc_keys[2]]) for doc_keys in keys)
+    finally:
+        conn.close()
+
+    return corpus_lemmas, corpus_lemmas_no_names, corpus_names
+
+
+@instrumentation.instrumented("tfidf.tf_idf_both", units="corpus")
+def tf_idf_both(corpus, max_df, batch_size = None, n_process = 1, cache_dir = None, chunk_size = None, return_names = False):
+    """
+    Creates the tf-idf matrices with and without names from a single analysis run. Gives the same results as calling tf_idf() with lemmatize and with lemmatize_no_names, at the cost of one parse per document.
+
+    Parameters
+    ----------
+    corpus : iterable
+        An iterable of all documents, in string format
+    max_df : float
+        Maximum document frequency allowed for each token
+    batch_size, n_process, cache_dir, chunk_size
+        See tf_idf()
+    return_names : bool
+        If True, additionally return the list of name sets of every document
+
+    Returns
+    -------
+    (X, feature_names) : tuple
+        The tf-idf matrix and tokens, including names
+    (X_no_names, feature_names_no_names) : tuple
+        The tf-idf matrix and tokens, excluding names
+    names : list
+        Only if return_names. The set of names found in every document.
+    """
+
+    corpus_lemmas, corpus_lemmas_no_names, corpus_names = analyze_corpus_both(corpus, batch_size, n_process, cache_dir, chunk_size)
+
+    # Build both matrices from the token lists
+    results = (
+        tf_idf(corpus_lemmas, max_df, analyzer = pretokenized),
+        tf_idf(corpus_lemmas_no_names, max_df, analyzer = pretokenized),
+    )
+
+    if return_names:
+        return results + (corpus_names,)
+    return results
+
+
 def load_table(sql_datapath, table_name):
     """
-    Loads sql database into list of dictionaries
+    Loads sql database into list of dictionaries. To read only some columns, or to stream documents, see the module storage.
     
     Parameters
     ----------
@@ -137,9 +827,11 @@ def scroll_df(df, height = '500px'):
 
 
 
+@instrumentation.instrumented("tfidf.max_row", units="df")
 def max_row(df, n, index = False):
     """
     Takes a TF-IDF dataframe(!) and outputs a Series of lists. Each list contains n tokens with the highest TF-IDF scores for the book that the list belongs to. 
+    For large vocabularies, prefer top_n(), which works on the sparse matrix directly.
 
     Parameters:
     -----------
@@ -169,6 +861,86 @@ def max_row(df, n, index = False):
     return df_max
 
 
+@instrumentation.instrumented("tfidf.top_n")
+def top_n(X, feature_names, n):
+    """
+    Sparse alternative to max_row(). Takes the TF-IDF matrix from tf_idf() directly and finds the n tokens with the highest TF-IDF scores of every book, using a partial selection on the non-zeros of each row.
+    Memory is proportional to the number of non-zeros rather than books x tokens.
+
+    Parameters
+    ----------
+    X : sparse.matrix
+        TF-IDF matrix (books, tokens)
+    feature_names : iterable
+        The tokens of the columns of X
+    n : int
+        Number of keywords for each book
+
+    Returns
+    -------
+    tokens : np.ndarray
+        Array (books, n) of keywords, in descending order of TF-IDF. Books with fewer than n non-zero tokens are padded with empty strings.
+    scores : np.ndarray
+        Array (books, n) of the matching TF-IDF values, padded with 0.
+    """
+
+    feature_names = np.asarray(feature_names, dtype=object)
+    cols, scores = top_n_columns(X, n)
+    tokens = np.where(cols >= 0, feature_names[np.maximum(cols, 0)] if feature_names.size else "", "")
+
+    return tokens, scores
+
+
+def top_n_columns(X, n):
+    """
+    The columns of the n highest TF-IDF scores of every book, see top_n().
+
+    Returns
+    -------
+    cols : np.ndarray
+        Array (books, n) of column indices, in descending order of TF-IDF, padded with -1
+    scores : np.ndarray
+        Array (books, n) of the matching TF-IDF values, padded with 0
+    """
+
+    X = X.tocsr()
+    n_books = X.shape[0]
+
+    cols = np.full((n_books, n), -1, dtype=np.int64)
+    scores = np.zeros((n_books, n), dtype=X.dtype)
+
+    for row in range(n_books):
+        start, end = X.indptr[row], X.indptr[row + 1]
+        data = X.data[start:end]
+        indices = X.indices[start:end]
+
+        # Select the k largest values (keeping all ties with the k-th), then sort them by descending value with ties by column, as nlargest does
+        k = min(n, data.size)
+        if k == 0:
+            continue
+        if k < data.size:
+            kth = -np.partition(-data, k - 1)[k - 1]
+            part = np.flatnonzero(data >= kth)
+        else:
+            part = np.arange(data.size)
+        order = part[np.lexsort((indices[part], -data[part]))][:k]
+
+        cols[row, :k] = indices[order]
+        scores[row, :k] = data[order]
+
+    return cols, scores
+
+
+def title_rows(titles):
+    """ Maps every title to its row, like list(titles).index(title) (the first occurrence) but built once for all lookups """
+
+    rows = {}
+    for row, title in enumerate(titles):
+        rows.setdefault(title, row)
+
+    return rows
+
+
 def create_wordcloud(top_15_tokens, top_15_tfidf, titles, selection):
 
     """
@@ -190,9 +962,10 @@ def create_wordcloud(top_15_tokens, top_15_tfidf, titles, selection):
     # Instantiate wordcloud object
     wordcloud = WordCloud(background_color="white", width=1000, height=500, random_state=42)
 
-    # Plot wordclouds for every title selected
+    # Plot wordclouds for every title selected. To render many clouds to files, see wordclouds.render_wordclouds()
+    rows = title_rows(titles)
     for title in selection:
-        idx = list(titles).index(title)
+        idx = rows[title]
         tokens = top_15_tokens[idx]
         tfidf = top_15_tfidf[idx]
 
@@ -235,12 +1008,14 @@ def compare_wordclouds(summary_tokens, summary_tfidf, full_tokens, full_tfidf, s
     wc1 = WordCloud(background_color="white", width=1000, height=500, random_state=42)
     wc2 = WordCloud(background_color="white", width=1000, height=500, random_state=42)
 
-    # For each selected title, generate wordclouds
+    # For each selected title, generate wordclouds. To render many comparisons to files, see wordclouds.render_comparisons()
+    summary_rows = title_rows(summary_titles)
+    full_rows = title_rows(full_titles)
     for title in selection:
         try:
             # Extract title indices and select respective tokens and tf-idf scores
-            sum_idx = list(summary_titles).index(title)
-            full_idx = list(full_titles).index(title)
+            sum_idx = summary_rows[title]
+            full_idx = full_rows[title]
             select_sum_tokens = summary_tokens[sum_idx]
             select_sum_tfidf = summary_tfidf[sum_idx]
             select_full_tokens = full_tokens[full_idx]
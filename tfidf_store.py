@@ -0,0 +1,200 @@
+import json
+import os
+import pickle
+import shutil
+import numpy as np
+import scipy
+import sklearn
+from scipy import sparse
+import storage
+
+
+# Increase whenever the layout of the directory changes. load_tfidf() refuses newer versions.
+FORMAT_VERSION = 1
+META_FILE = "meta.json"
+
+
+def save_strings(path, name, strings):
+    """ Stores strings as one utf-8 byte buffer plus offsets, so they can be memory-mapped """
+
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+
+    np.save(os.path.join(path, f"{name}.bytes.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+    np.save(os.path.join(path, f"{name}.offsets.npy"), offsets)
+
+
+def load_strings(path, name):
+    """ Inverse of save_strings(), returns an object array like TfidfVectorizer.get_feature_names_out() """
+
+    blob = np.load(os.path.join(path, f"{name}.bytes.npy")).tobytes()
+    offsets = np.load(os.path.join(path, f"{name}.offsets.npy"))
+
+    return np.array([blob[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)], dtype=object)
+
+
+def save_tfidf(path, X, feature_names, titles = None, params = None, formats = ("csr", "csc")):
+    """
+    Saves the output of tfidf.tf_idf() as a versioned directory of .npy arrays and a json metadata file.
+
+    Parameters
+    ----------
+    path : string
+        Directory to write. An existing directory at this path is replaced.
+    X : sparse.matrix
+        The tf-idf matrix (titles, tokens)
+    feature_names : iterable
+        The tokens of the columns of X
+    titles : iterable or None
+        The titles of the rows of X
+    params : dict or None
+        Parameters the matrix was computed with, e.g. {"max_df": 0.8, "analyzer": "lemmatize"}. Must be json serializable.
+    formats : tuple
+        Sparse layouts to store, "csr" for row (book) access and/or "csc" for column (token) access
+    """
+
+    if X.shape[1] != len(feature_names):
+        raise ValueError(f"X has {X.shape[1]} columns but there are {len(feature_names)} feature names")
+    if titles is not None and X.shape[0] != len(titles):
+        raise ValueError(f"X has {X.shape[0]} rows but there are {len(titles)} titles")
+
+    # Write into a temporary directory first, so a crash never leaves a half written model behind
+    tmp_path = f"{path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    for fmt in formats:
+        mat = X.tocsr() if fmt == "csr" else X.tocsc() if fmt == "csc" else None
+        if mat is None:
+            raise ValueError(f"Unknown sparse format {fmt}")
+        mat.sort_indices()
+        for name in ("data", "indices", "indptr"):
+            np.save(os.path.join(tmp_path, f"{fmt}.{name}.npy"), getattr(mat, name))
+
+    save_strings(tmp_path, "feature_names", [str(f) for f in feature_names])
+    if titles is not None:
+        save_strings(tmp_path, "titles", [str(t) for t in titles])
+
+    write_meta(tmp_path, X.shape, X.nnz, formats, titles is not None, params)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def write_meta(path, shape, nnz, formats, has_titles, params = None):
+    """ Writes the metadata file of a stored model, see save_tfidf() """
+
+    meta = {
+        "format_version": FORMAT_VERSION,
+        "shape": [int(n) for n in shape],
+        "nnz": int(nnz),
+        "formats": list(formats),
+        "has_titles": has_titles,
+        "params": params or {},
+        "versions": {"numpy": np.__version__, "scipy": scipy.__version__, "sklearn": sklearn.__version__},
+    }
+    with open(os.path.join(path, META_FILE), "w") as f:
+        json.dump(meta, f, indent=2)
+
+
+def load_meta(path):
+    """ Reads the metadata of a stored model, checking its format version """
+
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+
+    if meta.get("format_version", 0) > FORMAT_VERSION:
+        raise ValueError(f"{path} has format version {meta['format_version']}, this code reads up to version {FORMAT_VERSION}")
+
+    return meta
+
+
+def load_tfidf(path, fmt = "csr", mmap = True):
+    """
+    Opens a model stored with save_tfidf(). With mmap, the numeric arrays are memory-mapped read-only, so opening is near-instant and only the rows/columns that are accessed are read from disk.
+
+    Parameters
+    ----------
+    path : string
+        Directory written by save_tfidf()
+    fmt : string
+        Which stored layout to open, "csr" or "csc"
+    mmap : bool
+        If False, the arrays are read fully into memory
+
+    Returns
+    -------
+    X : sparse.matrix
+        The tf-idf matrix (titles, tokens), in the requested layout
+    feature_names : np.ndarray
+        The tokens of the columns of X
+    titles : np.ndarray or None
+        The titles of the rows of X, if they were stored
+    params : dict
+        The parameters stored with the model
+    """
+
+    meta = load_meta(path)
+    if fmt not in meta["formats"]:
+        raise ValueError(f"{path} does not contain the {fmt} layout, only {meta['formats']}")
+
+    mmap_mode = "r" if mmap else None
+    data, indices, indptr = (np.load(os.path.join(path, f"{fmt}.{name}.npy"), mmap_mode=mmap_mode) for name in ("data", "indices", "indptr"))
+
+    matrix_class = sparse.csr_matrix if fmt == "csr" else sparse.csc_matrix
+    X = matrix_class((data, indices, indptr), shape=tuple(meta["shape"]), copy=False)
+
+    feature_names = load_strings(path, "feature_names")
+    titles = load_strings(path, "titles") if meta["has_titles"] else None
+
+    return X, feature_names, titles, meta["params"]
+
+
+def convert_pickle(pickle_path, path, titles = None, params = None):
+    """
+    Converts one of the (X, feature_names) pickles in data/ into the stored model format.
+
+    Parameters
+    ----------
+    pickle_path : string
+        Path to the pickle file, e.g. "data/summary_results_1.pkl"
+    path : string
+        Directory to write
+    titles : iterable or None
+        The titles of the rows of X
+    params : dict or None
+        Parameters the matrix was computed with
+    """
+
+    with open(pickle_path, "rb") as f:
+        X, feature_names = pickle.load(f)
+
+    save_tfidf(path, X, feature_names, titles, params)
+
+
+def load_model(spec, db_path = "books.db"):
+    """
+    Loads a model with its titles from either a directory written by save_tfidf(), or a "<pickle>:<column>" spec: one of the (X, feature_names) pickles in data/, with the titles of the books.db rows whose column is not empty (the rows the matrix was computed from).
+
+    Returns
+    -------
+    X, feature_names, titles
+    """
+
+    if os.path.isdir(spec):
+        X, feature_names, titles, _ = load_tfidf(spec, mmap=False)
+        if titles is None:
+            raise ValueError(f"{spec} was stored without titles")
+        return X, feature_names, titles
+
+    path, _, column = spec.rpartition(":")
+    if not path:
+        raise ValueError(f"Pickled model {spec} needs a books.db column, e.g. {spec}:description")
+    with open(path, "rb") as f:
+        X, feature_names = pickle.load(f)
+    titles = storage.SqlCorpus(db_path, column).titles()
+    if len(titles) != X.shape[0]:
+        raise ValueError(f"{path} has {X.shape[0]} rows but {db_path} has {len(titles)} books with a {column}")
+
+    return X, feature_names, titles
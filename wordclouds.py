@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import wordcloud
+from wordcloud import WordCloud
+import instrumentation
+
+
+WORDCLOUD_CACHE_DIR = "wordcloud_cache"
+FORMATS = ("png", "svg")
+
+
+def cloud_key(tokens, scores, width, height, seed, fmt):
+    """
+    Cache key of a rendered wordcloud: a hash of everything the image depends on, i.e. the keywords and their scores, the image size, the random seed, the format and the wordcloud version.
+    """
+
+    identity = {
+        "frequencies": [[str(token), repr(float(score))] for token, score in zip(tokens, scores)],
+        "size": [width, height],
+        "seed": seed,
+        "format": fmt,
+        "wordcloud_version": wordcloud.__version__,
+    }
+
+    return hashlib.sha256(json.dumps(identity).encode("utf-8")).hexdigest()
+
+
+def frequencies(tokens, scores):
+    """ The {token: score} input of WordCloud, without the padding of tfidf.top_n() (empty tokens, zero scores) """
+    return {str(token): float(score) for token, score in zip(tokens, scores) if token != "" and score > 0}
+
+
+def render_cloud(tokens, scores, path, width = 1000, height = 500, seed = 42):
+    """
+    Renders one wordcloud to a PNG or SVG file, depending on the extension of path. The file only appears once it is complete.
+
+    Parameters
+    ----------
+    tokens : iterable
+        The keywords of the book
+    scores : iterable
+        The tf-idf values of the keywords
+    path : string
+        The image file to write, ending in .png or .svg
+    width, height : int
+        Size of the image in pixels
+    seed : int
+        Random state of the word layout
+
+    Returns
+    -------
+    path : string
+        The written file
+    """
+
+    cloud = WordCloud(background_color="white", width=width, height=height, random_state=seed)
+    cloud.generate_from_frequencies(frequencies(tokens, scores))
+
+    # Keep the extension on the temporary file, to_file() picks the image format from it
+    head, tail = os.path.split(path)
+    tmp_path = os.path.join(head, f".tmp-{os.getpid()}-{tail}")
+    if path.endswith(".svg"):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(cloud.to_svg())
+    else:
+        cloud.to_file(tmp_path)
+    os.replace(tmp_path, path)
+
+    return path
+
+
+def _render_cloud(args):
+    """ render_cloud() with its arguments packed in one tuple, for executor.map """
+    return render_cloud(*args)
+
+
+def image_filename(title, fmt):
+    """ A file name for the image of a title, made of its letters, digits, dashes and underscores """
+    return re.sub(r"[^\w\-]+", "_", str(title)).strip("_") + f".{fmt}"
+
+
+@instrumentation.instrumented("wordclouds.render_wordclouds", units="selection")
+def render_wordclouds(tokens, scores, rows, selection = None, out_dir = None, fmt = "png", width = 1000, height = 500, seed = 42,
+                      max_workers = None, cache_dir = WORDCLOUD_CACHE_DIR):
+    """
+    Renders the wordclouds of many books to image files, in parallel worker processes. Images are cached by cloud_key(), so a book whose keywords did not change is never redrawn.
+
+    Parameters
+    ----------
+    tokens : iterable
+        The keywords of every book, e.g. from tfidf.max_row(..., index=True) or tfidf.top_n()
+    scores : iterable
+        The matching tf-idf values of every book
+    rows : dict
+        Title -> row of the book in tokens and scores, see tfidf.title_rows()
+    selection : iterable or None
+        The titles to render, by default all of rows
+    out_dir : string or None
+        If given, every image is also copied to this directory, named after its title (see image_filename())
+    fmt : string
+        "png" or "svg"
+    width, height : int
+        Size of the images in pixels
+    seed : int
+        Random state of the word layout
+    max_workers : int or None
+        Number of worker processes, by default the number of cores. With 1, images are rendered in this process.
+    cache_dir : string
+        Directory of the rendered images
+
+    Returns
+    -------
+    images : dict
+        Title -> path of its image
+    """
+
+    if fmt not in FORMATS:
+        raise ValueError(f"fmt must be one of {FORMATS}, not {fmt}")
+    selection = list(rows) if selection is None else list(selection)
+    missing = [title for title in selection if title not in rows]
+    if missing:
+        raise ValueError(f"Not in the corpus: {missing}")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    images = {}
+    tasks = {}
+    for title in selection:
+        book_tokens, book_scores = list(tokens[rows[title]]), list(scores[rows[title]])
+        path = os.path.join(cache_dir, f"{cloud_key(book_tokens, book_scores, width, height, seed, fmt)}.{fmt}")
+        images[title] = path
+        # Identical clouds (e.g. duplicate titles) are rendered once
+        if not os.path.exists(path) and path not in tasks:
+            tasks[path] = (book_tokens, book_scores, path, width, height, seed)
+    instrumentation.count("wordclouds.cache_hit", len(set(images.values())) - len(tasks))
+
+    if max_workers == 1 or len(tasks) <= 1:
+        for task in tasks.values():
+            _render_cloud(task)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(_render_cloud, tasks.values()))
+
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+        for title, path in images.items():
+            images[title] = shutil.copyfile(path, os.path.join(out_dir, image_filename(title, fmt)))
+
+    return images
+
+
+def render_comparisons(summary_tokens, summary_scores, summary_rows, full_tokens, full_scores, full_rows, selection = None, out_dir = None, fmt = "png", **render_kwargs):
+    """
+    Batch version of tfidf.compare_wordclouds(): renders the summary and the full text wordcloud of every selected book to image files.
+
+    Parameters
+    ----------
+    summary_tokens, summary_scores : iterable
+        Keywords and tf-idf values of every summary
+    summary_rows : dict
+        Title -> row of the summaries, see tfidf.title_rows()
+    full_tokens, full_scores : iterable
+        Keywords and tf-idf values of every full text
+    full_rows : dict
+        Title -> row of the full texts
+    selection : iterable or None
+        The titles to render, by default all titles present in both
+    out_dir : string or None
+        If given, images are also copied to out_dir/summary and out_dir/full_text
+    fmt : string
+        "png" or "svg"
+    **render_kwargs
+        Passed on to render_wordclouds(), e.g. width, height, seed, max_workers or cache_dir
+
+    Returns
+    -------
+    images : dict
+        Title -> (summary image path, full text image path), for the selected titles present in both
+    """
+
+    both = [title for title in summary_rows if title in full_rows]
+    if selection is None:
+        selection = both
+    else:
+        selection = list(selection)
+        for title in selection:
+            if title not in summary_rows or title not in full_rows:
+                print(f"The title {title} is not present in both databases.")
+        selection = [title for title in selection if title in summary_rows and title in full_rows]
+
+    summary_dir, full_dir = (None, None) if out_dir is None else (os.path.join(out_dir, "summary"), os.path.join(out_dir, "full_text"))
+    summary_images = render_wordclouds(summary_tokens, summary_scores, summary_rows, selection, summary_dir, fmt, **render_kwargs)
+    full_images = render_wordclouds(full_tokens, full_scores, full_rows, selection, full_dir, fmt, **render_kwargs)
+
+    return {title: (summary_images[title], full_images[title]) for title in selection}